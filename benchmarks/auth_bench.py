@@ -0,0 +1,229 @@
+"""Micro-benchmarks of the auth building blocks and a login -> GET /users -> logout load scenario.
+
+    python -m benchmarks.auth_bench                                # run and print
+    python -m benchmarks.auth_bench --save-baseline                # store the results as the baseline
+    python -m benchmarks.auth_bench --compare --threshold 0.25     # exit 1 if anything got >25% worse
+
+The app from main.py runs in-process on a fresh sqlite file with fakeredis, driven by an async
+httpx client, so runs are repeatable on one machine. Baselines are only comparable on the machine
+(and HASH_POOL_WORKERS) they were recorded with. Install benchmarks/requirements.txt first.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'auth_bench.db')}"
+os.environ["REDIS_URL"] = "fakeredis://"
+os.environ.setdefault("SECRET_KEY_LOGIN", "benchmark-login-key-0123456789abcdef")
+os.environ.setdefault("SECRET_KEY_EMAIL", "benchmark-email-key-0123456789abcdef")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "auth_bench.log"))
+os.environ.setdefault("ACCESS_LOG_SAMPLE_RATE", "0")
+#every virtual user logs in from the same address, the limits would turn the scenario into 429s
+os.environ.setdefault("RATE_LIMIT_LOGIN_PER_IP", "off")
+os.environ.setdefault("RATE_LIMIT_LOGIN_PER_USERNAME", "off")
+
+import httpx
+import jwt
+from sqlalchemy import insert
+
+from main import app, lifespan
+from src.auth import helpers
+from src.auth.hashing import pwd_context
+from src.auth.rate_limit import Rate, rate_limiter
+from src.db import async_crud, crud, database, models
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baselines", "auth_bench.json")
+PASSWORD = "benchmark-password"
+
+
+def summarize(samples: list[float], elapsed: float) -> dict:
+    """Latency percentiles in ms and operations per second"""
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "count": len(samples),
+        "p50_ms": round(cuts[49] * 1000, 4),
+        "p95_ms": round(cuts[94] * 1000, 4),
+        "p99_ms": round(cuts[98] * 1000, 4),
+        "ops_per_second": round(len(samples) / elapsed, 2),
+    }
+
+def time_sync(fn, iterations: int, warmup: int = 3) -> dict:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - begin)
+    return summarize(samples, time.perf_counter() - started)
+
+async def time_async(fn, iterations: int, warmup: int = 3) -> dict:
+    for _ in range(warmup):
+        await fn()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - begin)
+    return summarize(samples, time.perf_counter() - started)
+
+def seed(users: int):
+    models.Base.metadata.create_all(bind=database.get_engine())
+    hashed = pwd_context.hash(PASSWORD) #one hash for everyone, seeding should not take minutes
+    with database.SessionLocal() as db:
+        db.execute(insert(models.User), [
+            {"name": f"user{i}", "email": f"user{i}@example.com", "password": hashed} for i in range(users)
+        ])
+        db.commit()
+
+async def micro(args) -> dict:
+    results = {}
+    token = helpers.create_access_token({"sub": 1}, type="login")
+    hashed = helpers.get_hash(PASSWORD)
+
+    results["create_access_token"] = time_sync(lambda: helpers.create_access_token({"sub": 1}, type="login"), args.iterations)
+    results["jwt.decode"] = time_sync(
+        lambda: jwt.decode(token, helpers.SECRET_KEY_LOGIN, algorithms=[helpers.ALGORITHM]), args.iterations)
+    #bcrypt is slow on purpose, a handful of rounds is enough for stable percentiles
+    results["get_hash"] = await asyncio.to_thread(time_sync, lambda: helpers.get_hash(PASSWORD), args.hash_iterations, 1)
+    results["verify_hash"] = await asyncio.to_thread(
+        time_sync, lambda: helpers.verify_hash(PASSWORD, hashed), args.hash_iterations, 1)
+
+    keys = iter(range(10**9))
+    unlimited = Rate(10**9, 60)
+    results["rate_limiter.hit"] = await time_async(lambda: rate_limiter.hit(f"bench:{next(keys)}", unlimited), args.iterations)
+    exhausted = Rate(1, 3600)
+    await rate_limiter.hit("bench:exhausted", exhausted)
+    results["rate_limiter.hit refused"] = await time_async(
+        lambda: rate_limiter.hit("bench:exhausted", exhausted), args.iterations)
+
+    with database.SessionLocal() as db:
+        results["crud.get_user_by_id"] = time_sync(lambda: crud.get_user_by_id(db, 1), args.iterations)
+    async with database.new_async_session() as db:
+        results["async_crud.get_user_by_id"] = await time_async(
+            lambda: async_crud.get_user_by_id(db, 1), args.iterations)
+    return results
+
+async def load(args) -> dict:
+    """Each virtual user logs in, lists users and logs out, over and over"""
+    steps = {"login": [], "get_users": [], "logout": []}
+    errors = 0
+
+    async def timed(step, request):
+        nonlocal errors
+        begin = time.perf_counter()
+        response = await request
+        steps[step].append(time.perf_counter() - begin)
+        if response.status_code >= 400:
+            errors += 1
+        return response
+
+    async def virtual_user(client, index):
+        name = f"user{index % args.users}"
+        for _ in range(args.rounds):
+            response = await timed("login", client.post("/api/v1/login", data={"username": name, "password": PASSWORD}))
+            if response.status_code != 200:
+                continue
+            headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            await timed("get_users", client.get("/api/v1/users", params={"limit": 50}, headers=headers))
+            await timed("logout", client.post("/api/v1/logout", headers=headers))
+
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(virtual_user(client, i) for i in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+
+    results = {f"load.{step}": summarize(samples, elapsed) for step, samples in steps.items() if len(samples) > 1}
+    results["load.scenario"] = {
+        "count": len(steps["logout"]),
+        "ops_per_second": round(len(steps["logout"]) / elapsed, 2),
+        "errors": errors,
+    }
+    return results
+
+def best_of(runs: list[dict]) -> dict:
+    """Lowest latency and highest throughput seen for each benchmark, which filters out runs
+    that were disturbed by something else on the machine"""
+    merged = {}
+    for name in runs[0]:
+        results = [run[name] for run in runs]
+        best = dict(results[0])
+        for key in best:
+            if key.endswith("_ms") or key == "errors":
+                best[key] = min(result[key] for result in results)
+            elif key == "ops_per_second":
+                best[key] = max(result[key] for result in results)
+        merged[name] = best
+    return merged
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Latencies more than threshold above the baseline, throughput more than threshold below it"""
+    found = []
+    for name, old in baseline.items():
+        new = results.get(name)
+        if new is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if key in old and new[key] > old[key] * (1 + threshold):
+                found.append(f"{name} {key} {old[key]} -> {new[key]}")
+        if new["ops_per_second"] < old["ops_per_second"] / (1 + threshold):
+            found.append(f"{name} ops_per_second {old['ops_per_second']} -> {new['ops_per_second']}")
+        if new.get("errors", 0) > old.get("errors", 0):
+            found.append(f"{name} errors {old.get('errors', 0)} -> {new['errors']}")
+    return found
+
+def report(results: dict):
+    print(f"{'benchmark':28} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>10}")
+    for name, result in results.items():
+        cells = [f"{result[key]:10.3f}" if key in result else f"{'-':>10}" for key in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:28} {result['count']:7d} {' '.join(cells)} {result['ops_per_second']:10.1f}"
+              + (f"  errors {result['errors']}" if result.get("errors") else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000, help="rounds of each fast micro-benchmark")
+    parser.add_argument("--hash-iterations", type=int, default=20, help="rounds of the bcrypt micro-benchmarks")
+    parser.add_argument("--users", type=int, default=100, help="users seeded into the database")
+    parser.add_argument("--concurrency", type=int, default=8, help="virtual users in the load scenario")
+    parser.add_argument("--rounds", type=int, default=5, help="login/list/logout rounds per virtual user")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the whole suite, the best of each number is kept")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--compare", action="store_true", help="exit 1 if the results regressed against --baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    seed(args.users)
+    async def run():
+        return {**await micro(args), **await load(args)}
+    results = best_of([asyncio.run(run()) for _ in range(args.repeat)])
+    report(results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as fp:
+            json.dump({"machine": platform.platform(), "python": platform.python_version(), "results": results}, fp, indent=2)
+        print(f"baseline written to {args.baseline}")
+    if args.compare:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+        found = regressions(results, baseline, args.threshold)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"no regressions beyond {args.threshold:.0%} of {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Check that `import main` stays under a time budget and has no side effects.
+
+    python -m benchmarks.import_time                    # report and enforce the default budget
+    python -m benchmarks.import_time --budget-ms 900    # exit 1 if importing main takes longer
+
+Every uvicorn worker and every test process pays for importing the app, so this is the cold
+start before the first request can be served. The import runs in a fresh interpreter with
+python -X importtime, best of --repeat runs. Importing must not touch the database: the sqlite
+file it is pointed at has to still be missing afterwards, the engine and schema come later.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(env: dict) -> dict:
+    """Cumulative microseconds of `import main` and of each module main imports directly"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    #a module is printed after everything it imported, nested ones indented two spaces a level
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == "main":
+            return {**children, "main": int(cumulative)}
+        if depth == 0:
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    sys.exit("python -X importtime printed no line for main")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=1250, help="allowed cumulative time of importing main, set from the machine it runs on")
+    parser.add_argument("--repeat", type=int, default=5, help="imports measured, the fastest one counts")
+    parser.add_argument("--top", type=int, default=10, help="slowest top level imports to list")
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), "import_time.db")
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{database}",
+        "REDIS_URL": "fakeredis://",
+        "SECRET_KEY_LOGIN": os.environ.get("SECRET_KEY_LOGIN", "import-time-login-key-0123456789abcdef"),
+        "SECRET_KEY_EMAIL": os.environ.get("SECRET_KEY_EMAIL", "import-time-email-key-0123456789abcdef"),
+    }
+    runs = [import_times(env) for _ in range(args.repeat)]
+    best = min(runs, key=lambda times: times["main"])
+    total_ms = best["main"] / 1000
+
+    print(f"{'module':40} {'ms':>8}")
+    slowest = sorted(((us, name) for name, us in best.items() if name != "main"), reverse=True)
+    for us, name in slowest[:args.top]:
+        print(f"{name:40} {us / 1000:8.1f}")
+    print(f"{'import main':40} {total_ms:8.1f}  (budget {args.budget_ms:.0f})")
+
+    failed = False
+    if os.path.exists(database):
+        print("FAIL importing main created the database, connect lazily instead")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL import took {total_ms:.0f}ms, over the {args.budget_ms:.0f}ms budget")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Check that listing recipes costs a constant number of queries however many are on the page.
+
+    python -m benchmarks.recipe_query_count
+
+Exits non-zero if the query count grows with the page size, which would mean an N+1 crept in.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+DATABASE_FILE = os.path.join(tempfile.mkdtemp(), "query_count.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DATABASE_FILE}"
+
+from sqlalchemy import event, insert
+
+from src.db import async_crud, database, models
+
+PAGE_SIZES = (1, 10, 100, 1000)
+STEPS_PER_RECIPE = 5
+
+
+def seed(count: int):
+    models.Base.metadata.create_all(bind=database.get_engine())
+    with database.SessionLocal() as db:
+        db.execute(insert(models.User), [{"name": "owner", "email": "owner@example.com", "password": "x"}])
+        db.execute(insert(models.Recipe), [
+            {"name": f"recipe {i}", "description": "", "user_id": 1, "prep_time": i % 60} for i in range(count)
+        ])
+        db.execute(insert(models.Recipe_Steps), [
+            {"recipe_id": recipe_id, "step_number": step, "instruction": f"step {step}"}
+            for recipe_id in range(1, count + 1) for step in range(1, STEPS_PER_RECIPE + 1)
+        ])
+        db.commit()
+
+async def count_queries(limit: int) -> int:
+    statements = []
+    async_engine = database.get_async_engine()
+    engine = async_engine.sync_engine if async_engine is not None else database.get_engine()
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        async with database.new_async_session() as db:
+            rows = await async_crud.get_recipes_page(db, limit=limit, with_description=True)
+            steps = await async_crud.get_steps_for_recipes(db, [row.id for row in rows])
+            assert len(rows) == limit and all(len(steps[row.id]) == STEPS_PER_RECIPE for row in rows)
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    return len(statements)
+
+async def main():
+    seed(max(PAGE_SIZES))
+    counts = {limit: await count_queries(limit) for limit in PAGE_SIZES}
+    for limit, count in counts.items():
+        print(f"{limit:5} recipes with steps: {count} queries")
+    await database.close_connections()
+    if len(set(counts.values())) != 1:
+        print("query count grows with the number of recipes")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
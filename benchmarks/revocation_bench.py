@@ -0,0 +1,104 @@
+"""Compare blacklist checks per second for the old per request redis EXISTS against the
+bloom filter revocation list, and one by one confirmation against a pipelined batch.
+
+    REDIS_URL=redis://localhost:6379/15 python -m benchmarks.revocation_bench --revoked 10000
+
+Without REDIS_URL the benchmark runs against fakeredis, which has no network round trip
+and so understates how much the filter and the pipeline save. Before measuring it checks
+against a fakeredis server that revoked_among finds exactly the revoked ids of a mixed batch,
+and what a check does while that server is down: possibly revoked tokens are refused with a
+503, or accepted with fail_open, and tokens the filter never saw are accepted either way.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import secrets
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("REDIS_URL", "fakeredis://")
+
+import fakeredis
+
+from src.auth.revocation import RevocationList, RevocationUnavailable
+from src.db.database import create_redis_client
+
+
+async def check_outage():
+    """Fail closed and fail open behaviour, on a fakeredis server of its own that is taken down"""
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    closed, open_ = (RevocationList(client, capacity=1000, error_rate=0.001, sync_seconds=600, rebuild_seconds=600,
+                                    fail_open=fail_open) for fail_open in (False, True))
+    expires_at = int(time.time()) + 1800
+    revoked = [secrets.token_urlsafe(9) for _ in range(50)]
+    never_revoked = [secrets.token_urlsafe(9) for _ in range(50)]
+    for jti in revoked:
+        await closed.revoke(jti, expires_at)
+        await open_.revoke(jti, expires_at)
+    assert await closed.revoked_among(revoked + never_revoked) == set(revoked), "pipelined check missed revoked ids"
+
+    server.connected = False
+    logging.getLogger("src.auth.revocation").disabled = True #the outage is on purpose, skip its tracebacks
+    try:
+        await closed.is_revoked(revoked[0])
+        raise AssertionError("fail closed accepted a possibly revoked token while redis was down")
+    except RevocationUnavailable as error:
+        assert error.status_code == 503
+    assert await open_.is_revoked(revoked[0]) is False, "fail open refused a token while redis was down"
+    assert await closed.revoked_among(never_revoked) == set(), "tokens the filter never saw need no redis"
+    server.connected = True
+    logging.getLogger("src.auth.revocation").disabled = False
+    assert await closed.is_revoked(revoked[0]), "revoked token accepted once redis was back"
+    await client.aclose()
+    print("outage checks       ok (fail closed 503, fail open accepted, unseen tokens unaffected)")
+
+async def rate(fn, ids) -> float:
+    start = time.perf_counter()
+    for jti in ids:
+        await fn(jti)
+    return len(ids) / (time.perf_counter() - start)
+
+async def run(args):
+    await check_outage()
+    client = create_redis_client()
+    await client.flushdb()
+    revocations = RevocationList(client, capacity=max(args.revoked, 1000), error_rate=0.001,
+                                 sync_seconds=1, rebuild_seconds=600)
+    expires_at = int(time.time()) + 1800
+    revoked = [secrets.token_urlsafe(9) for _ in range(args.revoked)]
+    for jti in revoked:
+        await revocations.revoke(jti, expires_at)
+    await revocations.rebuild()
+
+    ids = [secrets.token_urlsafe(9) for _ in range(args.checks)]
+    async def exists(jti):
+        return await client.exists("revoked:" + jti) == 1
+    exists_rate = await rate(exists, ids)
+    bloom_rate = await rate(revocations.is_revoked, ids)
+
+    batch = revoked[:args.batch]
+    single_rate = await rate(revocations.is_revoked, batch)
+    start = time.perf_counter()
+    await revocations.revoked_among(batch)
+    pipelined_rate = len(batch) / (time.perf_counter() - start)
+    await client.aclose()
+
+    print(f"revoked tokens      {args.revoked}")
+    print(f"redis EXISTS        {exists_rate:12.0f} checks/s")
+    print(f"bloom filter        {bloom_rate:12.0f} checks/s  ({bloom_rate / exists_rate:.1f}x)")
+    print(f"filter false hits   {revocations.filter_hits - 2 * len(batch)} of {args.checks}")
+    print(f"revoked, one by one {single_rate:12.0f} checks/s")
+    print(f"revoked, pipelined  {pipelined_rate:12.0f} checks/s  ({pipelined_rate / single_rate:.1f}x, batch of {len(batch)})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--revoked", type=int, default=10000, help="tokens revoked before measuring")
+    parser.add_argument("--checks", type=int, default=20000, help="checks of tokens that were never revoked")
+    parser.add_argument("--batch", type=int, default=100, help="revoked tokens confirmed in one pipeline")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
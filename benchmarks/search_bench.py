@@ -0,0 +1,85 @@
+"""Recipe search latency on a large synthetic sqlite catalogue.
+
+    python -m benchmarks.search_bench --recipes 1000000
+
+Builds the database once in --path (reused on later runs with the same size), then times
+search_recipes for a mix of full word, prefix and prep time filtered queries.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+WORDS = ("tomato basil garlic onion pepper chicken beef pork tofu rice pasta noodle bean lentil "
+         "potato carrot celery lemon lime ginger chili cumin curry soup stew salad roast grill "
+         "bake fry steam simmer boil chop dice slice whisk fold knead marinate glaze crispy creamy "
+         "spicy smoky sweet sour tangy fresh quick hearty mushroom spinach kale cheese butter").split()
+QUERIES = ["garlic", "tom", "spicy soup", "roast chick", "creamy mushroom pasta", "gin", "lentil stew"]
+
+
+def build(count: int, seed: int = 1):
+    from sqlalchemy import insert, text
+    from src.db import database, models
+    from src.search.recipe_search import rebuild_search_index
+
+    models.Base.metadata.create_all(bind=database.get_engine())
+    with database.get_engine().begin() as connection:
+        if connection.execute(text("SELECT count(*) FROM recipes")).scalar() == count:
+            return
+    rng = random.Random(seed)
+    sentence = lambda n: " ".join(rng.choice(WORDS) for _ in range(n))
+    started = time.perf_counter()
+    with database.get_engine().begin() as connection:
+        connection.execute(insert(models.User), [{"name": "owner", "email": "owner@example.com", "password": "x"}])
+        batch = 50000
+        for start in range(0, count, batch):
+            ids = range(start + 1, min(start + batch, count) + 1)
+            connection.execute(insert(models.Recipe), [
+                {"id": i, "name": f"{sentence(3)} {i}", "description": sentence(12), "user_id": 1, "prep_time": rng.randint(5, 180)}
+                for i in ids
+            ])
+            connection.execute(insert(models.Recipe_Steps), [
+                {"recipe_id": i, "step_number": step, "instruction": sentence(8)} for i in ids for step in (1, 2, 3)
+            ])
+        rebuild_search_index(connection)
+    print(f"built {count} recipes in {time.perf_counter() - started:.1f}s")
+
+async def measure(rounds: int):
+    from src.db import database
+    from src.search.recipe_search import search_recipes
+
+    timings = {}
+    async with database.new_async_session() as db:
+        for query in QUERIES:
+            for max_prep_time in (None, 30):
+                samples = []
+                for _ in range(rounds):
+                    started = time.perf_counter()
+                    await search_recipes(db, query, max_prep_time=max_prep_time, limit=20)
+                    samples.append((time.perf_counter() - started) * 1000)
+                timings[(query, max_prep_time)] = samples
+    await database.close_connections()
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipes", type=int, default=1000000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--path", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(args.path, f'search_bench_{args.recipes}.db')}"
+    build(args.recipes)
+    timings = asyncio.run(measure(args.rounds))
+    print(f"{'query':28} {'filter':>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for (query, max_prep_time), samples in timings.items():
+        samples.sort()
+        p95 = samples[int(len(samples) * 0.95) - 1]
+        prep_filter = f"<={max_prep_time}m" if max_prep_time else "-"
+        print(f"{query:28} {prep_filter:>10} {statistics.median(samples):8.2f} {p95:8.2f}")
+
+if __name__ == "__main__":
+    main()
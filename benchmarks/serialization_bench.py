@@ -0,0 +1,169 @@
+"""Encode time and bytes sent for 10k row user and recipe listings.
+
+    python -m benchmarks.serialization_bench --rows 10000
+
+The rows come from the crud functions the list endpoints use, on a fresh sqlite file. Each way
+of turning them into a JSON body is timed on the same rows, then the bodies are compressed the
+ways the CompressionMiddleware can. Last, GET /users/export streams every user through the app
+once per Accept-Encoding. Install benchmarks/requirements.txt first.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'serialization_bench.db')}"
+os.environ["REDIS_URL"] = "fakeredis://"
+os.environ.setdefault("SECRET_KEY_LOGIN", "benchmark-login-key-0123456789abcdef")
+os.environ.setdefault("SECRET_KEY_EMAIL", "benchmark-email-key-0123456789abcdef")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "serialization_bench.log"))
+os.environ.setdefault("ACCESS_LOG_SAMPLE_RATE", "0")
+os.environ.setdefault("RATE_LIMIT_LOGIN_PER_IP", "off")
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy import insert
+
+from main import app, lifespan
+from src.auth.hashing import pwd_context
+from src.db import async_crud, database, models
+from src.schemas.pydantic_schemas import RecipeInfo, RecipeSummary, StepInfo, UserInfo
+from src.server.compression import BrotliEncoder, GzipEncoder, brotli
+from src.server.responses import dumps
+
+PASSWORD = "benchmark-password"
+
+_users = TypeAdapter(list[UserInfo])
+_summaries = TypeAdapter(list[RecipeSummary])
+_recipes = TypeAdapter(list[RecipeInfo])
+
+
+def seed(rows: int):
+    models.Base.metadata.create_all(bind=database.get_engine())
+    hashed = pwd_context.hash(PASSWORD)
+    with database.SessionLocal() as db:
+        db.execute(insert(models.User), [
+            {"name": f"user{i}", "email": f"user{i}@example.com", "password": hashed} for i in range(rows)
+        ])
+        db.execute(insert(models.Recipe), [
+            {"name": f"recipe {i}", "description": "Simmer the beans with garlic, cumin and a bay leaf until soft. " * 2,
+             "user_id": 1 + i % rows, "prep_time": 5 + i % 120}
+            for i in range(rows)
+        ])
+        db.execute(insert(models.Recipe_Steps), [
+            {"recipe_id": i + 1, "step_number": step, "instruction": f"Step {step}: chop, stir and season to taste."}
+            for i in range(rows) for step in (1, 2, 3)
+        ])
+        db.commit()
+
+def best_ms(fn, repeat: int):
+    """Fastest of repeat runs in ms, and what the last run returned"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+def user_encoders(rows):
+    return {
+        #what GET /users did before: dicts through the stdlib
+        "stdlib json": lambda: json.dumps([{"name": row.name, "email": row.email, "id": row.id} for row in rows]).encode(),
+        #what FastAPI does for a list of dicts returned under response_model with its JSONResponse
+        "response_model + json": lambda: json.dumps(jsonable_encoder(_users.dump_python(
+            _users.validate_python([{"name": row.name, "email": row.email, "id": row.id} for row in rows]), mode="json"))).encode(),
+        "pydantic dump_json": lambda: _users.dump_json(_users.validate_python(rows, from_attributes=True)),
+        "orjson": lambda: dumps([{"name": row.name, "email": row.email, "id": row.id} for row in rows]),
+    }
+
+def summary_encoders(rows):
+    return {
+        "stdlib json": lambda: json.dumps([
+            {"id": row.id, "name": row.name, "prep_time": row.prep_time, "user_id": row.user_id,
+             "created_at": row.created_at.isoformat()} for row in rows]).encode(),
+        #what GET /recipes did before
+        "pydantic per row": lambda: _summaries.dump_json([RecipeSummary(**row._mapping) for row in rows]),
+        "pydantic dump_json": lambda: _summaries.dump_json(_summaries.validate_python(rows, from_attributes=True)),
+        "orjson": lambda: dumps([
+            {"id": row.id, "name": row.name, "prep_time": row.prep_time, "user_id": row.user_id,
+             "created_at": row.created_at} for row in rows]),
+    }
+
+def recipe_encoders(rows, steps):
+    def step_dicts(recipe_id):
+        return [{"step_number": step.step_number, "instruction": step.instruction, "image_url": step.image_url,
+                 "id": step.id} for step in steps[recipe_id]]
+    return {
+        #what GET /recipes?include_steps=true did before
+        "pydantic per row": lambda: _recipes.dump_json([
+            RecipeInfo(**row._mapping, steps=[StepInfo.model_validate(step) for step in steps[row.id]]) for row in rows]),
+        "orjson": lambda: dumps([
+            {"id": row.id, "name": row.name, "prep_time": row.prep_time, "user_id": row.user_id,
+             "created_at": row.created_at, "description": row.description, "steps": step_dicts(row.id)} for row in rows]),
+    }
+
+def compressors():
+    def one_shot(encoder):
+        return lambda body: encoder.compress(body) + encoder.finish()
+    found = {f"gzip {level}": (lambda level: lambda body: one_shot(GzipEncoder(level))(body))(level) for level in (1, 5, 9)}
+    if brotli is not None:
+        found.update({f"br {quality}": (lambda quality: lambda body: one_shot(BrotliEncoder(quality))(body))(quality)
+                      for quality in (1, 4, 6, 11)})
+    return found
+
+async def encode(args):
+    async with database.new_async_session() as db:
+        users = await async_crud.get_users_page(db, limit=args.rows)
+        recipes = await async_crud.get_recipes_page(db, limit=args.rows, with_description=True)
+        steps = await async_crud.get_steps_for_recipes(db, [row.id for row in recipes])
+    await database.close_connections() #the export below runs on another event loop
+    bodies = {}
+    print(f"{'listing':24} {'encoder':24} {'best ms':>9} {'bytes':>10}")
+    for listing, encoders in (("users", user_encoders(users)), ("recipe summaries", summary_encoders(recipes)),
+                              ("recipes with steps", recipe_encoders(recipes, steps))):
+        for name, fn in encoders.items():
+            ms, body = best_ms(fn, args.repeat)
+            print(f"{listing:24} {name:24} {ms:9.2f} {len(body):10d}")
+        bodies[listing] = body #the orjson one, what the endpoints send now
+
+    print(f"\n{'listing':24} {'encoding':24} {'best ms':>9} {'bytes':>10} {'ratio':>7}")
+    for listing, body in bodies.items():
+        print(f"{listing:24} {'identity':24} {0:9.2f} {len(body):10d} {1:7.2f}")
+        for name, fn in compressors().items():
+            ms, compressed = best_ms(lambda: fn(body), args.repeat)
+            print(f"{listing:24} {name:24} {ms:9.2f} {len(compressed):10d} {len(body) / len(compressed):7.2f}")
+
+async def export(args):
+    """GET /users/export through the app and its middleware, bytes as they come off the wire"""
+    print(f"\n{'GET /users/export':24} {'accept-encoding':24} {'best ms':>9} {'bytes':>10}")
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            response = await client.post("/api/v1/login", data={"username": "user0", "password": PASSWORD})
+            token = response.json()["access_token"]
+            for accept in ("identity", "gzip", "br"):
+                best, size = float("inf"), 0
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    async with client.stream("GET", "/api/v1/users/export", headers={
+                            "Authorization": f"Bearer {token}", "Accept-Encoding": accept}) as response:
+                        size = sum([len(chunk) async for chunk in response.aiter_raw()])
+                    best = min(best, time.perf_counter() - started)
+                print(f"{'':24} {accept:24} {best * 1000:9.2f} {size:10d}  {response.headers.get('content-encoding', '')}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="users and recipes in the listings")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each measurement, the best is kept")
+    args = parser.parse_args()
+
+    seed(args.rows)
+    asyncio.run(encode(args))
+    asyncio.run(export(args))
+
+if __name__ == "__main__":
+    main()
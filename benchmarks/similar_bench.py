@@ -0,0 +1,69 @@
+"""Build time, recall and lookup latency of the similar recipes table.
+
+    python -m benchmarks.similar_bench --recipes 20000
+
+Uses the synthetic catalogue of search_bench, built once in --path. Times a full exact build and
+a full approximate one, and reports how many of each recipe's exact top 10 the approximate build
+found. The catalogue's recipes are random words from one small vocabulary, nearly equally similar
+to each other, so that recall is a floor; on real recipes, which cluster, it is much higher. Then
+1% of the recipes are edited and an incremental build is timed. Last it times SimilarIndex.lookup,
+which is all GET /recipes/{id}/similar does besides auth.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+
+def recall(exact, approximate, k: int) -> float:
+    """Share of the exact top k neighbours that the approximate table also has"""
+    found = total = 0
+    for expected, got in zip(exact[:, :k].tolist(), approximate[:, :k].tolist()):
+        expected = {neighbour for neighbour in expected if neighbour >= 0}
+        found += len(expected.intersection(got))
+        total += len(expected)
+    return found / total if total else 1.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipes", type=int, default=20000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--path", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(args.path, f'search_bench_{args.recipes}.db')}"
+    import numpy as np
+    from sqlalchemy import update
+    from benchmarks.search_bench import build as build_catalogue
+    from src.db import database, models
+    from src.search import build_similar
+    from src.search.similar import SimilarIndex
+
+    build_catalogue(args.recipes)
+    index_path = tempfile.mkdtemp()
+    print(f"{'build':14} {'recipes':>8} {'read':>8} {'reused':>8} {'seconds':>8}")
+    def report(name, meta):
+        print(f"{name:14} {meta['recipes']:8d} {meta['read']:8d} {meta['reused']:8d} {meta['seconds']:8.2f}")
+        return SimilarIndex(os.path.join(index_path, meta["build"]))
+
+    exact = report("exact", build_similar.build(index_path, full=True))
+    approximate = report("approximate", build_similar.build(index_path, full=True, approximate=True))
+    with database.get_engine().begin() as connection:
+        connection.execute(update(models.Recipe).where(models.Recipe.id % 100 == 0).values(
+            description=models.Recipe.description + " edited", version=models.Recipe.version + 1))
+    index = report("incremental", build_similar.build(index_path))
+    print(f"\napproximate recall@10 {recall(np.asarray(exact.neighbours), np.asarray(approximate.neighbours), 10):.3f}")
+
+    rng = np.random.default_rng(0)
+    recipe_ids = rng.choice(np.asarray(index.ids), size=args.lookups).tolist()
+    samples = []
+    for recipe_id in recipe_ids:
+        started = time.perf_counter()
+        index.lookup(recipe_id, 10)
+        samples.append((time.perf_counter() - started) * 1e6)
+    cuts = statistics.quantiles(samples, n=100)
+    print(f"lookup p50 {cuts[49]:.1f}us p99 {cuts[98]:.1f}us over {args.lookups} lookups")
+
+if __name__ == "__main__":
+    main()
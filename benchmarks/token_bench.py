@@ -0,0 +1,68 @@
+"""Per token cost of signing and verifying, PyJWT's jwt.encode / jwt.decode against TokenService.
+
+    python -m benchmarks.token_bench --tokens 20000
+
+For HS256, ES256 and EdDSA: jwt.encode and jwt.decode given the key the way the app used to
+give it (the secret, or a PEM that has to be parsed), then given a prebuilt key object, then
+TokenService.sign, verify and verify_many on a batch of distinct tokens.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+
+from src.auth.tokens import Keyring, TokenKey, TokenService, new_key
+
+
+def per_token_us(fn, tokens: int, repeat: int) -> float:
+    """Fastest of repeat runs of fn over the batch, in microseconds per token"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1e6 / tokens
+
+def pem(key) -> bytes:
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+def public_pem(key) -> bytes:
+    return key.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each measurement, the best is kept")
+    args = parser.parse_args()
+
+    expires = datetime.now(timezone.utc) + timedelta(minutes=30)
+    claims = [{"sub": i, "exp": expires, "jti": f"{i:012d}"} for i in range(args.tokens)]
+    print(f"{'algorithm':10} {'way':34} {'sign us':>9} {'verify us':>10}")
+    for algorithm_name in ("HS256", "ES256", "EdDSA"):
+        key = TokenKey.from_jwk(new_key(algorithm_name, "bench"))
+        service = TokenService(Keyring([key]))
+        if algorithm_name == "HS256":
+            configured = (key.signing_key.decode("latin-1"), key.signing_key.decode("latin-1"))
+        else:
+            configured = (pem(key.signing_key), public_pem(key.verifying_key))
+        for way, (signing_key, verifying_key) in (("jwt.encode/decode, secret or PEM", configured),
+                                                  ("jwt.encode/decode, key object", (key.signing_key, key.verifying_key))):
+            tokens = [jwt.encode(claim, signing_key, algorithm=algorithm_name) for claim in claims]
+            sign = per_token_us(lambda: [jwt.encode(claim, signing_key, algorithm=algorithm_name) for claim in claims],
+                                args.tokens, args.repeat)
+            verify = per_token_us(lambda: [jwt.decode(token, verifying_key, algorithms=[algorithm_name]) for token in tokens],
+                                  args.tokens, args.repeat)
+            print(f"{algorithm_name:10} {way:34} {sign:9.2f} {verify:10.2f}")
+
+        tokens = [service.sign(claim) for claim in claims]
+        assert service.verify_many(tokens) == [jwt.decode(token, key.verifying_key, algorithms=[algorithm_name]) for token in tokens]
+        sign = per_token_us(lambda: [service.sign(claim) for claim in claims], args.tokens, args.repeat)
+        verify = per_token_us(lambda: [service.verify(token) for token in tokens], args.tokens, args.repeat)
+        print(f"{algorithm_name:10} {'TokenService.sign/verify':34} {sign:9.2f} {verify:10.2f}")
+        verify = per_token_us(lambda: service.verify_many(tokens), args.tokens, args.repeat)
+        print(f"{algorithm_name:10} {'TokenService.verify_many':34} {'':9} {verify:10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Statements and time per user update, the ORM way PUT /users/{id} used to write against
+write_user and update_users_bulk.
+
+    python -m benchmarks.user_writes_bench --users 2000
+
+Renames every user of a fresh sqlite file once per way of writing, after reading them through the
+cache like a client that GETs a user before it PUTs it. Passwords are left alone, hashing one costs
+the same whichever way it is stored. COMMITs are not counted as statements. Install
+benchmarks/requirements.txt first.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'user_writes_bench.db')}"
+os.environ["REDIS_URL"] = "fakeredis://"
+os.environ.setdefault("SECRET_KEY_LOGIN", "benchmark-login-key-0123456789abcdef")
+os.environ.setdefault("SECRET_KEY_EMAIL", "benchmark-email-key-0123456789abcdef")
+
+from sqlalchemy import event, insert
+
+from src.auth.token_cache import invalidate_user_tokens
+from src.db import async_crud, database, models
+from src.db.http_cache import versions
+
+
+def seed(users: int):
+    models.Base.metadata.create_all(bind=database.get_engine())
+    with database.SessionLocal() as db:
+        db.execute(insert(models.User), [
+            {"name": f"user{i}", "email": f"user{i}@example.com", "password": "x"} for i in range(users)
+        ])
+        db.commit()
+
+async def orm_update(db, user_id: int, changes: dict):
+    """What PUT /users/{id} did before, async_crud.get_user_by_id and the old update_user"""
+    user = await async_crud.get_user_by_id(db, user_id)
+    old_name_and_email = (user.name, user.email)
+    for key, value in changes.items():
+        setattr(user, key, value)
+    await db.commit()
+    await db.refresh(user)
+    await invalidate_user_tokens(user.id)
+    await async_crud._invalidate_user(user.id, old_name_and_email, (user.name, user.email))
+    await versions.remember("user", user.id, user.version)
+
+async def measure(args):
+    statements = 0
+
+    def count(*_):
+        nonlocal statements
+        statements += 1
+    event.listen(database.get_async_engine().sync_engine, "before_cursor_execute", count)
+
+    user_ids = list(range(1, args.users + 1))
+    async def one_by_one(write):
+        async with database.new_async_session() as db:
+            for user_id in user_ids:
+                await write(db, user_id)
+
+    async def bulk(round):
+        async with database.new_async_session() as db:
+            for start in range(0, len(user_ids), args.batch):
+                batch = user_ids[start:start + args.batch]
+                await async_crud.update_users_bulk(db, [(user_id, {"name": f"{round}-{user_id}"}, None) for user_id in batch])
+
+    ways = {
+        "orm load, commit, refresh": lambda: one_by_one(lambda db, user_id: orm_update(db, user_id, {"name": f"a-{user_id}"})),
+        "write_user": lambda: one_by_one(lambda db, user_id: async_crud.write_user(db, user_id, {"name": f"b-{user_id}"})),
+        "write_user if-match": lambda: one_by_one(lambda db, user_id: async_crud.write_user(db, user_id, {"name": f"c-{user_id}"}, expected_version=3)),
+        f"update_users_bulk by {args.batch}": lambda: bulk("d"),
+    }
+    print(f"{'way':32} {'statements/user':>16} {'ms/user':>9}")
+    for name, run in ways.items():
+        async with database.new_async_session() as db:
+            for user_id in user_ids:
+                await async_crud.cached_get_user_by_id(db, user_id)
+        statements = 0
+        started = time.perf_counter()
+        await run()
+        seconds = time.perf_counter() - started
+        print(f"{name:32} {statements / args.users:16.3f} {seconds * 1000 / args.users:9.3f}")
+    await database.close_connections()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=500, help="users per PATCH /users")
+    args = parser.parse_args()
+
+    seed(args.users)
+    asyncio.run(measure(args))
+
+if __name__ == "__main__":
+    main()
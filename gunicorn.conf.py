@@ -0,0 +1,33 @@
+"""Production server under gunicorn, an alternative to serve.py:
+
+    gunicorn -c gunicorn.conf.py main:app
+
+The app is imported once in the master and the workers are forked from it, so they share the
+imported modules and the warmed-up state instead of each building their own. Nothing that
+opens a connection or starts a thread runs at import, which is what makes that fork safe.
+Settings come from the same environment variables as serve.py, see src/server/settings.py.
+"""
+from src.server import settings
+
+workers = settings.worker_count()
+settings.prepare_environment(workers) #before the app is preloaded below, it reads these
+
+bind = f"{settings.HOST}:{settings.PORT}"
+worker_class = "src.server.gunicorn_worker.Worker"
+preload_app = True
+keepalive = settings.KEEPALIVE_SECONDS
+backlog = settings.BACKLOG
+graceful_timeout = settings.GRACEFUL_TIMEOUT
+timeout = settings.WORKER_TIMEOUT
+max_requests = settings.MAX_REQUESTS
+max_requests_jitter = settings.MAX_REQUESTS_JITTER
+
+
+def on_starting(server):
+    settings.clear_metrics_dir()
+    import main
+    main.warm_up()
+
+def child_exit(server, worker):
+    from src.metrics.prometheus import mark_process_dead
+    mark_process_dead(worker.pid)
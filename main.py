@@ -1,22 +1,61 @@
+import asyncio
 import logging
 import time
+import uuid
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-from src.db import models
-from src.db.database import engine
-from src.routers import login, email, users
-from src.logs.logging_config import setup_logging
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.orm.exc import StaleDataError
+from src.db.database import close_connections
+from src.auth.hashing import hashing_service, pwd_context
+from src.auth.token_cache import start_invalidation_listener
+from src.config.load import email_config_store
+from src.images.uploads import thumbnail_renderer
+from src.mail.worker import EMAIL_WORKER_IN_PROCESS, build_email_worker
+from src.metrics.prometheus import REQUEST_LATENCY, REQUESTS_IN_PROGRESS, mark_process_dead, route_label
+from src.routers import login, email, images, metrics, recipes, users
+from src.server.compression import COMPRESSION_BROTLI_QUALITY, COMPRESSION_GZIP_LEVEL, COMPRESSION_MINIMUM_SIZE, CompressionMiddleware
+from src.server.responses import JSONResponse
+from src.logs.logging_config import access_logger, request_id_var, setup_logging, should_log_access, stop_logging
 
 
 logging.getLogger('passlib').setLevel(logging.ERROR) #silences a warning between passlib and bcrypt
-setup_logging()
 
-models.Base.metadata.create_all(bind=engine)
+def warm_up():
+    """Build what would otherwise be built on the first requests. It opens no connections and
+    starts no threads, so gunicorn can run it once before forking the workers"""
+    configure_mappers()
+    pwd_context.handler().get_backend() #loads bcrypt
+    app.openapi()
+
+#importing this module only declares the app, everything that starts threads or opens files or
+#connections happens here. The schema is managed by migrations, run `alembic upgrade head` first
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    warm_up() #already done when the workers were forked from a preloaded app
+    token_cache_listener = start_invalidation_listener()
+    email_config_store.start_watching()
+    email_worker = build_email_worker() if EMAIL_WORKER_IN_PROCESS else None
+    email_worker_task = asyncio.create_task(email_worker.run()) if email_worker else None
+    yield
+    email_config_store.stop_watching()
+    if email_worker_task is not None:
+        email_worker_task.cancel()
+        email_worker.close()
+    token_cache_listener.cancel()
+    await thumbnail_renderer.shutdown()
+    hashing_service.shutdown()
+    await close_connections()
+    mark_process_dead()
+    stop_logging()
 
 app = FastAPI(
     title="Recipe Organizer API",
-    version="0.0.1"
+    version="0.0.1",
+    lifespan=lifespan,
+    default_response_class=JSONResponse,
 )
 
 origins = [
@@ -24,6 +63,14 @@ origins = [
     "http://localhost:8080",
 ]
 
+#innermost, so the latency the middleware below records includes compressing
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MINIMUM_SIZE,
+    gzip_level=COMPRESSION_GZIP_LEVEL,
+    brotli_quality=COMPRESSION_BROTLI_QUALITY,
+)
+
 #might want to remove later
 app.add_middleware(
     CORSMiddleware,
@@ -35,24 +82,57 @@ app.add_middleware(
 
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
+    #for streamed responses this is the time until the body starts, not until it ends
+    request_id = request.headers.get("X-Request-ID", "")
+    if not request_id or len(request_id) > 64 or not request_id.isprintable():
+        request_id = uuid.uuid4().hex
+    request_id_token = request_id_var.set(request_id)
+    in_progress = REQUESTS_IN_PROGRESS.labels(request.method)
+    in_progress.inc()
+    status_code = 500
+    start_time = time.perf_counter()
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        process_time = time.perf_counter() - start_time
+        in_progress.dec()
+        REQUEST_LATENCY.labels(request.method, route_label(request), str(status_code)).observe(process_time)
+        if should_log_access(status_code, process_time):
+            access_logger.info("%s %s %s", request.method, request.url.path, status_code, extra={
+                "status": status_code, "duration_ms": round(process_time * 1000, 2),
+                "client": request.client.host if request.client else None,
+            })
+        request_id_var.reset(request_id_token)
     response.headers["X-Process-Time"] = str(process_time)
+    response.headers["X-Request-ID"] = request_id
+    response.headers.update(getattr(request.state, "rate_limit_headers", {}))
     return response
 
 
+#an ORM write found its row at another version than the one it loaded, see version_id_col in models.py
+@app.exception_handler(StaleDataError)
+async def stale_data_handler(request: Request, exc: StaleDataError):
+    return JSONResponse(status_code=409, content={"detail": "The resource was changed by another request, reload it and try again"})
+
+
 #endpoints
 
 app.include_router(login.router, prefix="/api/v1", tags=["login"])
 app.include_router(users.router, prefix="/api/v1", tags=["users"])
+app.include_router(recipes.router, prefix="/api/v1", tags=["recipes"])
+app.include_router(images.router, prefix="/api/v1", tags=["images"])
+app.include_router(metrics.router, tags=["metrics"])
 
 #currently disabling email routes
 # app.include_router(email.router, tags=["email"])
 
 
+#development server, one process that reloads on changes. serve.py or gunicorn.conf.py run production
 if __name__ == '__main__':
+    import uvicorn
     uvicorn.run("main:app",
                 host="0.0.0.0",
                 port=8080,
-                reload=True)
+                reload=True,
+                access_log=False)
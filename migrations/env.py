@@ -0,0 +1,53 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+from src.db import models
+from src.db.database import SQLALCHEMY_DATABASE_URL
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keep autogenerate away from what only exists on one backend: the FTS5 table on sqlite
+    (and its shadow tables) and the FULLTEXT indexes on MySQL. The migrations create those by hand"""
+    if type_ == "table" and name.startswith("recipe_search"):
+        return False
+    if type_ == "index" and name.endswith("_fulltext"):
+        return context.get_context().dialect.name == "mysql"
+    return True
+
+
+def run_migrations_offline() -> None:
+    """Print the SQL instead of running it, `alembic upgrade head --sql`"""
+    context.configure(
+        url=SQLALCHEMY_DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        render_as_batch=True,
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online() -> None:
+    #a plain engine without the app's pool settings or metrics, migrations run once and exit
+    connectable = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=pool.NullPool)
+    with connectable.connect() as connection:
+        #sqlite cannot ALTER most things, batch mode rebuilds the table instead
+        context.configure(connection=connection, target_metadata=target_metadata,
+                          render_as_batch=True, include_object=include_object)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
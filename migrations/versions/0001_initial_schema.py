@@ -0,0 +1,84 @@
+"""initial schema
+
+The tables create_all used to make at startup, including the search indexes: FULLTEXT on MySQL
+and the recipe_search FTS5 table on sqlite.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 19:16:40.189410
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+
+    op.create_table('users',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=30), nullable=False),
+    sa.Column('email', sa.String(length=254), nullable=False),
+    sa.Column('password', sa.String(length=128), nullable=False),
+    sa.Column('status', sa.Enum('new', 'invited', 'active', 'deleted', name='userstatus'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_users_email'), 'users', ['email'], unique=True)
+    op.create_index(op.f('ix_users_id'), 'users', ['id'], unique=False)
+    op.create_index(op.f('ix_users_name'), 'users', ['name'], unique=True)
+    op.create_index(op.f('ix_users_status'), 'users', ['status'], unique=False)
+
+    op.create_table('recipes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=254), nullable=False),
+    sa.Column('description', sa.Text(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('prep_time', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_recipes_id'), 'recipes', ['id'], unique=False)
+    op.create_index(op.f('ix_recipes_name'), 'recipes', ['name'], unique=True)
+    op.create_index(op.f('ix_recipes_user_id'), 'recipes', ['user_id'], unique=False)
+
+    op.create_table('recipe_steps',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('recipe_id', sa.Integer(), nullable=False),
+    sa.Column('step_number', sa.Integer(), nullable=False),
+    sa.Column('instruction', sa.Text(), nullable=False),
+    sa.Column('image_url', sa.String(length=1024), nullable=True),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipes.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('recipe_id', 'step_number')
+    )
+    op.create_index(op.f('ix_recipe_steps_id'), 'recipe_steps', ['id'], unique=False)
+    op.create_index(op.f('ix_recipe_steps_recipe_id'), 'recipe_steps', ['recipe_id'], unique=False)
+
+    if dialect == "mysql":
+        op.create_index('ix_recipes_fulltext', 'recipes', ['name', 'description'], unique=False, mysql_prefix='FULLTEXT')
+        op.create_index('ix_recipe_steps_fulltext', 'recipe_steps', ['instruction'], unique=False, mysql_prefix='FULLTEXT')
+    elif dialect == "sqlite":
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search USING fts5("
+                   "name, description, steps, tokenize='unicode61', prefix='2 3')")
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == "sqlite":
+        op.execute("DROP TABLE IF EXISTS recipe_search")
+
+    op.drop_table('recipe_steps')
+    op.drop_table('recipes')
+    op.drop_table('users')
+    if dialect == "postgresql":
+        sa.Enum(name='userstatus').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,37 @@
+"""Production server: a uvicorn worker process per CPU, on uvloop and httptools when installed.
+
+    python serve.py                         # uvicorn supervisor, settings from src/server/settings.py
+    gunicorn -c gunicorn.conf.py main:app   # gunicorn with the app preloaded before fork
+
+`python main.py` is the single process, auto reloading development server. uvicorn starts its
+workers as fresh interpreters, so each imports the app itself, use gunicorn to preload it.
+On SIGINT or SIGTERM workers stop accepting connections, finish in-flight requests for up to
+GRACEFUL_TIMEOUT minus a few seconds and then run the lifespan shutdown, which closes the
+database and redis pools.
+"""
+import logging
+import uvicorn
+from src.server import settings
+
+
+def main():
+    workers = settings.worker_count()
+    settings.prepare_environment(workers)
+    settings.clear_metrics_dir()
+    loop, http = settings.event_loop(), settings.http_protocol()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger(__name__).info("starting %d workers on %s:%d (loop %s, http %s)",
+                                     workers, settings.HOST, settings.PORT, loop, http)
+    uvicorn.run("main:app",
+                host=settings.HOST,
+                port=settings.PORT,
+                workers=workers,
+                loop=loop,
+                http=http,
+                backlog=settings.BACKLOG,
+                timeout_keep_alive=settings.KEEPALIVE_SECONDS,
+                timeout_graceful_shutdown=settings.drain_seconds(),
+                access_log=False)
+
+if __name__ == '__main__':
+    main()
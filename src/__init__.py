@@ -0,0 +1,5 @@
+from dotenv import load_dotenv
+
+#settings are read from the environment when each module is imported, so .env is loaded here,
+#once, before any of them
+load_dotenv()
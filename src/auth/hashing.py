@@ -0,0 +1,174 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from src.metrics.prometheus import PASSWORD_HASH_LATENCY, PASSWORD_HASH_QUEUE_WAIT, PASSWORD_HASH_REJECTED
+
+HASH_POOL_KIND = os.environ.get('HASH_POOL_KIND', 'thread') #"thread" or "process"
+HASH_POOL_WORKERS = int(os.environ.get('HASH_POOL_WORKERS', os.cpu_count() or 1))
+HASH_POOL_MAX_QUEUE = int(os.environ.get('HASH_POOL_MAX_QUEUE', HASH_POOL_WORKERS * 8))
+HASH_RETRY_AFTER_SECONDS = int(os.environ.get('HASH_RETRY_AFTER_SECONDS', 1))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+#these run inside the pool so they have to be module level functions to be picklable for the process pool
+def _timed_hash(input):
+    started = time.monotonic()
+    result = pwd_context.hash(input)
+    return result, started, time.monotonic() - started
+
+def _timed_verify(plain_input, hashed_input):
+    started = time.monotonic()
+    result = pwd_context.verify(plain_input, hashed_input)
+    return result, started, time.monotonic() - started
+
+
+class HashingPoolSaturated(HTTPException):
+    """Raised when the pool already has max_queue jobs in flight"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, try again later",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class HashingMetrics:
+    """Running totals for the hashing pool, read by whatever exports metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+
+    def observe(self, queue_wait, hash_time):
+        PASSWORD_HASH_QUEUE_WAIT.observe(queue_wait)
+        PASSWORD_HASH_LATENCY.observe(hash_time)
+        with self._lock:
+            self.completed += 1
+            self.queue_wait_seconds += queue_wait
+            self.hash_seconds += hash_time
+            self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, queue_wait)
+
+    def reject(self):
+        PASSWORD_HASH_REJECTED.inc()
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "queue_wait_seconds": self.queue_wait_seconds,
+                "hash_seconds": self.hash_seconds,
+                "max_queue_wait_seconds": self.max_queue_wait_seconds,
+            }
+
+
+class HashingService:
+    """Runs bcrypt hash/verify on a bounded thread or process pool so callers never
+    block the event loop. Once max_queue jobs are in flight new jobs are rejected with a 503"""
+
+    def __init__(self, kind: str = "thread", workers: int = 1, max_queue: int = 8, retry_after: int = 1):
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.metrics = HashingMetrics()
+        self._executor: Executor | None = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.kind == "process":
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hashing")
+        return self._executor
+
+    def _acquire(self):
+        with self._lock:
+            if self._in_flight >= self.max_queue:
+                self.metrics.reject()
+                raise HashingPoolSaturated(self.retry_after)
+            self._in_flight += 1
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _submit(self, fn, *args):
+        self._acquire()
+        submitted = time.monotonic()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+
+        def done(f):
+            self._release()
+            if not f.cancelled() and f.exception() is None:
+                _, started, elapsed = f.result()
+                self.metrics.observe(max(started - submitted, 0.0), elapsed)
+
+        future.add_done_callback(done)
+        return future
+
+    async def hash(self, input) -> str:
+        return (await asyncio.wrap_future(self._submit(_timed_hash, input)))[0]
+
+    async def verify(self, plain_input, hashed_input) -> bool:
+        return (await asyncio.wrap_future(self._submit(_timed_verify, plain_input, hashed_input)))[0]
+
+    async def hash_many(self, inputs) -> list:
+        """Hash a batch without competing with interactive requests for the queue limit. At most
+        one job per worker is in flight for the batch and a saturated pool is waited out"""
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def hash_one(input):
+            async with semaphore:
+                while True:
+                    try:
+                        return await self.hash(input)
+                    except HashingPoolSaturated:
+                        await asyncio.sleep(self.retry_after)
+
+        return list(await asyncio.gather(*(hash_one(input) for input in inputs)))
+
+    def hash_blocking(self, input) -> str:
+        """For sync callers that already run in a worker thread"""
+        return self._submit(_timed_hash, input).result()[0]
+
+    def verify_blocking(self, plain_input, hashed_input) -> bool:
+        """For sync callers that already run in a worker thread"""
+        return self._submit(_timed_verify, plain_input, hashed_input).result()[0]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+hashing_service = HashingService(
+    kind=HASH_POOL_KIND,
+    workers=HASH_POOL_WORKERS,
+    max_queue=HASH_POOL_MAX_QUEUE,
+    retry_after=HASH_RETRY_AFTER_SECONDS,
+)
@@ -4,76 +4,96 @@ import secrets
 from typing import Union
 from fastapi import Depends, HTTPException, Header, status
 from typing_extensions import Annotated
-import jwt #should use both pyjwt and jwcrypto or change to all jcrypto?
-import jwcrypto.jwk
-import jwcrypto.jwt
-import jwcrypto.jwe
+import jwt
 import json
+import logging
 import time
-from passlib.context import CryptContext
+import redis
 from fastapi.security import OAuth2PasswordBearer
 from src.schemas.pydantic_schemas import TokenData
 from src.db.models import User
-from src.db.database import get_db, redis_client
-from sqlalchemy.orm import Session
+from src.db.database import get_async_db, get_redis_client
+from src.auth.hashing import hashing_service
+from src.auth.token_cache import CachedUser, invalidate_token, token_cache, token_digest
+from src.auth.revocation import REVOCATION_BUFFER_SECONDS, REVOCATION_FAIL_OPEN, RevocationUnavailable, revocation_list
+from src.auth.tokens import token_service
+from sqlalchemy.ext.asyncio import AsyncSession
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 # to get a string like this run:
 # openssl rand -hex 32
 SECRET_KEY_LOGIN = os.environ.get('SECRET_KEY_LOGIN')
 SECRET_KEY_EMAIL = os.environ.get('SECRET_KEY_EMAIL')
-ALGORITHM = "HS256"
+ALGORITHM = "HS256" #of tokens signed with the secrets above, see src/auth/tokens.py for key sets
+
+logger = logging.getLogger(__name__)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/login")
 
 #helper methods
 def verify_hash(plain_input, hashed_input):
-    """Check user input matches the hashed input"""
+    """Check user input matches the hashed input. Blocks until the hashing pool is done,
+    only call this from sync code that is already off the event loop"""
 
-    return pwd_context.verify(plain_input, hashed_input)
+    return hashing_service.verify_blocking(plain_input, hashed_input)
 
 def get_hash(input):
-    """Convert the input into a hashed string"""
+    """Convert the input into a hashed string. Blocks until the hashing pool is done,
+    only call this from sync code that is already off the event loop"""
+
+    return hashing_service.hash_blocking(input)
+
+async def verify_hash_async(plain_input, hashed_input):
+    """Check user input matches the hashed input without blocking the event loop"""
 
-    return pwd_context.hash(input)
+    return await hashing_service.verify(plain_input, hashed_input)
 
-def authenticate_user(db, name: str, password: str):
+async def get_hash_async(input):
+    """Convert the input into a hashed string without blocking the event loop"""
+
+    return await hashing_service.hash(input)
+
+async def authenticate_user(db, name: str, password: str):
     """Check the user inputted username and password matches the username and its corresponding
     hashed password queried from database"""
 
-    from src.db.crud import get_user_by_username
+    from src.db.async_crud import get_user_by_username
 
-    user = get_user_by_username(db, name) #circular import issue?
+    user = await get_user_by_username(db, name) #circular import issue?
     if not user:
         return False
-    if not verify_hash(password, user.password):
+    if not await verify_hash_async(password, user.password):
         return False
     return user
 
 def create_access_token(data: dict, type: str, expires_delta: Union[timedelta, None] = None):
-    """Create encoded jwt token using pyjwt"""
+    """Create a jwt signed with the current key of the login or email keyring"""
 
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update([("exp", expire)])
-    if type == "login":
-        encoded_jwt = jwt.encode(to_encode, SECRET_KEY_LOGIN, algorithm=ALGORITHM)
-    elif type == "email":
-        encoded_jwt = jwt.encode(to_encode, SECRET_KEY_EMAIL, algorithm=ALGORITHM)
-    return encoded_jwt
-
-async def verify_user_logged_in(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
-    """Authorizes user with valid login token to be allowed to use endpoints
-    this function gets dependency injected into"""
+    to_encode.update([("exp", expire), ("jti", secrets.token_urlsafe(9))])
+    return token_service(type).sign(to_encode)
 
-    from src.db.crud import get_user_by_id
+async def verify_user_logged_in(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)):
+    """Authorizes user with valid login token to be allowed to use endpoints
+    this function gets dependency injected into. Tokens verified before are answered
+    from the local token cache without touching the jwt or the database, and only checked
+    against the in memory revocation filter"""
+
+    from src.db.async_crud import cached_get_user_by_id
+
+    cached = token_cache.get(token)
+    if cached is not None:
+        #the filter is synced from redis at most every sync_seconds, so a revocation whose
+        #invalidation message never arrived still ends the cached entry
+        await revocation_list.maybe_sync()
+        jti = cached[0].get("jti")
+        if jti is None or jti not in revocation_list.filter:
+            return cached[1]
+        token_cache.invalidate_digest(token_digest(token)) #possibly revoked, verify it in full below
 
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -81,11 +101,10 @@ async def verify_user_logged_in(token: Annotated[str, Depends(oauth2_scheme)], d
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-
-        if is_token_blacklisted(token):
+        payload = token_service("login").verify(token)
+        if await is_token_blacklisted(token, payload.get("jti")):
             raise HTTPException(status_code=403, detail="Token is blacklisted")
-        payload = jwt.decode(token, SECRET_KEY_LOGIN, algorithms=[ALGORITHM])
-        print("the payload",payload)
+        logger.debug("Token payload %s", payload)
         id = payload.get("sub")
         if id is None:
             raise credentials_exception
@@ -93,24 +112,27 @@ async def verify_user_logged_in(token: Annotated[str, Depends(oauth2_scheme)], d
         raise HTTPException(status_code=401, detail="Token is expired", headers={"WWW-Authenticate": "Bearer"})
     except jwt.exceptions.InvalidTokenError:
         raise credentials_exception
-    user = get_user_by_id(db, id) #circular import issue
+    user = await cached_get_user_by_id(db, id) #circular import issue
     if user is None:
         raise credentials_exception
+    user = CachedUser(user["id"], user["name"], user["email"])
+    token_cache.put(token, payload, user)
     return user
 
-async def verify_is_admin(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
+async def verify_is_admin(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)):
     """Verify the logged in user has the status of admin to be authorized for certain operations"""
 
     user = await verify_user_logged_in(token, db)
-    print("curr user's role:", user.role.value)
-    if user.role.value != "admin":
+    logger.debug("Current user's role: %s", user.role)
+    #users have no role column yet, so nobody is an admin until they do
+    if user.role is None or user.role.value != "admin":
         raise HTTPException(status_code=403, detail="Admin privilege is required for request")
 
 def verify_id_token(token: str) -> bool:
-    """Decode email jwt and return user id from payload using pyjwt"""
+    """Verify email jwt against the email keyring and return user id from payload"""
     try:
-        payload = jwt.decode(token, SECRET_KEY_EMAIL, algorithms=[ALGORITHM])
-        print("payload", payload)
+        payload = token_service("email").verify(token)
+        logger.debug("Email token payload %s", payload)
         id = payload.get("sub")
         return id
     except jwt.ExpiredSignatureError:
@@ -129,17 +151,34 @@ def generate_random_password() -> str:
             break
     return password
 
-def blacklist_token(token):
-    """Decode the jwt token to obtain expiration time and set the difference between it
-    and the current time to be the expiration time of the corresponding key in the redis database blacklist"""
+async def blacklist_token(token):
+    """Decode the jwt token to obtain its id and expiration time and add it to the revocation list
+    until it expires. Tokens issued before ids were added are blacklisted under the full token"""
 
-    decoded_token = jwt.decode(token, SECRET_KEY_LOGIN, algorithms=[ALGORITHM])
+    decoded_token = token_service("login").verify(token)
     token_expiration = decoded_token["exp"]
-    print("exp", token_expiration)
-    remaining_time = token_expiration - int(time.time()) + 3600 #might want to change buffer time later
-    redis_client.setex(token, remaining_time, "blacklisted")
-
-def is_token_blacklisted(token):
-    """Check if the token can be found in the redis database blacklist"""
-
-    return redis_client.exists(token) == 1
+    logger.debug("Revoking token expiring at %s", token_expiration)
+    jti = decoded_token.get("jti")
+    try:
+        if jti:
+            await revocation_list.revoke(jti, token_expiration)
+        else:
+            remaining_time = token_expiration - int(time.time()) + REVOCATION_BUFFER_SECONDS
+            await get_redis_client().setex(token, remaining_time, "blacklisted")
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Could not revoke token, try again shortly")
+    finally:
+        await invalidate_token(token)
+
+async def is_token_blacklisted(token, jti=None):
+    """Check the token id against the revocation list, which only asks redis when its in memory
+    filter reports a possible match. Tokens without an id are looked up in redis directly"""
+
+    if jti:
+        return await revocation_list.is_revoked(jti)
+    try:
+        return await get_redis_client().exists(token) == 1
+    except redis.RedisError:
+        if REVOCATION_FAIL_OPEN:
+            return False
+        raise RevocationUnavailable()
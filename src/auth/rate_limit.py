@@ -0,0 +1,259 @@
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+import redis
+from fastapi import HTTPException, Request, status
+from src.db.database import get_redis_client
+from src.metrics.prometheus import RATE_LIMIT_REJECTED
+
+#when redis is unreachable each worker still enforces the limits on what it has seen itself.
+#Fail closed refuses everything with a 503 instead
+RATE_LIMIT_FAIL_OPEN = os.environ.get('RATE_LIMIT_FAIL_OPEN', 'true').lower() in ('1', 'true', 'yes')
+RATE_LIMIT_LOCAL_KEYS = int(os.environ.get('RATE_LIMIT_LOCAL_KEYS', 100000)) #clients each worker remembers
+
+RATE_LIMIT_KEY_PREFIX = "ratelimit:"
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+#sliding window counter: the count of the current fixed window plus the previous window's count
+#weighted by how much of it the sliding window still covers. Refused requests are not counted.
+#KEYS are the current and previous window, ARGV the weight, the limit and the key lifetime in ms
+SLIDING_WINDOW_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+if previous * tonumber(ARGV[1]) + current >= tonumber(ARGV[2]) then
+    return {0, current, previous}
+end
+current = redis.call('INCR', KEYS[1])
+if current == 1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+end
+return {1, current, previous}
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Rate:
+    """At most limit requests in any window of window seconds, parsed from 5/minute or 5/60"""
+
+    __slots__ = ("limit", "window")
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+
+    @classmethod
+    def parse(cls, value: str):
+        limit, _, period = value.partition("/")
+        period = period.strip()
+        window = PERIODS.get(period.rstrip("s")) or float(period)
+        return cls(int(limit), window)
+
+
+class RateLimitResult:
+    __slots__ = ("allowed", "limit", "remaining", "reset", "retry_after")
+
+    def __init__(self, allowed: bool, limit: int, remaining: int, reset: int, retry_after: int = 0):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset #seconds until the current window ends
+        self.retry_after = retry_after #seconds until a refused client may try again
+
+    def headers(self) -> dict:
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+def _window(now: float, rate: Rate):
+    """Index of the fixed window now falls in and the seconds already spent in it"""
+    index = int(now // rate.window)
+    return index, now - index * rate.window
+
+def _result(allowed: bool, previous: int, current: int, elapsed: float, rate: Rate) -> RateLimitResult:
+    reset = max(1, math.ceil(rate.window - elapsed))
+    if allowed:
+        estimate = previous * (1 - elapsed / rate.window) + current
+        return RateLimitResult(True, rate.limit, max(0, rate.limit - math.ceil(estimate)), reset)
+    if current < rate.limit:
+        #the previous window's share has to shrink until one more request fits
+        wait = rate.window * (1 - (rate.limit - current) / previous) - elapsed
+    else:
+        #wait for the next window, and for the share of this one carried into it to shrink
+        wait = rate.window - elapsed + rate.window * (1 - rate.limit / current)
+    return RateLimitResult(False, rate.limit, 0, reset, max(1, math.floor(wait) + 1))
+
+
+class LocalWindows:
+    """Sliding window counts of the requests this worker let through, per key, and the keys
+    redis refused until they may retry. Both only ever undercount what redis knows, so a key
+    that is over its limit here is over it everywhere. Least recently used keys are dropped
+    beyond maxsize"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict() #key -> [window index, current, previous, blocked until]
+
+    def _entry(self, key: str, index: int):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [index, 0, 0, 0.0]
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+            if entry[0] != index:
+                entry[2] = entry[1] if entry[0] == index - 1 else 0
+                entry[0], entry[1] = index, 0
+        return entry
+
+    def check(self, key: str, rate: Rate, now: float):
+        """The refusal to give without asking redis, or None when redis has to decide"""
+        index, elapsed = _window(now, rate)
+        entry = self._entry(key, index)
+        _, current, previous, blocked_until = entry
+        if now < blocked_until:
+            result = _result(False, previous, max(current, rate.limit), elapsed, rate)
+            result.retry_after = max(1, math.ceil(blocked_until - now))
+            return result
+        if previous * (1 - elapsed / rate.window) + current >= rate.limit:
+            return _result(False, previous, current, elapsed, rate)
+        return None
+
+    def count(self, key: str, rate: Rate, now: float) -> RateLimitResult:
+        index, elapsed = _window(now, rate)
+        entry = self._entry(key, index)
+        entry[1] += 1
+        return _result(True, entry[2], entry[1], elapsed, rate)
+
+    def block(self, key: str, until: float):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[3] = until
+
+
+class RateLimitUnavailable(HTTPException):
+    """Redis could not count the request and RATE_LIMIT_FAIL_OPEN is off"""
+
+    def __init__(self):
+        super().__init__(status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+
+
+class RateLimiter:
+    """Sliding window limits shared by all workers through redis, counted atomically by a lua
+    script in one round trip. Each worker refuses from memory first (see LocalWindows), so a
+    client that keeps hammering past its limit costs neither redis nor the database nor bcrypt"""
+
+    def __init__(self, redis=None, local_keys: int = 100000, fail_open: bool = True):
+        self._redis = redis
+        self._script = None
+        self.fail_open = fail_open
+        self.local = LocalWindows(local_keys)
+        self.local_rejections = 0
+        self.redis_rejections = 0
+        self.redis_errors = 0
+
+    @property
+    def redis(self):
+        """The client given to the constructor, or the app's shared one"""
+        return self._redis or get_redis_client()
+
+    def _sliding_window(self):
+        client = self.redis
+        if self._script is None or self._script.registered_client is not client:
+            self._script = client.register_script(SLIDING_WINDOW_SCRIPT)
+        return self._script
+
+    async def hit(self, key: str, rate: Rate, now: float = None) -> RateLimitResult:
+        """Count a request for key, unless key is already over rate"""
+        now = now or time.time()
+        refused = self.local.check(key, rate, now)
+        if refused is not None:
+            self.local_rejections += 1
+            return refused
+
+        index, elapsed = _window(now, rate)
+        prefix = f"{RATE_LIMIT_KEY_PREFIX}{{{key}}}:" #hash tag keeps both windows on one cluster slot
+        try:
+            allowed, current, previous = await self._sliding_window()(
+                keys=[f"{prefix}{index}", f"{prefix}{index - 1}"],
+                args=[1 - elapsed / rate.window, rate.limit, int(rate.window * 2000)],
+            )
+        except redis.RedisError:
+            self.redis_errors += 1
+            logger.warning("Rate limit check failed for %s", key, exc_info=True)
+            if not self.fail_open:
+                raise RateLimitUnavailable()
+            return self.local.count(key, rate, now)
+
+        result = _result(bool(allowed), int(previous), int(current), elapsed, rate)
+        if result.allowed:
+            self.local.count(key, rate, now)
+        else:
+            self.redis_rejections += 1
+            self.local.block(key, now + result.retry_after)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "local_keys": len(self.local._entries),
+            "local_rejections": self.local_rejections,
+            "redis_rejections": self.redis_rejections,
+            "redis_errors": self.redis_errors,
+        }
+
+
+rate_limiter = RateLimiter(None, local_keys=RATE_LIMIT_LOCAL_KEYS, fail_open=RATE_LIMIT_FAIL_OPEN)
+
+
+def _configured_rate(scope: str, dimension: str, default: str):
+    """RATE_LIMIT_<SCOPE>_PER_<DIMENSION> overrides the route's default, "off" turns it off"""
+    value = os.environ.get(f"RATE_LIMIT_{scope}_PER_{dimension}".upper(), default or "off")
+    return None if value == "off" else Rate.parse(value)
+
+def client_ip(request: Request) -> str:
+    #behind a proxy set FORWARDED_ALLOW_IPS to its address, uvicorn then puts the client's own here
+    return request.client.host if request.client else "unknown"
+
+def rate_limit(scope: str, per_ip: str = None, per_username: str = None):
+    """Dependency that answers 429 once the caller's IP, or the username in the submitted form,
+    is over its limit for this route. It runs before the endpoint, so a refused request does no
+    database or password work. Allowed requests leave the RateLimit-* headers of the tightest
+    limit in request.state for the middleware in main.py, which adds them to the response
+    whatever the endpoint returns or raises"""
+    ip_rate = _configured_rate(scope, "ip", per_ip)
+    username_rate = _configured_rate(scope, "username", per_username)
+
+    async def check_rate_limit(request: Request):
+        checks = []
+        if ip_rate:
+            checks.append(("ip", client_ip(request), ip_rate))
+        if username_rate:
+            username = (await request.form()).get("username")
+            if isinstance(username, str) and username:
+                checks.append(("username", username.strip().lower()[:64], username_rate))
+
+        tightest = None
+        for dimension, value, rate in checks:
+            result = await rate_limiter.hit(f"{scope}:{dimension}:{value}", rate)
+            if not result.allowed:
+                RATE_LIMIT_REJECTED.labels(scope, dimension).inc()
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many requests, try again later",
+                    headers=result.headers(),
+                )
+            if tightest is None or result.remaining < tightest.remaining:
+                tightest = result
+        if tightest is not None:
+            request.state.rate_limit_headers = tightest.headers()
+
+    return check_rate_limit
@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import math
+import os
+import time
+import redis
+from fastapi import HTTPException
+from src.db.database import get_redis_client
+
+REVOCATION_FILTER_CAPACITY = int(os.environ.get('REVOCATION_FILTER_CAPACITY', 100000))
+REVOCATION_FILTER_ERROR_RATE = float(os.environ.get('REVOCATION_FILTER_ERROR_RATE', 0.001))
+REVOCATION_SYNC_SECONDS = float(os.environ.get('REVOCATION_SYNC_SECONDS', 1))
+REVOCATION_REBUILD_SECONDS = float(os.environ.get('REVOCATION_REBUILD_SECONDS', 600))
+REVOCATION_BUFFER_SECONDS = 3600 #might want to change buffer time later
+#how long a revocation stays in the log, has to cover the longest lived token (email links, 12 hours)
+REVOCATION_RETENTION_SECONDS = int(os.environ.get('REVOCATION_RETENTION_SECONDS', 13 * 3600))
+#what a possibly revoked token gets when redis cannot confirm it: refused with a 503 by default,
+#accepted when fail open. Tokens the filter has never seen are accepted either way
+REVOCATION_FAIL_OPEN = os.environ.get('REVOCATION_FAIL_OPEN', 'false').lower() in ('1', 'true', 'yes')
+SYNC_OVERLAP_SECONDS = 5 #re-read a little of the log each sync to allow for clock skew between workers
+
+REVOKED_KEY_PREFIX = "revoked:"
+REVOCATION_LOG_KEY = "revoked:log" #sorted set of jti scored by the time they were revoked
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Fixed size bloom filter over strings. No false negatives, false positives at
+    roughly error_rate once capacity items have been added"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationUnavailable(HTTPException):
+    """Redis could not say whether a token was revoked and REVOCATION_FAIL_OPEN is off"""
+
+    def __init__(self):
+        super().__init__(status_code=503, detail="Token revocation status is unavailable, try again shortly")
+
+
+class RevocationList:
+    """Revoked token ids, with a bloom filter per worker so the common case of a token that
+    was never revoked is answered from memory. Redis is only asked when the filter
+    reports a possible match. The filter is topped up from the revocation log every
+    sync_seconds and rebuilt every rebuild_seconds to shed expired ids. When redis is
+    unreachable the filter keeps serving the last synced state and possible matches are
+    accepted or refused according to fail_open"""
+
+    def __init__(self, redis, capacity: int, error_rate: float, sync_seconds: float, rebuild_seconds: float, fail_open: bool = False):
+        self._redis = redis
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.fail_open = fail_open
+        self.filter = BloomFilter(capacity, error_rate)
+        self.filter_hits = 0 #checks that had to go to redis
+        self.confirmed = 0 #of those, the ones that really were revoked
+        self.redis_errors = 0
+        self._synced_until = 0.0 #revocation log score already pulled into the filter
+        self._last_sync = 0.0
+        self._last_rebuild = 0.0
+
+    @property
+    def redis(self):
+        """The client given to the constructor, or the app's shared one"""
+        return self._redis or get_redis_client()
+
+    async def revoke(self, jti: str, expires_at: int):
+        """Store a revoked token id until the token itself has expired. The id goes into this
+        worker's filter first so it is refused here even if redis is down"""
+        self.filter.add(jti)
+        expires_at = expires_at + REVOCATION_BUFFER_SECONDS
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.setex(REVOKED_KEY_PREFIX + jti, max(1, expires_at - int(time.time())), "1")
+            pipe.zadd(REVOCATION_LOG_KEY, {jti: time.time()})
+            await pipe.execute()
+
+    async def is_revoked(self, jti: str) -> bool:
+        return jti in await self.revoked_among([jti])
+
+    async def revoked_among(self, jtis) -> set:
+        """The subset of jtis that are revoked. Whatever passes the filter is confirmed in a
+        single pipelined round trip, however many ids there are"""
+        await self.maybe_sync()
+        candidates = [jti for jti in jtis if jti in self.filter]
+        if not candidates:
+            return set()
+        self.filter_hits += len(candidates)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for jti in candidates:
+                    pipe.exists(REVOKED_KEY_PREFIX + jti)
+                results = await pipe.execute()
+        except redis.RedisError:
+            self.redis_errors += 1
+            logger.warning("Could not confirm %d possibly revoked tokens", len(candidates), exc_info=True)
+            if self.fail_open:
+                return set()
+            raise RevocationUnavailable()
+        revoked = {jti for jti, exists in zip(candidates, results) if exists}
+        self.confirmed += len(revoked)
+        return revoked
+
+    def mark_stale(self):
+        """Force a sync on the next check, used when another worker announces a revocation"""
+        self._last_sync = 0.0
+
+    async def maybe_sync(self):
+        now = time.time()
+        if now - self._last_sync < self.sync_seconds:
+            return
+        self._last_sync = now
+        try:
+            if now - self._last_rebuild >= self.rebuild_seconds:
+                await self.rebuild(now)
+            else:
+                await self.sync()
+        except redis.RedisError:
+            #keep checking against what was synced so far, retried after sync_seconds
+            self.redis_errors += 1
+            logger.warning("Revocation list sync failed", exc_info=True)
+
+    async def sync(self):
+        """Pull the ids revoked since the last sync into the filter"""
+        since = max(0.0, self._synced_until - SYNC_OVERLAP_SECONDS)
+        entries = await self.redis.zrangebyscore(REVOCATION_LOG_KEY, since, "+inf", withscores=True)
+        for jti, score in entries:
+            self.filter.add(jti)
+            self._synced_until = max(self._synced_until, score)
+
+    async def rebuild(self, now: float = None):
+        """Replace the filter with one built from the revocations still inside the retention window"""
+        now = now or time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(REVOCATION_LOG_KEY, "-inf", now - REVOCATION_RETENTION_SECONDS)
+            pipe.zrange(REVOCATION_LOG_KEY, 0, -1, withscores=True)
+            _, entries = await pipe.execute()
+        capacity = max(self.capacity, len(entries) * 2)
+        bloom = BloomFilter(capacity, self.error_rate)
+        synced_until = 0.0
+        for jti, score in entries:
+            bloom.add(jti)
+            synced_until = max(synced_until, score)
+        self.filter = bloom
+        self._synced_until = synced_until
+        self._last_rebuild = now
+
+    def stats(self) -> dict:
+        return {
+            "filter_items": self.filter.count,
+            "filter_hits": self.filter_hits,
+            "confirmed": self.confirmed,
+            "redis_errors": self.redis_errors,
+        }
+
+
+revocation_list = RevocationList(
+    None,
+    capacity=REVOCATION_FILTER_CAPACITY,
+    error_rate=REVOCATION_FILTER_ERROR_RATE,
+    sync_seconds=REVOCATION_SYNC_SECONDS,
+    rebuild_seconds=REVOCATION_REBUILD_SECONDS,
+    fail_open=REVOCATION_FAIL_OPEN,
+)
@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import redis
+from src.db.database import get_redis_client
+from src.auth.revocation import revocation_list
+
+TOKEN_CACHE_MAXSIZE = int(os.environ.get('TOKEN_CACHE_MAXSIZE', 10000))
+TOKEN_CACHE_TTL_SECONDS = int(os.environ.get('TOKEN_CACHE_TTL_SECONDS', 60))
+INVALIDATION_CHANNEL = "token-cache:invalidate"
+LISTENER_POLL_SECONDS = 1
+LISTENER_RETRY_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def token_digest(token: str) -> str:
+    """Cache key for a token so raw tokens are never kept around or published"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class CachedUser:
+    """Slim copy of the fields of a User the auth dependencies need"""
+
+    __slots__ = ("id", "name", "email", "role")
+
+    def __init__(self, id, name, email, role=None):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.role = role
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.name, user.email, getattr(user, "role", None))
+
+
+class TokenCache:
+    """Per process LRU of verified tokens. An entry never outlives the token's exp claim"""
+
+    def __init__(self, maxsize: int = 10000, ttl: int = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict() #digest -> (expires_at, claims, user)
+        self._by_user = {} #user id -> set of digests
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        """Return (claims, user) for a token verified earlier, or None"""
+        digest = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, claims, user = entry
+            if expires_at <= time.time():
+                self._remove(digest)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return claims, user
+
+    def put(self, token: str, claims: dict, user: CachedUser):
+        expires_at = time.time() + self.ttl
+        if "exp" in claims:
+            expires_at = min(expires_at, claims["exp"])
+        digest = token_digest(token)
+        with self._lock:
+            self._remove(digest)
+            self._entries[digest] = (expires_at, claims, user)
+            self._by_user.setdefault(user.id, set()).add(digest)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_digest(self, digest: str):
+        with self._lock:
+            if self._remove(digest):
+                self.invalidations += 1
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for digest in list(self._by_user.get(user_id, ())):
+                self._remove(digest)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, digest) -> bool:
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return False
+        user_digests = self._by_user.get(entry[2].id)
+        if user_digests is not None:
+            user_digests.discard(digest)
+            if not user_digests:
+                del self._by_user[entry[2].id]
+        return True
+
+
+token_cache = TokenCache(maxsize=TOKEN_CACHE_MAXSIZE, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+
+async def _publish(*messages: str):
+    try:
+        async with get_redis_client().pipeline(transaction=False) as pipe:
+            for message in messages:
+                pipe.publish(INVALIDATION_CHANNEL, message)
+            await pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not publish %d token cache invalidations", len(messages), exc_info=True)
+
+async def invalidate_token(token: str):
+    """Drop a token from this worker's cache and tell the other workers to do the same"""
+    digest = token_digest(token)
+    token_cache.invalidate_digest(digest)
+    await _publish(f"token:{digest}")
+
+async def invalidate_user_tokens(*user_ids: int):
+    """Drop every cached token of these users in all workers, used when a user changes"""
+    for user_id in user_ids:
+        token_cache.invalidate_user(user_id)
+    await _publish(*(f"user:{user_id}" for user_id in user_ids))
+
+def _handle_invalidation(message):
+    kind, _, value = str(message["data"]).partition(":")
+    if kind == "token":
+        token_cache.invalidate_digest(value)
+        #a token was revoked elsewhere, pick it up before this worker verifies it again
+        revocation_list.mark_stale()
+    elif kind == "user":
+        token_cache.invalidate_user(int(value))
+
+async def _listen():
+    while True:
+        pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            while True:
+                message = await pubsub.get_message(timeout=LISTENER_POLL_SECONDS)
+                if message is not None:
+                    _handle_invalidation(message)
+        except redis.RedisError:
+            #until it reconnects other workers' changes are only picked up when entries expire
+            logger.warning("Token cache invalidation listener lost redis, retrying", exc_info=True)
+            await asyncio.sleep(LISTENER_RETRY_SECONDS)
+        finally:
+            await pubsub.aclose()
+
+def start_invalidation_listener() -> asyncio.Task:
+    """Subscribe to invalidations published by other workers in a background task,
+    cancel the task to stop it"""
+    return asyncio.create_task(_listen(), name="token-cache-invalidation")
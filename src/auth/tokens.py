@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime
+import jwt
+import orjson
+from jwt.algorithms import ECAlgorithm, HMACAlgorithm, OKPAlgorithm
+
+#signing and verifying of the login and email link tokens. Each kind of token has a keyring, a
+#JSON Web Key Set whose keys are told apart by the kid in the token header. The first key of the
+#set that has its private part signs, the others only verify, so a key can be rotated without
+#logging anyone out:
+#   1. add the new key to the end of the set everywhere and restart the workers
+#   2. move it to the front, new tokens are signed with it and old ones still verify
+#   3. drop the old key once the last token it signed has expired
+#With EdDSA or ES256 keys the nodes that only verify tokens get the public keys alone
+#(`python -m src.auth.tokens public keys.json`), they never hold what could sign one.
+#Without a key set the secret from SECRET_KEY_LOGIN / SECRET_KEY_EMAIL signs HS256 tokens
+#without a kid as before, and it keeps verifying such tokens after a key set is configured
+TOKEN_KEYS_LOGIN = os.environ.get('TOKEN_KEYS_LOGIN') #path to the login tokens' JWKS file
+TOKEN_KEYS_EMAIL = os.environ.get('TOKEN_KEYS_EMAIL')
+TOKEN_HEADER_CACHE_SIZE = int(os.environ.get('TOKEN_HEADER_CACHE_SIZE', 256))
+#below this many tokens verify_many_async verifies on the event loop, a thread costs more
+TOKEN_BATCH_THREAD_MIN = int(os.environ.get('TOKEN_BATCH_THREAD_MIN', 64))
+
+ALGORITHMS = {"HS256": HMACAlgorithm(HMACAlgorithm.SHA256), "ES256": ECAlgorithm(ECAlgorithm.SHA256),
+              "EdDSA": OKPAlgorithm()}
+TIME_CLAIMS = ("exp", "nbf", "iat")
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class TokenKey:
+    """One key of a keyring with its cryptography objects built once. signing_key is None for
+    keys that only verify"""
+
+    __slots__ = ("kid", "algorithm_name", "algorithm", "signing_key", "verifying_key", "header")
+
+    def __init__(self, kid, algorithm_name: str, signing_key, verifying_key):
+        if algorithm_name not in ALGORITHMS:
+            raise ValueError(f"Unsupported token algorithm {algorithm_name}, use one of {', '.join(ALGORITHMS)}")
+        self.kid = kid
+        self.algorithm_name = algorithm_name
+        self.algorithm = ALGORITHMS[algorithm_name]
+        self.signing_key = signing_key
+        self.verifying_key = verifying_key
+        header = {"alg": algorithm_name, "typ": "JWT"}
+        if kid is not None:
+            header["kid"] = kid
+        self.header = _b64encode(json.dumps(header, separators=(",", ":"), sort_keys=True).encode())
+
+    @classmethod
+    def from_jwk(cls, jwk: dict):
+        parsed = jwt.PyJWK(jwk)
+        if parsed.key_id is None:
+            raise ValueError("Every key of a token key set needs a kid")
+        key = parsed.key
+        if isinstance(key, bytes):
+            return cls(parsed.key_id, parsed.algorithm_name, key, key)
+        if hasattr(key, "sign"): #private key, verifies with its public half
+            return cls(parsed.key_id, parsed.algorithm_name, key, key.public_key())
+        return cls(parsed.key_id, parsed.algorithm_name, None, key)
+
+    @classmethod
+    def from_secret(cls, secret: str):
+        """The HS256 key of tokens from before key sets, which have no kid"""
+        return cls(None, "HS256", secret.encode(), secret.encode())
+
+
+class Keyring:
+    def __init__(self, keys: list[TokenKey]):
+        self.keys = {key.kid: key for key in keys}
+        self.signing = next((key for key in keys if key.signing_key is not None), None)
+
+    @classmethod
+    def load(cls, jwks_file: str = None, secret: str = None):
+        """The keys of the JWKS file, then the legacy secret"""
+        keys = []
+        if jwks_file:
+            with open(jwks_file) as fp:
+                keys += [TokenKey.from_jwk(jwk) for jwk in json.load(fp)["keys"]]
+        if secret:
+            keys.append(TokenKey.from_secret(secret))
+        return cls(keys)
+
+    def key_for(self, header_segment: str) -> TokenKey:
+        """The key a token header names, its alg has to be the key's own"""
+        try:
+            header = orjson.loads(_b64decode(header_segment))
+        except (ValueError, TypeError):
+            raise jwt.DecodeError("Invalid header")
+        if not isinstance(header, dict):
+            raise jwt.DecodeError("Invalid header")
+        key = self.keys.get(header.get("kid"))
+        if key is None:
+            raise jwt.InvalidTokenError("Unknown kid")
+        if header.get("alg") != key.algorithm_name:
+            raise jwt.InvalidAlgorithmError("The specified alg value is not allowed")
+        return key
+
+
+class TokenService:
+    """Signs and verifies the JWTs of one keyring. Tokens of the same key share their header, so
+    verifying goes from the header straight to the key through a dict of the headers of tokens
+    that verified before. Claims are checked like jwt.decode does for exp and nbf, failures raise
+    the same jwt exceptions"""
+
+    def __init__(self, keyring: Keyring, header_cache_size: int = 256):
+        self.keyring = keyring
+        self.header_cache_size = header_cache_size
+        self._headers = {}
+
+    def sign(self, claims: dict) -> str:
+        """A token for claims, datetimes in exp, nbf and iat become timestamps"""
+        key = self.keyring.signing
+        if key is None:
+            raise RuntimeError("No token signing key, this node only has keys that verify")
+        claims = {name: int(value.timestamp()) if name in TIME_CLAIMS and isinstance(value, datetime) else value
+                  for name, value in claims.items()}
+        signing_input = key.header + b"." + _b64encode(orjson.dumps(claims))
+        return (signing_input + b"." + _b64encode(key.algorithm.sign(signing_input, key.signing_key))).decode()
+
+    def verify(self, token: str) -> dict:
+        """The claims of a token signed by a key of the keyring that has not expired"""
+        signing_input, _, signature = token.rpartition(".")
+        header_segment, _, payload_segment = signing_input.partition(".")
+        if not payload_segment or "." in payload_segment:
+            raise jwt.DecodeError("Not enough segments")
+        key = self._headers.get(header_segment)
+        known = key is not None
+        if not known:
+            key = self.keyring.key_for(header_segment)
+        try:
+            valid = key.algorithm.verify(signing_input.encode(), key.verifying_key, _b64decode(signature))
+            claims = orjson.loads(_b64decode(payload_segment))
+        except (ValueError, TypeError):
+            raise jwt.DecodeError("Invalid token padding or encoding")
+        if not valid:
+            raise jwt.InvalidSignatureError("Signature verification failed")
+        #only headers that came with a valid signature, whoever can fill this holds a key
+        if not known and len(self._headers) < self.header_cache_size:
+            self._headers[header_segment] = key
+        if not isinstance(claims, dict):
+            raise jwt.DecodeError("Invalid payload")
+        now = time.time()
+        exp, nbf = claims.get("exp"), claims.get("nbf")
+        if exp is not None:
+            if not isinstance(exp, (int, float)):
+                raise jwt.DecodeError("Expiration Time claim (exp) must be an integer.")
+            if exp <= now:
+                raise jwt.ExpiredSignatureError("Signature has expired")
+        if nbf is not None:
+            if not isinstance(nbf, (int, float)):
+                raise jwt.DecodeError("Not Before claim (nbf) must be an integer.")
+            if nbf > now:
+                raise jwt.ImmatureSignatureError("The token is not yet valid (nbf)")
+        return claims
+
+    def verify_many(self, tokens) -> list:
+        """verify for each token, the claims or the jwt.InvalidTokenError it failed with, in order"""
+        results = []
+        for token in tokens:
+            try:
+                results.append(self.verify(token))
+            except jwt.InvalidTokenError as error:
+                results.append(error)
+        return results
+
+    async def verify_many_async(self, tokens: list) -> list:
+        """verify_many without holding up the event loop, in a thread for large batches"""
+        if len(tokens) < TOKEN_BATCH_THREAD_MIN:
+            return self.verify_many(tokens)
+        return await asyncio.to_thread(self.verify_many, tokens)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+def token_service(purpose: str) -> TokenService:
+    """The TokenService for "login" or "email" tokens, its keys are read on first use"""
+    service = _services.get(purpose)
+    if service is None:
+        from src.auth.helpers import SECRET_KEY_EMAIL, SECRET_KEY_LOGIN #helpers uses this module
+        jwks_file, secret = {"login": (TOKEN_KEYS_LOGIN, SECRET_KEY_LOGIN),
+                             "email": (TOKEN_KEYS_EMAIL, SECRET_KEY_EMAIL)}[purpose]
+        with _services_lock:
+            service = _services.get(purpose)
+            if service is None:
+                service = _services[purpose] = TokenService(Keyring.load(jwks_file, secret), TOKEN_HEADER_CACHE_SIZE)
+    return service
+
+
+def new_key(algorithm_name: str, kid: str) -> dict:
+    """A private JWK for a new key"""
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+    if algorithm_name == "EdDSA":
+        jwk = OKPAlgorithm.to_jwk(ed25519.Ed25519PrivateKey.generate(), as_dict=True)
+    elif algorithm_name == "ES256":
+        jwk = ECAlgorithm.to_jwk(ec.generate_private_key(ec.SECP256R1()), as_dict=True)
+    else:
+        jwk = HMACAlgorithm.to_jwk(os.urandom(32), as_dict=True)
+    return {**jwk, "kid": kid, "alg": algorithm_name}
+
+def public_keys(jwks: dict) -> dict:
+    """The key set without private parts or the keys that are all private (HS256)"""
+    private = {"d", "p", "q", "dp", "dq", "qi", "k"}
+    return {"keys": [{name: value for name, value in jwk.items() if name not in private}
+                     for jwk in jwks["keys"] if jwk.get("kty") != "oct"]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Make token keys")
+    commands = parser.add_subparsers(dest="command", required=True)
+    new = commands.add_parser("new-key", help="print a new private JWK to add to a key set")
+    new.add_argument("algorithm", choices=ALGORITHMS)
+    new.add_argument("--kid", default=time.strftime("%Y%m%d", time.gmtime()))
+    public = commands.add_parser("public", help="print the key set without its private keys, for nodes that only verify")
+    public.add_argument("jwks_file")
+    args = parser.parse_args()
+    if args.command == "new-key":
+        print(json.dumps(new_key(args.algorithm, args.kid), indent=2))
+    else:
+        with open(args.jwks_file) as fp:
+            print(json.dumps(public_keys(json.load(fp)), indent=2))
@@ -1,15 +1,35 @@
+import asyncio
+import logging
+import os
+import tempfile
+import threading
 import yaml
+from pydantic import ValidationError
+from src.schemas.pydantic_schemas import EmailConfig
+
+EMAIL_CONFIG_FILE = "email.yaml"
+CONFIG_POLL_SECONDS = float(os.environ.get('CONFIG_POLL_SECONDS', 2))
+CONFIG_RELOAD_CHANNEL = "config:reload"
+CONFIG_VERSION_KEY_PREFIX = "config:version:"
+
+logger = logging.getLogger(__name__)
 
 
 def save_yaml_config(filename, options):
-    """Save options into a yaml file"""
-    result = {}
+    """Save options into a yaml file. Written to a temp file and renamed over the old one so
+    readers never see a half written file"""
+    result = yaml.safe_dump(options)
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".yaml")
     try:
-        with open(filename, 'w') as fp:
-            result = yaml.safe_dump(options)
+        with os.fdopen(fd, 'w') as fp:
             fp.write(result)
-    except Exception as exc:
-        print(exc)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, filename)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
     return result
 
 def load_yaml_config(filename):
@@ -18,15 +38,129 @@ def load_yaml_config(filename):
     try:
         with open(filename, 'r') as fp:
             result = yaml.safe_load(fp.read())
-    except Exception as exc:
-        print(exc)
+    except FileNotFoundError:
+        pass
+    except (OSError, yaml.YAMLError):
+        logger.exception("Could not read config file %s", filename)
 
     return result or {}
 
-def save_email_config(options):
+
+class ConfigStore:
+    """Parses a yaml config file once into an immutable model and keeps serving that snapshot
+    from memory. A background thread reloads it when the file's mtime changes and a task on the
+    event loop when another worker announces a new version through redis. An invalid file keeps
+    the last good snapshot"""
+
+    def __init__(self, filename: str, model):
+        self.filename = filename
+        self.model = model
+        self._snapshot = None
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._listener = None
+        self._loaded = False
+
+    def get(self):
+        """Current snapshot, or None if the file is missing or was never valid. The file is
+        first read here rather than on import"""
+        if not self._loaded:
+            self.reload()
+        return self._snapshot
+
+    def _current_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        with self._lock:
+            self._loaded = True
+            self._mtime = self._current_mtime()
+            data = load_yaml_config(self.filename)
+            if not data:
+                self._snapshot = None
+                return
+            try:
+                self._snapshot = self.model.model_validate(data)
+            except ValidationError:
+                logger.exception("Invalid config in %s, keeping the previous one", self.filename)
+
+    def reload_if_changed(self):
+        if self._current_mtime() != self._mtime:
+            self.reload()
+
+    async def save(self, config):
+        """Validate and atomically write a new config, then tell every worker to reload it"""
+        config = self.model.model_validate(config)
+        await asyncio.to_thread(self._write, config)
+        await self._announce()
+        return config
+
+    def _write(self, config):
+        #the write, fsync and rename block, so this runs in a thread
+        save_yaml_config(self.filename, config.model_dump())
+        self.reload()
+
+    async def _announce(self):
+        from src.db.database import get_redis_client
+        import redis
+        try:
+            version = await get_redis_client().incr(CONFIG_VERSION_KEY_PREFIX + self.filename)
+            await get_redis_client().publish(CONFIG_RELOAD_CHANNEL, f"{self.filename}:{version}")
+        except redis.RedisError:
+            logger.warning("Could not announce config change, other workers will see it on their next poll")
+
+    def _poll(self):
+        while not self._stop.wait(CONFIG_POLL_SECONDS):
+            self.reload_if_changed()
+
+    async def _listen(self):
+        from src.db.database import get_redis_client
+        import redis
+        while True:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(CONFIG_RELOAD_CHANNEL)
+                while True:
+                    message = await pubsub.get_message(timeout=1)
+                    if message and str(message["data"]).startswith(self.filename + ":"):
+                        self.reload()
+            except redis.RedisError:
+                await asyncio.sleep(CONFIG_POLL_SECONDS)
+            finally:
+                await pubsub.aclose()
+
+    def start_watching(self):
+        """Start the mtime poller in a daemon thread and the redis listener as a task, so
+        this has to be called from the running event loop"""
+        if self._threads:
+            return
+        self.reload()
+        self._stop.clear()
+        thread = threading.Thread(target=self._poll, name=f"config-watch-{self.filename}", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        self._listener = asyncio.create_task(self._listen(), name=f"config-listen-{self.filename}")
+
+    def stop_watching(self):
+        self._stop.set()
+        self._threads = []
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+
+email_config_store = ConfigStore(EMAIL_CONFIG_FILE, EmailConfig)
+
+async def save_email_config(options):
     """Save options into email.yaml"""
-    return save_yaml_config("email.yaml", options)
+    return await email_config_store.save(options)
 
 def load_email_config():
-    """Load email.yaml"""
-    return load_yaml_config("email.yaml")
+    """The current email config as an immutable EmailConfig, or None if it is not set up.
+    Served from memory, the file is only read again when it changes"""
+    return email_config_store.get()
@@ -0,0 +1,442 @@
+from collections import defaultdict
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import bindparam, delete, insert, or_, select, update
+from sqlalchemy.orm import selectinload
+from ..schemas.pydantic_schemas import RecipeCreate, RecipeInfo, RecipeUpdate, StepCreate, UserCreation
+
+from . import models
+from .cache import cache
+from .http_cache import PreconditionFailed, row_etag, versions
+from src.auth.token_cache import invalidate_user_tokens
+from src.auth.helpers import get_hash_async, generate_random_password
+from src.auth.hashing import hashing_service
+from src.search.recipe_search import remove_recipes, reindex_recipes
+
+#async versions of the functions in crud.py, the session is either an AsyncSession
+#or a SyncSessionAdapter depending on DB_ASYNC
+
+BULK_READ_BATCH_SIZE = 500 #ids per IN list, under sqlite's variable limit
+
+async def create_user(db: AsyncSession, user: UserCreation):
+    password = generate_random_password()
+    hashed_password = await get_hash_async(password)
+    db_user = models.User(name=user.name, email=user.email,
+                          password=hashed_password)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    await _invalidate_user(db_user.id, (user.name, user.email))
+    return db_user
+
+async def get_user_by_id(db: AsyncSession, user_id: int):
+    stmt = select(models.User).where(models.User.id == user_id)
+    return (await db.execute(stmt)).scalar_one_or_none()
+
+async def get_user_by_username(db: AsyncSession, name: str):
+    stmt = select(models.User).where(models.User.name == name)
+    return (await db.execute(stmt)).scalar_one_or_none()
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    stmt = select(models.User).where(models.User.email == email)
+    return (await db.execute(stmt)).scalar_one_or_none()
+
+#cached reads return plain dicts (never the password hash) instead of ORM objects, use the
+#uncached functions above when the row is going to be changed
+
+def _user_snapshot(user):
+    if user is None:
+        return None
+    return {"id": user.id, "name": user.name, "email": user.email, "version": user.version}
+
+async def _invalidate_user(user_id, *names_and_emails):
+    keys = [f"user:id:{user_id}"]
+    for name, email in names_and_emails:
+        keys += [f"user:name:{name}", f"user:email:{email}"]
+    await cache.invalidate(*keys)
+
+async def cached_get_user_by_id(db: AsyncSession, user_id: int):
+    async def load():
+        return _user_snapshot(await get_user_by_id(db, user_id))
+    return await cache.get_or_load(f"user:id:{user_id}", load)
+
+async def cached_get_user_by_username(db: AsyncSession, name: str):
+    async def load():
+        return _user_snapshot(await get_user_by_username(db, name))
+    return await cache.get_or_load(f"user:name:{name}", load)
+
+async def cached_get_user_by_email(db: AsyncSession, email: str):
+    async def load():
+        return _user_snapshot(await get_user_by_email(db, email))
+    return await cache.get_or_load(f"user:email:{email}", load)
+
+async def get_existing_names_and_emails(db: AsyncSession, names, emails):
+    """Which of the names and emails are already taken, in a single query"""
+    stmt = select(models.User.name, models.User.email).where(
+        or_(models.User.name.in_(names), models.User.email.in_(emails))
+    )
+    rows = (await db.execute(stmt)).all()
+    return {row.name for row in rows}, {row.email for row in rows}
+
+async def create_users_bulk(db: AsyncSession, users: list[UserCreation]):
+    """Insert every user whose name and email are free as one executemany and commit once.
+    Returns "created" or "duplicate" for each user, in order"""
+    if not users:
+        return []
+    existing_names, existing_emails = await get_existing_names_and_emails(
+        db, [user.name for user in users], [user.email for user in users]
+    )
+    new_users = [user for user in users if user.name not in existing_names and user.email not in existing_emails]
+    hashed_passwords = await hashing_service.hash_many(generate_random_password() for _ in new_users)
+    if new_users:
+        rows = [{"name": user.name, "email": user.email, "password": hashed_password}
+                for user, hashed_password in zip(new_users, hashed_passwords)]
+        if db.get_bind().dialect.insert_executemany_returning:
+            user_ids = (await db.execute(insert(models.User).returning(models.User.id), rows)).scalars().all()
+        else:
+            #mysql has no RETURNING, the ids are read back by email in the same transaction
+            await db.execute(insert(models.User), rows)
+            emails = [user.email for user in new_users]
+            user_ids = []
+            for start in range(0, len(emails), BULK_READ_BATCH_SIZE):
+                stmt = select(models.User.id).where(models.User.email.in_(emails[start:start + BULK_READ_BATCH_SIZE]))
+                user_ids += (await db.execute(stmt)).scalars().all()
+        await db.commit()
+        #ids looked up before the import may be cached as missing, like the names and emails
+        await cache.invalidate(*(f"user:id:{user_id}" for user_id in user_ids),
+                               *(f"user:name:{user.name}" for user in new_users),
+                               *(f"user:email:{user.email}" for user in new_users))
+    created = {id(user) for user in new_users}
+    return ["created" if id(user) in created else "duplicate" for user in users]
+
+async def get_users_page(db: AsyncSession, after_id: int = 0, limit: int = 100, name: str = None, email: str = None, with_version: bool = False):
+    """Rows of id, name and email (never the password) for the users after after_id in id order.
+    Goes through Core so no ORM objects or identity map are built. The name and email
+    filters are exact matches so they can use the indexes on those columns"""
+    columns = [models.User.id, models.User.name, models.User.email]
+    if with_version:
+        columns.append(models.User.version)
+    stmt = (select(*columns)
+            .where(models.User.id > after_id)
+            .order_by(models.User.id)
+            .limit(limit))
+    if name is not None:
+        stmt = stmt.where(models.User.name == name)
+    if email is not None:
+        stmt = stmt.where(models.User.email == email)
+    return (await db.execute(stmt)).all()
+
+async def get_invite_recipients(db: AsyncSession, user_ids: list[int] = None, status: str = None, after_id: int = 0, limit: int = 1000):
+    """Rows of id, name and email for the first limit users after after_id in id order that are
+    in user_ids and/or have the status, in one query"""
+    stmt = (select(models.User.id, models.User.name, models.User.email)
+            .where(models.User.id > after_id)
+            .order_by(models.User.id)
+            .limit(limit))
+    if user_ids:
+        stmt = stmt.where(models.User.id.in_(user_ids))
+    if status is not None:
+        stmt = stmt.where(models.User.status == models.UserStatus(status))
+    return (await db.execute(stmt)).all()
+
+async def invite_users(db: AsyncSession, invites: list[tuple]):
+    """Set the new password hashes and the invited status for many (recipient row from
+    get_invite_recipients, password hash) in one transaction"""
+    if not invites:
+        return
+    #Core executemany, the ORM's bulk update by primary key cannot bump the version
+    users = models.User.__table__
+    await db.execute(
+        update(users).where(users.c.id == bindparam("user_id")).values(
+            password=bindparam("hashed_password"), status=models.UserStatus.invited, version=users.c.version + 1),
+        [{"user_id": recipient.id, "hashed_password": hashed_password} for recipient, hashed_password in invites],
+    )
+    await db.commit()
+    user_ids = [recipient.id for recipient, _ in invites]
+    await invalidate_user_tokens(*user_ids)
+    #the cached rows still hold the old version, read_user would remember it again
+    await cache.invalidate(*(f"user:id:{recipient.id}" for recipient, _ in invites),
+                           *(f"user:name:{recipient.name}" for recipient, _ in invites),
+                           *(f"user:email:{recipient.email}" for recipient, _ in invites))
+    await versions.forget("user", *user_ids)
+
+async def get_users(db: AsyncSession, limit: int = 100):
+    stmt = select(models.User).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
+
+async def _hash_passwords(changes: list[dict]):
+    """Replace the plain passwords in changes with their hashes, hashed in parallel like a batch"""
+    with_password = [change for change in changes if "password" in change]
+    hashed = await hashing_service.hash_many(change["password"] for change in with_password)
+    for change, hashed_password in zip(with_password, hashed):
+        change["password"] = hashed_password
+
+def _user_update(columns, conditional: bool):
+    """UPDATE of columns of a user that bumps its version, with the values as bind parameters
+    (named new_<column>, the column names themselves are reserved) for executemany"""
+    users = models.User.__table__
+    stmt = update(users).where(users.c.id == bindparam("user_id")).values(
+        {**{column: bindparam(f"new_{column}") for column in columns}, "version": users.c.version + 1})
+    if conditional:
+        stmt = stmt.where(users.c.version == bindparam("expected_version"))
+    return stmt
+
+def _user_params(user_id: int, change: dict, expected_version: int = None) -> dict:
+    params = {"user_id": user_id, **{f"new_{column}": value for column, value in change.items()}}
+    if expected_version is not None:
+        params["expected_version"] = expected_version
+    return params
+
+async def _after_user_writes(rows, old_names_and_emails):
+    """Drop everything cached about users whose writes committed and store their new versions"""
+    await invalidate_user_tokens(*(row.id for row in rows))
+    await cache.invalidate(*(f"user:id:{row.id}" for row in rows),
+                           *(f"user:name:{row.name}" for row in rows), *(f"user:email:{row.email}" for row in rows),
+                           *(f"user:name:{name}" for name, _ in old_names_and_emails),
+                           *(f"user:email:{email}" for _, email in old_names_and_emails))
+    await versions.remember_many("user", {row.id: row.version for row in rows})
+
+async def _old_names_and_emails(db: AsyncSession, user_ids, changes):
+    """Names and emails of the users about to be renamed, whose cache entries the write makes
+    stale. From the read through cache, so usually without a query"""
+    found = []
+    for user_id, change in zip(user_ids, changes):
+        if "name" in change or "email" in change:
+            user = await cached_get_user_by_id(db, user_id)
+            if user is not None:
+                found.append((user["name"], user["email"]))
+    return found
+
+async def get_user_versions(db: AsyncSession, user_ids: list[int]) -> dict:
+    """{id: version} of the users in user_ids that exist"""
+    users = models.User.__table__
+    stmt = select(users.c.id, users.c.version).where(users.c.id.in_(user_ids))
+    return {row.id: row.version for row in (await db.execute(stmt)).all()}
+
+async def write_user(db: AsyncSession, user_id: int, changes: dict, expected_version: int = None):
+    """Apply changes (column values, a password is hashed here) to a user and commit, with one
+    UPDATE ... RETURNING that also bumps its version, instead of loading, flushing and refreshing
+    an ORM object. Returns the row of id, name, email and version, or None when there is no such
+    user. With expected_version the update only applies to that version of the user, and raises
+    PreconditionFailed when it is at another"""
+    changes = dict(changes)
+    if "password" in changes:
+        changes["password"] = await get_hash_async(changes["password"])
+    old_names_and_emails = await _old_names_and_emails(db, [user_id], [changes])
+    users = models.User.__table__
+    stmt = _user_update(changes, expected_version is not None)
+    params = _user_params(user_id, changes, expected_version)
+    if db.get_bind().dialect.update_returning:
+        stmt = stmt.returning(users.c.id, users.c.name, users.c.email, users.c.version)
+        row = (await db.execute(stmt, params)).one_or_none()
+    else:
+        #mysql has no RETURNING, the row is read back in the same transaction, which holds its lock
+        row = None
+        if (await db.execute(stmt, params)).rowcount:
+            stmt = select(users.c.id, users.c.name, users.c.email, users.c.version).where(users.c.id == user_id)
+            row = (await db.execute(stmt)).one()
+    if row is None:
+        await db.rollback()
+        if expected_version is not None:
+            current = (await get_user_versions(db, [user_id])).get(user_id)
+            if current is not None:
+                raise PreconditionFailed(row_etag("user", user_id, current))
+        return None
+    await db.commit()
+    await _after_user_writes([row], old_names_and_emails)
+    return row
+
+async def update_users_bulk(db: AsyncSession, updates: list[tuple[int, dict, int]]):
+    """Apply many (user id, changes, expected version or None) in one transaction, all or none
+    of them. Updates changing the same columns go out as one executemany where the driver counts
+    the rows each statement matched, and as a statement per user where it cannot. Returns the
+    rows of id, name, email and version in the order of updates, or None after rolling back
+    when a user was missing or at another version than expected (get_user_versions tells which)"""
+    changes = [dict(change) for _, change, _ in updates]
+    await _hash_passwords(changes)
+    user_ids = [user_id for user_id, _, _ in updates]
+    old_names_and_emails = await _old_names_and_emails(db, user_ids, changes)
+    groups = defaultdict(list)
+    for (user_id, _, expected_version), change in zip(updates, changes):
+        groups[(tuple(sorted(change)), expected_version is not None)].append(_user_params(user_id, change, expected_version))
+    per_statement = not db.get_bind().dialect.supports_sane_multi_rowcount
+    for (columns, conditional), params in groups.items():
+        stmt = _user_update(columns, conditional)
+        for batch in ([[param] for param in params] if per_statement else [params]):
+            if (await db.execute(stmt, batch)).rowcount != len(batch):
+                await db.rollback()
+                return None
+    users = models.User.__table__
+    rows = {}
+    for start in range(0, len(user_ids), BULK_READ_BATCH_SIZE):
+        stmt = (select(users.c.id, users.c.name, users.c.email, users.c.version)
+                .where(users.c.id.in_(user_ids[start:start + BULK_READ_BATCH_SIZE])))
+        rows.update((row.id, row) for row in (await db.execute(stmt)).all())
+    await db.commit()
+    rows = [rows[user_id] for user_id in user_ids]
+    await _after_user_writes(rows, old_names_and_emails)
+    return rows
+
+async def update_user(db: AsyncSession, user, update_user):
+    """write_user for callers that hold the ORM user, returns the changes without the password.
+    The user is refreshed, the UPDATE does not go through the session"""
+    if(not isinstance(update_user, dict)):
+        update_user = update_user.dict(exclude_unset=True)
+    if await write_user(db, user.id, update_user) is not None:
+        await db.refresh(user)
+    return {key: value for key, value in update_user.items() if key != "password"}
+
+async def delete_user(db: AsyncSession, user: UserCreation):
+    user_id = user.id
+    name_and_email = (user.name, user.email)
+    await db.delete(user)
+    await db.commit()
+    await _after_user_deleted(user_id, name_and_email)
+    return {"message": "User deleted successfully"}
+
+async def _after_user_deleted(user_id, name_and_email):
+    await invalidate_user_tokens(user_id)
+    await _invalidate_user(user_id, name_and_email)
+    await versions.deleted("user", user_id)
+
+async def create_recipe(db: AsyncSession, recipe: RecipeCreate, user_id: int):
+    """Insert the recipe and all of its steps in one transaction, the steps as a single executemany"""
+    db_recipe = models.Recipe(name=recipe.name, description=recipe.description,
+                              prep_time=recipe.prep_time, user_id=user_id)
+    db.add(db_recipe)
+    await db.flush()
+    if recipe.steps:
+        await db.execute(insert(models.Recipe_Steps), [
+            {"recipe_id": db_recipe.id, **step.model_dump()} for step in recipe.steps
+        ])
+    await reindex_recipes(db, [db_recipe.id])
+    await db.commit()
+    await cache.invalidate(f"recipe:{db_recipe.id}")
+    return await get_recipe(db, db_recipe.id)
+
+async def get_recipe(db: AsyncSession, recipe_id: int):
+    """The recipe with its steps loaded by one extra IN query"""
+    stmt = (select(models.Recipe)
+            .options(selectinload(models.Recipe.steps))
+            .where(models.Recipe.id == recipe_id)
+            .execution_options(populate_existing=True))
+    return (await db.execute(stmt)).scalar_one_or_none()
+
+async def cached_get_recipe(db: AsyncSession, recipe_id: int):
+    """The recipe with its steps as a RecipeInfo shaped dict plus its version, or None"""
+    async def load():
+        recipe = await get_recipe(db, recipe_id)
+        if recipe is None:
+            return None
+        return {**RecipeInfo.model_validate(recipe).model_dump(mode="json"), "version": recipe.version}
+    return await cache.get_or_load(f"recipe:{recipe_id}", load)
+
+async def get_recipes_page(db: AsyncSession, after_id: int = 0, limit: int = 100, user_id: int = None, with_description: bool = False, with_version: bool = False):
+    """Rows of the summary columns for the recipes after after_id in id order, one query
+    however many recipes are on the page"""
+    columns = [models.Recipe.id, models.Recipe.name, models.Recipe.prep_time,
+               models.Recipe.user_id, models.Recipe.created_at]
+    if with_description:
+        columns.append(models.Recipe.description)
+    if with_version:
+        columns.append(models.Recipe.version)
+    stmt = (select(*columns)
+            .where(models.Recipe.id > after_id)
+            .order_by(models.Recipe.id)
+            .limit(limit))
+    if user_id is not None:
+        stmt = stmt.where(models.Recipe.user_id == user_id)
+    return (await db.execute(stmt)).all()
+
+async def get_steps_for_recipes(db: AsyncSession, recipe_ids: list[int]):
+    """Steps of many recipes in one query, grouped by recipe id"""
+    steps = {recipe_id: [] for recipe_id in recipe_ids}
+    if not recipe_ids:
+        return steps
+    stmt = (select(models.Recipe_Steps)
+            .where(models.Recipe_Steps.recipe_id.in_(recipe_ids))
+            .order_by(models.Recipe_Steps.recipe_id, models.Recipe_Steps.step_number))
+    for step in (await db.execute(stmt)).scalars():
+        steps[step.recipe_id].append(step)
+    return steps
+
+async def update_recipe(db: AsyncSession, recipe, update_recipe: RecipeUpdate):
+    for key, value in update_recipe.model_dump(exclude_unset=True).items():
+        setattr(recipe, key, value)
+    await db.flush()
+    await reindex_recipes(db, [recipe.id])
+    await db.commit()
+    await cache.invalidate(f"recipe:{recipe.id}")
+    recipe = await get_recipe(db, recipe.id)
+    await versions.remember("recipe", recipe.id, recipe.version)
+    return recipe
+
+async def bump_recipe_version(db: AsyncSession, recipe_id: int) -> int:
+    """Bump the version of a recipe whose steps changed, in the caller's transaction. Returns
+    the new version"""
+    await db.execute(update(models.Recipe).where(models.Recipe.id == recipe_id)
+                     .values(version=models.Recipe.version + 1)
+                     .execution_options(synchronize_session=False))
+    stmt = select(models.Recipe.version).where(models.Recipe.id == recipe_id)
+    return (await db.execute(stmt)).scalar_one()
+
+async def update_recipe_steps(db: AsyncSession, recipe_id: int, steps: list[StepCreate]):
+    """Make the recipe's steps match the given list by step number. Only rows that actually
+    change are written: new step numbers are inserted, changed ones updated and missing ones deleted"""
+    stmt = select(models.Recipe_Steps.id, models.Recipe_Steps.step_number,
+                  models.Recipe_Steps.instruction, models.Recipe_Steps.image_url
+                  ).where(models.Recipe_Steps.recipe_id == recipe_id)
+    existing = {row.step_number: row for row in (await db.execute(stmt)).all()}
+    wanted = {step.step_number: step for step in steps}
+
+    to_insert = [{"recipe_id": recipe_id, **step.model_dump()}
+                 for number, step in wanted.items() if number not in existing]
+    to_update = [{"id": existing[number].id, "instruction": step.instruction, "image_url": step.image_url}
+                 for number, step in wanted.items()
+                 if number in existing and (existing[number].instruction, existing[number].image_url) != (step.instruction, step.image_url)]
+    to_delete = [row.id for number, row in existing.items() if number not in wanted]
+
+    if to_delete:
+        await db.execute(delete(models.Recipe_Steps).where(models.Recipe_Steps.id.in_(to_delete)))
+    if to_update:
+        await db.execute(update(models.Recipe_Steps), to_update)
+    if to_insert:
+        await db.execute(insert(models.Recipe_Steps), to_insert)
+    version = None
+    if to_insert or to_update or to_delete:
+        await reindex_recipes(db, [recipe_id])
+        version = await bump_recipe_version(db, recipe_id)
+    await db.commit()
+    await cache.invalidate(f"recipe:{recipe_id}")
+    if version is not None:
+        await versions.remember("recipe", recipe_id, version)
+    return {
+        "inserted": len(to_insert),
+        "updated": len(to_update),
+        "deleted": len(to_delete),
+        "unchanged": len(wanted) - len(to_insert) - len(to_update),
+    }
+
+async def set_step_image(db: AsyncSession, recipe_id: int, step_number: int, image_url: str) -> bool:
+    """Point a step at an uploaded image, False when the recipe has no such step"""
+    result = await db.execute(
+        update(models.Recipe_Steps)
+        .where(models.Recipe_Steps.recipe_id == recipe_id, models.Recipe_Steps.step_number == step_number)
+        .values(image_url=image_url)
+    )
+    if result.rowcount == 0:
+        await db.rollback()
+        return False
+    version = await bump_recipe_version(db, recipe_id)
+    await db.commit()
+    await cache.invalidate(f"recipe:{recipe_id}")
+    await versions.remember("recipe", recipe_id, version)
+    return True
+
+async def delete_recipe(db: AsyncSession, recipe_id: int):
+    await db.execute(delete(models.Recipe_Steps).where(models.Recipe_Steps.recipe_id == recipe_id))
+    await db.execute(delete(models.Recipe).where(models.Recipe.id == recipe_id))
+    await remove_recipes(db, [recipe_id])
+    await db.commit()
+    await cache.invalidate(f"recipe:{recipe_id}")
+    await versions.deleted("recipe", recipe_id)
+    return {"message": "Recipe deleted successfully"}
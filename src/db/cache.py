@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import random
+import secrets
+import time
+from collections import OrderedDict
+import msgpack
+import redis
+from src.db.database import get_redis_binary_client
+
+#bump when the shape of a cached value changes so old entries are simply never read again
+CACHE_SCHEMA_VERSION = 2
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', 300))
+CACHE_NEGATIVE_TTL_SECONDS = int(os.environ.get('CACHE_NEGATIVE_TTL_SECONDS', 30))
+CACHE_TTL_JITTER = 0.1 #spread expiries by +-10% so keys cached together do not expire together
+CACHE_L1_MAXSIZE = int(os.environ.get('CACHE_L1_MAXSIZE', 10000))
+#the per process tier is only invalidated locally, so this is how stale another worker's write can look
+CACHE_L1_TTL_SECONDS = float(os.environ.get('CACHE_L1_TTL_SECONDS', 5))
+CACHE_LOCK_MILLISECONDS = 5000
+CACHE_LOCK_POLL_SECONDS = 0.05
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ReadThroughCache:
+    """Two tier read through cache: a small per process LRU in front of redis. Values are
+    msgpack encoded, None is cached too (for a shorter time) so lookups of missing rows are
+    cheap as well. Only one loader per key runs at a time: within a process callers share one
+    load, across processes a short redis lock makes the others wait for the first one's result.
+    Redis being down only costs the cache, never the request"""
+
+    def __init__(self, redis, prefix: str, ttl: int, negative_ttl: int, l1_maxsize: int, l1_ttl: float):
+        self._redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.l1_maxsize = l1_maxsize
+        self.l1_ttl = l1_ttl
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self._l1 = OrderedDict() #key -> (expires_at, value)
+        self._inflight = {} #key -> future of the load in progress
+
+    @property
+    def redis(self):
+        """The client given to the constructor, or the app's shared binary one"""
+        return self._redis or get_redis_binary_client()
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}v{CACHE_SCHEMA_VERSION}:{key}"
+
+    def _l1_get(self, key):
+        entry = self._l1.get(key)
+        if entry is None:
+            return _MISSING
+        if entry[0] <= time.monotonic():
+            del self._l1[key]
+            return _MISSING
+        self._l1.move_to_end(key)
+        return entry[1]
+
+    def _l1_set(self, key, value):
+        self._l1[key] = (time.monotonic() + self.l1_ttl, value)
+        self._l1.move_to_end(key)
+        while len(self._l1) > self.l1_maxsize:
+            self._l1.popitem(last=False)
+
+    async def _redis_get(self, key):
+        try:
+            raw = await self.redis.get(self._key(key))
+        except redis.RedisError:
+            logger.warning("Cache read failed for %s", key, exc_info=True)
+            return _MISSING
+        return _MISSING if raw is None else msgpack.unpackb(raw)
+
+    async def _redis_set(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        ttl = max(1, int(ttl * random.uniform(1 - CACHE_TTL_JITTER, 1 + CACHE_TTL_JITTER)))
+        try:
+            await self.redis.set(self._key(key), msgpack.packb(value), ex=ttl)
+        except redis.RedisError:
+            logger.warning("Cache write failed for %s", key, exc_info=True)
+
+    async def get_or_load(self, key: str, loader):
+        """Cached value for key, calling the async loader() on a miss. loader returns something
+        msgpack can encode (dicts, lists, strings, numbers) or None"""
+        value = self._l1_get(key)
+        if value is not _MISSING:
+            self.l1_hits += 1
+            return value
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._load(key, loader)
+            self._l1_set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception() #mark retrieved, the waiters get it through await
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _load(self, key, loader):
+        value = await self._redis_get(key)
+        if value is not _MISSING:
+            self.l2_hits += 1
+            return value
+        self.misses += 1
+        lock_key = self._key(f"lock:{key}")
+        token = secrets.token_hex(8)
+        try:
+            locked = await self.redis.set(lock_key, token, nx=True, px=CACHE_LOCK_MILLISECONDS)
+        except redis.RedisError:
+            return await loader() #redis is down, nothing to coordinate with
+        if not locked:
+            #someone else is loading it, wait for their result rather than hitting the database too
+            deadline = time.monotonic() + CACHE_LOCK_MILLISECONDS / 1000
+            while time.monotonic() < deadline:
+                await asyncio.sleep(CACHE_LOCK_POLL_SECONDS)
+                value = await self._redis_get(key)
+                if value is not _MISSING:
+                    return value
+        value = await loader()
+        await self._redis_set(key, value)
+        if locked:
+            try:
+                if await self.redis.get(lock_key) == token.encode():
+                    await self.redis.delete(lock_key)
+            except redis.RedisError:
+                pass
+        return value
+
+    async def invalidate(self, *keys: str):
+        """Drop keys from this process and from redis, call after the write has committed"""
+        if not keys:
+            return
+        for key in keys:
+            self._l1.pop(key, None)
+        try:
+            await self.redis.delete(*(self._key(key) for key in keys))
+        except redis.RedisError:
+            logger.warning("Cache invalidation failed for %s", keys, exc_info=True)
+
+    def stats(self) -> dict:
+        return {"l1_hits": self.l1_hits, "l2_hits": self.l2_hits, "misses": self.misses, "l1_size": len(self._l1)}
+
+
+cache = ReadThroughCache(
+    None,
+    prefix="cache:",
+    ttl=CACHE_TTL_SECONDS,
+    negative_ttl=CACHE_NEGATIVE_TTL_SECONDS,
+    l1_maxsize=CACHE_L1_MAXSIZE,
+    l1_ttl=CACHE_L1_TTL_SECONDS,
+)
@@ -1,11 +1,34 @@
+import asyncio
+import logging
+import threading
+from anyio import from_thread
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 from ..schemas.pydantic_schemas import UserCreation, UpdateUser
 
-from . import models
+from . import async_crud, models
 from src.auth.helpers import get_hash, generate_random_password
 
+logger = logging.getLogger(__name__)
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def _run_async(fn, *args):
+    """Run an async function, such as the cache invalidation after a commit, from sync code.
+    From the app's threadpool it runs on the app's event loop. Anywhere else (scripts, jobs)
+    it runs on one event loop of this process in a background thread, so the redis clients
+    built on that loop stay usable from one call to the next"""
+    global _loop
+    if hasattr(from_thread.threadlocals, "current_token"): #an AnyIO worker thread
+        return from_thread.run(fn, *args)
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="crud-async", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(fn(*args), _loop).result()
+
 def create_user(db: Session, user: UserCreation):
     password = generate_random_password()
     hashed_password = get_hash(password)
@@ -14,6 +37,7 @@ def create_user(db: Session, user: UserCreation):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    _run_async(async_crud._invalidate_user, db_user.id, (user.name, user.email))
     return db_user
 
 def get_user_by_id(db: Session, user_id: int):
@@ -35,18 +59,23 @@ def get_users(db: Session, limit: int = 100):
 def update_user(db: Session, user, update_user):
     if(not isinstance(update_user, dict)):
         update_user = update_user.dict(exclude_unset=True)
+    old_name_and_email = (user.name, user.email)
     for key, value in update_user.items():
-        print(key)
+        logger.debug("Updating %s of user %s", key, user.id)
         if(key == "password"):
             value = get_hash(value)
         setattr(user, key, value)
     db.commit()
     db.refresh(user)
+    _run_async(async_crud._after_user_writes, [user], [old_name_and_email])
     if "password" in update_user:
         del update_user["password"]
     return update_user
 
 def delete_user(db:Session, user: UserCreation):
+    user_id = user.id
+    name_and_email = (user.name, user.email)
     db.delete(user)
     db.commit()
+    _run_async(async_crud._after_user_deleted, user_id, name_and_email)
     return {"message": "User deleted successfully"}
\ No newline at end of file
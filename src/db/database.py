@@ -1,23 +1,164 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import DeclarativeBase
-import redis
+from starlette.concurrency import run_in_threadpool
+import redis.asyncio as aioredis
+from src.metrics.prometheus import instrument_engine, instrument_redis
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
+import threading
 
 SQLALCHEMY_DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_ASYNC = os.environ.get('DB_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+
+#pool settings are per engine, so per uvicorn worker
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800)) #keep below mysql wait_timeout
+
+#redis pools are per client, so per uvicorn worker. fakeredis:// gives an in memory server for tests and benchmarks
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 1)) #wait for a free connection before erroring
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 1))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 1))
+REDIS_HEALTH_CHECK_SECONDS = int(os.environ.get('REDIS_HEALTH_CHECK_SECONDS', 30))
+
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+def _pool_options(url) -> dict:
+    """sqlite uses its own pool classes that do not take sizing arguments"""
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+
+def async_database_url(url) -> str:
+    """Swap the sync driver in the database url for its async equivalent"""
+    url = make_url(url)
+    drivername = ASYNC_DRIVERS.get(url.drivername, url.drivername)
+    return url.set(drivername=drivername).render_as_string(hide_password=False)
+
+#engines, session factories and redis clients are built on first use, once per process, so
+#importing the app (or a test, or a script) does not touch the database or redis
+_instances = {}
+_instances_lock = threading.RLock() #reentrant, building a session factory builds the engine
+
+def _once(name, build):
+    instance = _instances.get(name)
+    if instance is None:
+        with _instances_lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = _instances[name] = build()
+    return instance
+
+def get_engine():
+    return _once("engine", lambda: instrument_engine(create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        pool_pre_ping=True,
+        **_pool_options(SQLALCHEMY_DATABASE_URL)
+    )))
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    pool_pre_ping=True
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def get_async_engine():
+    """The async engine, or None when DB_ASYNC is off"""
+    if not DB_ASYNC:
+        return None
+    def build():
+        async_engine = create_async_engine(
+            async_database_url(SQLALCHEMY_DATABASE_URL),
+            pool_pre_ping=True,
+            **_pool_options(SQLALCHEMY_DATABASE_URL)
+        )
+        instrument_engine(async_engine.sync_engine)
+        return async_engine
+    return _once("async_engine", build)
+
+def SessionLocal(**kwargs):
+    session_factory = _once("session_factory", lambda: sessionmaker(autocommit=False, autoflush=False, bind=get_engine()))
+    return session_factory(**kwargs)
+
+def AsyncSessionLocal():
+    session_factory = _once("async_session_factory", lambda: async_sessionmaker(
+        get_async_engine(), autoflush=False, expire_on_commit=False))
+    return session_factory()
 
 class Base(DeclarativeBase):
     pass
 
+class SyncSessionAdapter:
+    """Gives a sync Session the awaitable interface of AsyncSession by running each
+    database call in the threadpool. Used when DB_ASYNC is turned off so the async
+    crud functions and routers work unchanged on the sync engine"""
+
+    def __init__(self, session):
+        self.sync_session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def get_bind(self, *args, **kwargs):
+        return self.sync_session.get_bind(*args, **kwargs)
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def flush(self, *args, **kwargs):
+        await run_in_threadpool(self.sync_session.flush, *args, **kwargs)
+
+    async def refresh(self, *args, **kwargs):
+        await run_in_threadpool(self.sync_session.refresh, *args, **kwargs)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+def new_async_session() -> AsyncSession:
+    """Open a session for the async crud functions on whichever engine DB_ASYNC selects"""
+    if DB_ASYNC:
+        return AsyncSessionLocal()
+    return SyncSessionAdapter(SessionLocal(expire_on_commit=False))
+
 def get_db():
     db = SessionLocal()
     try:
@@ -25,4 +166,49 @@ def get_db():
     finally:
         db.close()
 
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
\ No newline at end of file
+async def get_async_db():
+    async with new_async_session() as db:
+        yield db
+
+_fake_redis_server = None
+
+def create_redis_client(decode_responses: bool = True, **options) -> aioredis.Redis:
+    """Async redis client on its own connection pool for REDIS_URL, options override the
+    pool settings above (e.g. socket_timeout=None for blocking commands)"""
+    global _fake_redis_server
+    if REDIS_URL.startswith("fakeredis://"):
+        import fakeredis
+        if _fake_redis_server is None:
+            _fake_redis_server = fakeredis.FakeServer()
+        return instrument_redis(fakeredis.FakeAsyncRedis(server=_fake_redis_server, decode_responses=decode_responses))
+    settings = {
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        "timeout": REDIS_POOL_TIMEOUT,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_SECONDS,
+        "retry_on_timeout": False, #callers decide what a timeout means, see REVOCATION_FAIL_OPEN
+        **options,
+    }
+    pool = aioredis.BlockingConnectionPool.from_url(REDIS_URL, decode_responses=decode_responses, **settings)
+    return instrument_redis(aioredis.Redis(connection_pool=pool))
+
+def get_redis_client() -> aioredis.Redis:
+    return _once("redis_client", create_redis_client)
+
+def get_redis_binary_client() -> aioredis.Redis:
+    """Same server without decoding, for values that are not text such as the msgpack encoded cache"""
+    return _once("redis_binary_client", lambda: create_redis_client(decode_responses=False))
+
+async def close_connections():
+    """Dispose of whatever engines and clients were built, they are built again if used afterwards"""
+    with _instances_lock:
+        instances = dict(_instances)
+        _instances.clear()
+    for name in ("redis_client", "redis_binary_client"):
+        if name in instances:
+            await instances[name].aclose(close_connection_pool=True)
+    if "async_engine" in instances:
+        await instances["async_engine"].dispose()
+    if "engine" in instances:
+        instances["engine"].dispose()
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import redis
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+from src.db.database import get_redis_client
+
+#conditional GETs: read endpoints tag their responses with an ETag built from the version column
+#of the rows in them, and answer a matching If-None-Match with an empty 304 before serializing
+#anything. For single rows the version can come from a redis counter, which skips the database too.
+#Writes take a row's tag back in If-Match and only apply to the version it names
+
+#bump when the JSON of a tagged endpoint changes shape, so clients stop matching old tags
+ETAG_REVISION = 1
+HTTP_CACHE_VERSIONS = os.environ.get('HTTP_CACHE_VERSIONS', 'true').lower() in ('1', 'true', 'yes')
+#same lifetime as the read through cache, whose entries the counters have to agree with
+HTTP_CACHE_VERSION_TTL_SECONDS = int(os.environ.get('HTTP_CACHE_VERSION_TTL_SECONDS', os.environ.get('CACHE_TTL_SECONDS', 300)))
+
+VERSION_KEY_PREFIX = "version:"
+#higher than any real version, left behind by deletes so no old tag matches until it expires
+DELETED = 2 ** 52
+
+#versions only ever go up, so a reader that loaded a row before a write and stores its version
+#after the writer stored the new one cannot move the counter back. KEYS is the counter, ARGV the
+#version and the lifetime in seconds
+SET_AT_LEAST_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag for a response built from parts (ids, versions, query parameters)"""
+    digest = hashlib.blake2b(repr((ETAG_REVISION, parts)).encode(), digest_size=12)
+    return f'"{digest.hexdigest()}"'
+
+def row_etag(kind: str, row_id: int, version: int) -> str:
+    """ETag of a single row, readable so a client can send it back in If-Match"""
+    return f'"{kind}-{row_id}-{version}.{ETAG_REVISION}"'
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match compares weakly, so W/ tags match their strong form"""
+    return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+class PreconditionFailed(HTTPException):
+    """If-Match named another version of the row than the current one. Carries the current tag
+    when there is one, so the client can tell what it has to reload"""
+
+    def __init__(self, etag: str = None):
+        super().__init__(
+            status_code=412,
+            detail="The resource was changed since it was read, reload it and try again",
+            headers={"ETag": etag} if etag else None,
+        )
+
+
+def if_match_version(request: Request, kind: str, row_id: int):
+    """The version of the row If-Match makes a write conditional on, None without the header or
+    with *. Tags of other rows or not made by row_etag fail the precondition. W/ tags are taken
+    as their strong form, the compression middleware weakens them but the version is the same"""
+    header = request.headers.get("if-match")
+    if header is None or header.strip() == "*":
+        return None
+    prefix = f'"{kind}-{row_id}-'
+    suffix = f'.{ETAG_REVISION}"'
+    for tag in header.split(","):
+        tag = tag.strip().removeprefix("W/")
+        version = tag[len(prefix):-len(suffix)]
+        if tag.startswith(prefix) and tag.endswith(suffix) and version.isdigit():
+            return int(version)
+    raise PreconditionFailed()
+
+
+class HttpCache:
+    """Cache-Control and conditional GET handling for one route. The max-age given in the code
+    can be changed with HTTP_CACHE_<SCOPE>_MAX_AGE. Everything behind auth is private, and
+    max-age 0 means clients revalidate every time, which is what the ETags are for"""
+
+    def __init__(self, scope: str, max_age: int = 0):
+        self.max_age = int(os.environ.get(f"HTTP_CACHE_{scope}_MAX_AGE".upper(), max_age))
+        self.cache_control = f"private, max-age={self.max_age}" if self.max_age else "private, no-cache"
+
+    def headers(self, etag: str) -> dict:
+        return {"ETag": etag, "Cache-Control": self.cache_control}
+
+    def not_modified(self, request: Request, etag: str):
+        """The 304 to answer with when the client already has etag, otherwise None"""
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=self.headers(etag))
+        return None
+
+
+class VersionCounters:
+    """The current version of rows, kept in redis by the writes so a conditional GET of a single
+    row can be answered without loading it. A missing counter, or redis being down, just means
+    the row is loaded (through the read through cache) as it would be without them. Counters
+    can lag a write by as much as that cache can"""
+
+    def __init__(self, redis=None, ttl: int = 300, enabled: bool = True):
+        self._redis = redis
+        self._script = None
+        self.ttl = ttl
+        self.enabled = enabled
+
+    @property
+    def redis(self):
+        """The client given to the constructor, or the app's shared one"""
+        return self._redis or get_redis_client()
+
+    def _key(self, kind: str, row_id: int) -> str:
+        return f"{VERSION_KEY_PREFIX}{kind}:{row_id}"
+
+    def _set_at_least(self):
+        client = self.redis
+        if self._script is None or self._script.registered_client is not client:
+            self._script = client.register_script(SET_AT_LEAST_SCRIPT)
+        return self._script
+
+    async def get(self, kind: str, row_id: int):
+        """The version of the row, or None when it has to be loaded to find out"""
+        if not self.enabled:
+            return None
+        try:
+            value = await self.redis.get(self._key(kind, row_id))
+        except redis.RedisError:
+            logger.warning("Version read failed for %s %s", kind, row_id, exc_info=True)
+            return None
+        return None if value is None else int(value)
+
+    async def remember(self, kind: str, row_id: int, version: int):
+        """Store the version a read or a committed write saw, unless a newer one is stored"""
+        if not self.enabled:
+            return
+        try:
+            await self._set_at_least()(keys=[self._key(kind, row_id)], args=[version, self.ttl])
+        except redis.RedisError:
+            logger.warning("Version write failed for %s %s", kind, row_id, exc_info=True)
+
+    async def remember_many(self, kind: str, row_versions: dict):
+        """remember for many rows {id: version} in one round trip"""
+        if not self.enabled or not row_versions:
+            return
+        try:
+            script = self._set_at_least()
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for row_id, version in row_versions.items():
+                    await script(keys=[self._key(kind, row_id)], args=[version, self.ttl], client=pipe)
+                await pipe.execute()
+        except redis.RedisError:
+            logger.warning("Version write failed for %s %s", kind, list(row_versions), exc_info=True)
+
+    async def forget(self, kind: str, *row_ids: int):
+        """Drop counters of rows whose new version is not known, call after the write has committed"""
+        if not self.enabled or not row_ids:
+            return
+        try:
+            await self.redis.delete(*(self._key(kind, row_id) for row_id in row_ids))
+        except redis.RedisError:
+            logger.warning("Version invalidation failed for %s %s", kind, row_ids, exc_info=True)
+
+    async def deleted(self, kind: str, row_id: int):
+        await self.remember(kind, row_id, DELETED)
+
+
+versions = VersionCounters(None, ttl=HTTP_CACHE_VERSION_TTL_SECONDS, enabled=HTTP_CACHE_VERSIONS)
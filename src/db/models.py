@@ -1,11 +1,17 @@
 import enum
 import datetime
-from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, String, Enum
+from sqlalchemy import DDL, Boolean, DateTime, ForeignKey, Index, Integer, String, Enum, Text, UniqueConstraint, event
 from sqlalchemy.sql import func
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 from .database import Base
 
 
+class UserStatus(enum.Enum):
+    new = "new"
+    invited = "invited"
+    active = "active"
+    deleted = "deleted"
+
 class User(Base):
     __tablename__ = "users"
 
@@ -13,24 +19,57 @@ class User(Base):
     name: Mapped[str] = mapped_column(String(30), nullable=False, index=True, unique=True)
     email: Mapped[str] = mapped_column(String(254), unique=True, index=True, nullable=False)
     password: Mapped[str] = mapped_column(String(128), nullable=False)
+    status: Mapped[UserStatus] = mapped_column(Enum(UserStatus), nullable=False, default=UserStatus.new, index=True)
+    #bumped by every write, the ETags of the read endpoints are built from it. Flushes of a loaded
+    #row bump it themselves and fail if another writer got there first
+    version: Mapped[int] = mapped_column(Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
 
 class Recipe(Base):
     __tablename__ = "recipes"
+    __table_args__ = (
+        Index("ix_recipes_fulltext", "name", "description", mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     name: Mapped[str] = mapped_column(String(254), nullable=False, index=True, unique=True)
-    description: Mapped[str] = mapped_column(String)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    description: Mapped[str] = mapped_column(Text, nullable=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     prep_time: Mapped[int] = mapped_column(Integer, nullable=False)
     created_at: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
+    #also bumped when the steps change, see async_crud.bump_recipe_version
+    version: Mapped[int] = mapped_column(Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+    #lazy="raise" so a missing selectinload fails loudly instead of quietly doing a query per recipe
+    steps: Mapped[list["Recipe_Steps"]] = relationship(
+        back_populates="recipe", order_by="Recipe_Steps.step_number", lazy="raise"
+    )
 
 class Recipe_Steps(Base):
     __tablename__ = "recipe_steps"
+    __table_args__ = (
+        UniqueConstraint("recipe_id", "step_number"),
+        Index("ix_recipe_steps_fulltext", "instruction", mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    recipe_id: Mapped[int] = mapped_column(ForeignKey("recipe.id"))
+    recipe_id: Mapped[int] = mapped_column(ForeignKey("recipes.id", ondelete="CASCADE"), index=True)
     step_number: Mapped[int] = mapped_column(Integer, nullable=False)
-    instruction: Mapped[str] = mapped_column(String, nullable=False)
-    image_url: Mapped[str] = mapped_column(String)
\ No newline at end of file
+    instruction: Mapped[str] = mapped_column(Text, nullable=False)
+    image_url: Mapped[str] = mapped_column(String(1024), nullable=True)
+
+    recipe: Mapped[Recipe] = relationship(back_populates="steps", lazy="raise")
+
+#sqlite has no FULLTEXT indexes, so there the recipe search uses an FTS5 table with one row per
+#recipe (rowid = recipe id) that src/search/recipe_search.py keeps up to date
+event.listen(
+    Recipe.__table__,
+    "after_create",
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search USING fts5("
+        "name, description, steps, tokenize='unicode61', prefix='2 3')").execute_if(dialect="sqlite"),
+)
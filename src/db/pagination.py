@@ -0,0 +1,29 @@
+import base64
+import json
+from fastapi import HTTPException
+
+#keyset pagination: a page is the rows after the last id the client saw, so every page costs the
+#same index range scan no matter how deep it is. Cursors are opaque so the key can change later
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": last_id}).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str | None) -> int:
+    """Return the id to continue after, 0 for the first page"""
+    if not cursor:
+        return 0
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        after = json.loads(base64.urlsafe_b64decode(padded.encode()))["after"]
+        if not isinstance(after, int):
+            raise ValueError
+        return after
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def split_page(rows, limit: int):
+    """Rows are fetched with limit + 1 so the extra row tells whether there is a next page"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1].id)
+    return rows, None
@@ -0,0 +1,362 @@
+import abc
+import contextlib
+import os
+import shutil
+import tempfile
+import uuid
+from starlette.concurrency import run_in_threadpool
+
+#local keeps images under IMAGE_STORAGE_PATH. s3 needs boto3 and S3_BUCKET (plus S3_ENDPOINT_URL for
+#minio and other S3 compatible stores), s3-local runs the s3 code against a stand-in on local disk
+IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE', 'local')
+IMAGE_STORAGE_PATH = os.environ.get('IMAGE_STORAGE_PATH', 'media')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'recipe-organizer')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_PART_SIZE = int(os.environ.get('S3_PART_SIZE', 8 * 1024 * 1024)) #S3 wants at least 5MB for every part but the last
+
+LOCAL_WRITE_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+MEDIA_TYPES = {"jpg": "image/jpeg", "png": "image/png", "gif": "image/gif", "webp": "image/webp"}
+
+
+def media_type(key: str) -> str:
+    return MEDIA_TYPES.get(key.rsplit(".", 1)[-1], "application/octet-stream")
+
+
+class BufferedUpload(abc.ABC):
+    """An object being written. Chunks are collected up to threshold bytes and then flushed,
+    so at most one threshold's worth of the file is ever in memory. commit stores it under
+    its final key and returns False when that key already existed, the upload is then dropped"""
+
+    threshold = LOCAL_WRITE_SIZE
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    async def write(self, chunk: bytes):
+        self._buffer += chunk
+        if len(self._buffer) >= self.threshold:
+            await self._flush(bytes(self._buffer))
+            self._buffer.clear()
+
+    @abc.abstractmethod
+    async def _flush(self, data: bytes):
+        ...
+
+    @abc.abstractmethod
+    async def commit(self, key: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def abort(self):
+        ...
+
+
+class Storage(abc.ABC):
+    """Where images live, addressed by key"""
+
+    @abc.abstractmethod
+    async def begin_upload(self) -> BufferedUpload:
+        ...
+
+    @abc.abstractmethod
+    async def put(self, key: str, data: bytes):
+        """Store a small object in one go, such as a thumbnail"""
+
+    @abc.abstractmethod
+    async def size(self, key: str):
+        """Size in bytes, or None when there is no such object"""
+
+    @abc.abstractmethod
+    def read(self, key: str, start: int = 0, end: int = None):
+        """Async iterator over the bytes from start up to but not including end, a chunk at a time"""
+
+    @contextlib.asynccontextmanager
+    async def local_copy(self, key: str):
+        """A path to the object on local disk for as long as the context is open"""
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(key)[1]) as fp:
+            async for chunk in self.read(key):
+                await run_in_threadpool(fp.write, chunk)
+            await run_in_threadpool(fp.flush)
+            yield fp.name
+
+
+class LocalUpload(BufferedUpload):
+    def __init__(self, storage, fp):
+        super().__init__()
+        self.storage = storage
+        self.fp = fp
+
+    async def _flush(self, data: bytes):
+        await run_in_threadpool(self.fp.write, data)
+
+    async def commit(self, key: str) -> bool:
+        await self._flush(bytes(self._buffer))
+        await run_in_threadpool(self.fp.close)
+        return await run_in_threadpool(self._move, key)
+
+    def _move(self, key: str) -> bool:
+        path = self.storage.path(key)
+        if os.path.exists(path):
+            os.remove(self.fp.name)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.fp.name, path) #atomic, a reader sees the whole file or none of it
+        return True
+
+    async def abort(self):
+        await run_in_threadpool(self._remove)
+
+    def _remove(self):
+        self.fp.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.fp.name)
+
+
+class LocalStorage(Storage):
+    """Files under root, sharded by the first characters of the key. Uploads are written to
+    root/.incoming so moving them into place is a rename on the same filesystem"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    async def begin_upload(self) -> LocalUpload:
+        return LocalUpload(self, await run_in_threadpool(self._open_incoming))
+
+    def _open_incoming(self):
+        incoming = os.path.join(self.root, ".incoming")
+        os.makedirs(incoming, exist_ok=True)
+        return open(os.path.join(incoming, uuid.uuid4().hex), "wb")
+
+    async def put(self, key: str, data: bytes):
+        upload = await self.begin_upload()
+        await upload.write(data)
+        await upload.commit(key)
+
+    async def size(self, key: str):
+        try:
+            return (await run_in_threadpool(os.stat, self.path(key))).st_size
+        except FileNotFoundError:
+            return None
+
+    async def read(self, key: str, start: int = 0, end: int = None):
+        fp = await run_in_threadpool(open, self.path(key), "rb")
+        try:
+            fp.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = await run_in_threadpool(fp.read, READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            fp.close()
+
+    @contextlib.asynccontextmanager
+    async def local_copy(self, key: str):
+        yield self.path(key)
+
+
+def _is_missing(error) -> bool:
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+class S3Upload(BufferedUpload):
+    """Files up to one part are sent with a single put_object straight to their final key. Larger
+    ones go up as a multipart upload to a temporary key, which is copied into place at commit
+    since S3 has no rename"""
+
+    threshold = S3_PART_SIZE
+
+    def __init__(self, storage):
+        super().__init__()
+        self.storage = storage
+        self.temp_key = f"incoming/{uuid.uuid4().hex}"
+        self.upload_id = None
+        self.parts = []
+
+    def _call(self, method, **kwargs):
+        return run_in_threadpool(getattr(self.storage.client, method), Bucket=self.storage.bucket, **kwargs)
+
+    async def _flush(self, data: bytes):
+        if self.upload_id is None:
+            self.upload_id = (await self._call("create_multipart_upload", Key=self.temp_key))["UploadId"]
+        number = len(self.parts) + 1
+        part = await self._call("upload_part", Key=self.temp_key, UploadId=self.upload_id, PartNumber=number, Body=data)
+        self.parts.append({"PartNumber": number, "ETag": part["ETag"]})
+
+    async def commit(self, key: str) -> bool:
+        if await self.storage.size(key) is not None:
+            await self.abort()
+            return False
+        if self.upload_id is None:
+            await self.storage.put(key, bytes(self._buffer))
+            return True
+        if self._buffer:
+            await self._flush(bytes(self._buffer))
+        await self._call("complete_multipart_upload", Key=self.temp_key, UploadId=self.upload_id,
+                         MultipartUpload={"Parts": self.parts})
+        await self._call("copy_object", Key=key, CopySource={"Bucket": self.storage.bucket, "Key": self.temp_key},
+                         ContentType=media_type(key), MetadataDirective="REPLACE")
+        await self._call("delete_object", Key=self.temp_key)
+        return True
+
+    async def abort(self):
+        if self.upload_id is not None:
+            await self._call("abort_multipart_upload", Key=self.temp_key, UploadId=self.upload_id)
+
+
+class S3Storage(Storage):
+    """Objects in an S3 bucket, through a client with the method names and arguments of boto3's.
+    The client is blocking, so every call runs in the threadpool"""
+
+    def __init__(self, client, bucket: str):
+        self.client = client
+        self.bucket = bucket
+
+    async def begin_upload(self) -> S3Upload:
+        return S3Upload(self)
+
+    async def put(self, key: str, data: bytes):
+        await run_in_threadpool(self.client.put_object, Bucket=self.bucket, Key=key, Body=data,
+                                ContentType=media_type(key))
+
+    async def size(self, key: str):
+        try:
+            return (await run_in_threadpool(self.client.head_object, Bucket=self.bucket, Key=key))["ContentLength"]
+        except Exception as error:
+            if _is_missing(error):
+                return None
+            raise
+
+    async def read(self, key: str, start: int = 0, end: int = None):
+        byte_range = f"bytes={start}-{'' if end is None else end - 1}"
+        response = await run_in_threadpool(self.client.get_object, Bucket=self.bucket, Key=key, Range=byte_range)
+        chunks = response["Body"].iter_chunks(READ_CHUNK_SIZE)
+        try:
+            while True:
+                chunk = await run_in_threadpool(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            response["Body"].close()
+
+
+class LocalS3Error(Exception):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}} #shaped like botocore's ClientError
+
+
+class LocalS3Body:
+    def __init__(self, fp, length: int):
+        self.fp = fp
+        self.remaining = length
+
+    def iter_chunks(self, chunk_size: int):
+        while self.remaining > 0:
+            chunk = self.fp.read(min(chunk_size, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.fp.close()
+
+
+class LocalS3Client:
+    """Stand-in for a boto3 S3 client that keeps buckets as directories under root. It covers
+    only the calls S3Storage makes, so the S3 code path can run in development and tests"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def _parts(self, upload_id: str) -> str:
+        return os.path.join(self.root, ".multipart", upload_id)
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as fp:
+            fp.write(Body)
+        os.replace(path + ".part", path)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        try:
+            return {"ContentLength": os.stat(self._path(Bucket, Key)).st_size}
+        except FileNotFoundError:
+            raise LocalS3Error("404")
+
+    def get_object(self, Bucket, Key, Range=None):
+        size = self.head_object(Bucket, Key)["ContentLength"]
+        start, end = 0, size - 1
+        if Range:
+            first, _, last = Range.removeprefix("bytes=").partition("-")
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        fp = open(self._path(Bucket, Key), "rb")
+        fp.seek(start)
+        return {"Body": LocalS3Body(fp, end - start + 1), "ContentLength": end - start + 1}
+
+    def delete_object(self, Bucket, Key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(Bucket, Key))
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource, ContentType=None, MetadataDirective=None):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(self._path(CopySource["Bucket"], CopySource["Key"]), path)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._parts(upload_id))
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with open(os.path.join(self._parts(UploadId), str(PartNumber)), "wb") as fp:
+            fp.write(Body)
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            for part in MultipartUpload["Parts"]:
+                with open(os.path.join(self._parts(UploadId), str(part["PartNumber"])), "rb") as fp:
+                    shutil.copyfileobj(fp, out)
+        shutil.rmtree(self._parts(UploadId))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        shutil.rmtree(self._parts(UploadId), ignore_errors=True)
+        return {}
+
+
+_storage = None
+
+def get_storage() -> Storage:
+    """The storage configured by IMAGE_STORAGE, created on first use"""
+    global _storage
+    if _storage is None:
+        if IMAGE_STORAGE == "s3":
+            import boto3
+            _storage = S3Storage(boto3.client("s3", endpoint_url=S3_ENDPOINT_URL), S3_BUCKET)
+        elif IMAGE_STORAGE == "s3-local":
+            _storage = S3Storage(LocalS3Client(IMAGE_STORAGE_PATH), S3_BUCKET)
+        else:
+            _storage = LocalStorage(IMAGE_STORAGE_PATH)
+    return _storage
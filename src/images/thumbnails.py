@@ -0,0 +1,29 @@
+import io
+
+#runs inside the image process pool, which starts its workers as fresh interpreters, so this
+#module imports nothing from the app and Pillow only when it is called
+
+THUMBNAIL_FORMAT = "webp"
+
+
+def render_thumbnails(path: str, widths: list[int]) -> dict:
+    """Scaled down copies of the image at path, as {width: webp bytes}. Widths at or above the
+    image's own are skipped, and nothing is rendered when Pillow is not installed"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return {}
+    thumbnails = {}
+    with Image.open(path) as image:
+        #lets the JPEG decoder scale down while decoding, much cheaper than decoding full size
+        image.draft("RGB", (max(widths), max(widths)))
+        image = ImageOps.exif_transpose(image)
+        for width in sorted(widths, reverse=True):
+            if width >= image.width:
+                continue
+            thumbnail = image.copy()
+            thumbnail.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            thumbnail.save(output, format=THUMBNAIL_FORMAT, quality=80)
+            thumbnails[width] = output.getvalue()
+    return thumbnails
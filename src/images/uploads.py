@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+from src.images.storage import Storage
+from src.images.thumbnails import THUMBNAIL_FORMAT, render_thumbnails
+
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_THUMBNAIL_WIDTHS = [int(width) for width in os.environ.get('IMAGE_THUMBNAIL_WIDTHS', '320,960').split(',') if width]
+IMAGE_POOL_WORKERS = int(os.environ.get('IMAGE_POOL_WORKERS', 1))
+
+SNIFF_BYTES = 12 #enough to tell the formats below apart
+
+logger = logging.getLogger(__name__)
+
+
+class ImageTooLarge(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f"Images can be at most {IMAGE_MAX_BYTES} bytes")
+
+
+class UnsupportedImage(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                         detail="Only JPEG, PNG, GIF and WebP images are supported")
+
+
+class StoredImage:
+    __slots__ = ("name", "size", "created")
+
+    def __init__(self, name: str, size: int, created: bool):
+        self.name = name
+        self.size = size
+        self.created = created #False when the same image had been uploaded before
+
+
+def image_extension(head: bytes):
+    """Extension for the format the first bytes of a file say it is, the Content-Type the
+    client sent is not trusted"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def thumbnail_name(name: str, width: int) -> str:
+    return f"{name.rsplit('.', 1)[0]}_w{width}.{THUMBNAIL_FORMAT}"
+
+async def store_image(chunks, storage: Storage) -> StoredImage:
+    """Stream an image into storage under the sha256 of its content, hashing each chunk as it
+    passes. Only a chunk (plus the storage's write buffer) is in memory at a time. Identical
+    images end up as one object, a repeated upload is discarded at commit"""
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    extension = None
+    upload = None
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > IMAGE_MAX_BYTES:
+                raise ImageTooLarge()
+            if upload is None:
+                head += chunk
+                if len(head) < SNIFF_BYTES:
+                    continue
+                extension = image_extension(head)
+                if extension is None:
+                    raise UnsupportedImage()
+                upload = await storage.begin_upload()
+                chunk, head = head, b""
+            digest.update(chunk)
+            await upload.write(chunk)
+        if upload is None:
+            raise UnsupportedImage()
+        name = f"{digest.hexdigest()}.{extension}"
+        created = await upload.commit(name)
+    except BaseException:
+        if upload is not None:
+            await upload.abort()
+        raise
+    return StoredImage(name, size, created)
+
+
+class ThumbnailRenderer:
+    """Renders the thumbnails of newly stored images on a process pool after the upload has been
+    answered. Resizing is CPU bound, so it is kept off the event loop and out of the request.
+    Thumbnails are named after the original's hash, so they are never rendered twice"""
+
+    def __init__(self, widths: list[int], workers: int = 1):
+        self.widths = widths
+        self.workers = workers
+        self.enabled = bool(widths) and importlib.util.find_spec("PIL") is not None
+        self._executor = None
+        self._tasks = set()
+
+    def _get_executor(self):
+        if self._executor is None:
+            #spawn rather than fork, forking a process that runs threads can deadlock the child
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def schedule(self, storage: Storage, name: str):
+        if not self.enabled:
+            return
+        task = asyncio.create_task(self._render(storage, name), name=f"thumbnails-{name}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _render(self, storage: Storage, name: str):
+        try:
+            async with storage.local_copy(name) as path:
+                future = self._get_executor().submit(render_thumbnails, path, self.widths)
+                thumbnails = await asyncio.wrap_future(future)
+            for width, data in thumbnails.items():
+                await storage.put(thumbnail_name(name, width), data)
+        except Exception:
+            logger.warning("Could not render thumbnails of %s", name, exc_info=True)
+
+    async def shutdown(self):
+        """Let thumbnails in progress finish, then stop the pool"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+thumbnail_renderer = ThumbnailRenderer(IMAGE_THUMBNAIL_WIDTHS, workers=IMAGE_POOL_WORKERS)
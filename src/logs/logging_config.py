@@ -1,41 +1,121 @@
+import atexit
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from logging.config import dictConfig
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LOG_FILE', 'src/logs/recipe_organizer_api.log')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+#share of ordinary requests that get an access log line, errors and slow requests are always logged
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', 1))
+ACCESS_LOG_SLOW_SECONDS = float(os.environ.get('ACCESS_LOG_SLOW_SECONDS', 1))
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+access_logger = logging.getLogger("recipe_organizer.access")
+
+#attributes every LogRecord has, anything else was passed through extra= and goes into the json line
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id", "color_message"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line with the time, level, logger, message, request id and any extra fields"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread. Only the cheap parts happen in the calling thread:
+    the message is rendered and the request id captured while the context is still there.
+    When the queue is full the record is dropped rather than making the request wait"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.request_id = request_id_var.get()
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def should_log_access(status_code: int, duration: float) -> bool:
+    if status_code >= 500 or duration >= ACCESS_LOG_SLOW_SECONDS:
+        return True
+    return ACCESS_LOG_SAMPLE_RATE >= 1 or random.random() < ACCESS_LOG_SAMPLE_RATE
 
 def setup_logging():
-    logging_config = {
-        "version": 1,
-        "disable_existing_loggers": False,
-        "formatters": {
-            "default": {
-                "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            },
-        },
-        "handlers": {
-            "file": {
-                "level": "INFO",
-                "class": "logging.handlers.RotatingFileHandler",
-                "formatter": "default",
-                "filename": "src/logs/recipe_organizer_api.log",  # Log file name
-                "maxBytes": 5 * 1024 * 1024,  # 5MB per log file
-                "backupCount": 3,  # Keep 3 backups
-            },
-            "console": {
-                "level": "INFO",
-                "class": "logging.StreamHandler",
-                "formatter": "default",
-            },
-        },
-        "loggers": {
-            "uvicorn": {
-                "handlers": ["file", "console"],
-                "level": "INFO",
-                "propagate": False,
-            },
-            "uvicorn.access": {
-                "handlers": ["file", "console"],
-                "level": "INFO",
-                "propagate": False,
-            },
-        },
-    }
-    dictConfig(logging_config)
\ No newline at end of file
+    """Send the app's and uvicorn's logs through a queue to a listener thread that does the
+    formatting and the file and console writes, so request handlers never wait on disk I/O"""
+    global _listener
+    stop_logging()
+
+    formatter = JsonFormatter()
+    file_handler = RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=5 * 1024 * 1024,  # 5MB per log file
+        backupCount=3,  # Keep 3 backups
+    )
+    console_handler = logging.StreamHandler()
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _listener = QueueListener(queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for name in ("uvicorn", "uvicorn.error"):
+        logger = logging.getLogger(name)
+        logger.handlers = []
+        logger.propagate = True
+    #access lines come from the middleware in main.py, which adds the request id and samples them
+    logging.getLogger("uvicorn.access").disabled = True
+    return queue_handler
+
+def stop_logging():
+    """Write out whatever is still queued, stop the listener thread and close its handlers"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(stop_logging)
@@ -0,0 +1,49 @@
+import logging
+import os
+from datetime import timedelta
+from src.auth.hashing import hashing_service
+from src.auth.helpers import create_access_token, generate_random_password
+from src.db import async_crud
+from src.db.database import new_async_session
+
+#invitation emails carry a new temporary password. It is only made when the email is about to
+#be sent, so it is never stored in the queue or the dead letter list, and it only replaces the
+#user's password once the email went out. Until then the user keeps the old one
+ACTIVATION_EMAIL_EXPIRE_MINUTES = 720
+
+logger = logging.getLogger(__name__)
+
+
+def invitation(to: str, subject: str, body: str, user_id: int) -> dict:
+    """A queue message inviting user_id, the password and activation link are added when it is sent"""
+    return {"to": to, "subject": subject, "body": body, "invite": user_id}
+
+def invitation_body(body: str, user_id: int, new_password: str) -> str:
+    token = create_access_token(data={"sub": user_id}, type="email", expires_delta=timedelta(minutes=ACTIVATION_EMAIL_EXPIRE_MINUTES))
+    activation_link = f"http://{os.environ.get('EMAIL_HOSTNAME')}/activate/{token}"
+    return (body
+            + f"\nYour temporary password is {new_password}"
+            + f"\nClick to activate account: {activation_link}")
+
+def with_password(message: dict) -> tuple[dict, str]:
+    """The message as it is sent and the new password written into it, None for messages that
+    are not invitations"""
+    user_id = message.get("invite")
+    if user_id is None:
+        return message, None
+    new_password = generate_random_password()
+    return {**message, "body": invitation_body(message["body"], user_id, new_password)}, new_password
+
+async def save_passwords(passwords: dict[int, str]):
+    """Give the users whose invitation was sent ({user id: password}) that password and the
+    invited status, in one transaction"""
+    if not passwords:
+        return
+    try:
+        async with new_async_session() as db:
+            recipients = await async_crud.get_invite_recipients(db, user_ids=list(passwords), limit=len(passwords))
+            hashed_passwords = await hashing_service.hash_many(passwords[recipient.id] for recipient in recipients)
+            await async_crud.invite_users(db, list(zip(recipients, hashed_passwords)))
+    except Exception:
+        #the emails are out, all that can be done is to say whose password did not change
+        logger.exception("Invitations were sent but the passwords of users %s were not saved", sorted(passwords))
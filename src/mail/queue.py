@@ -0,0 +1,150 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import redis
+
+EMAIL_QUEUE_BACKEND = os.environ.get('EMAIL_QUEUE_BACKEND', 'redis') #"redis" or "memory"
+#a message a worker took but did not acknowledge for this long is taken over by another worker,
+#longer than a batch with all its retries takes. Messages of a worker that died or was stopped
+#mid batch are sent again after this
+EMAIL_CLAIM_IDLE_SECONDS = int(os.environ.get('EMAIL_CLAIM_IDLE_SECONDS', 300))
+EMAIL_QUEUE_KEY = "email:stream"
+EMAIL_CONSUMER_GROUP = "email-workers"
+LEGACY_QUEUE_KEY = "email:queue" #the list messages were queued in before the stream
+EMAIL_DEAD_LETTER_KEY = "email:dead"
+EMAIL_DEAD_LETTER_MAX = int(os.environ.get('EMAIL_DEAD_LETTER_MAX', 1000)) #newest failures kept
+EMAIL_DEAD_LETTER_TTL_SECONDS = int(os.environ.get('EMAIL_DEAD_LETTER_TTL_SECONDS', 7 * 86400)) #since the last failure
+DEAD_LETTER_FIELDS = ("to", "subject", "invite") #never the body, which may hold a password
+
+#messages are plain dicts with "to", "subject" and "body", the sender address comes from
+#the email config at send time so queued messages survive a change of sender. Invitations
+#also have "invite", the user id, see src/mail/invites.py
+
+
+def dead_letter_entry(message: dict, error: str) -> dict:
+    """What is kept of a message that could not be sent: who it was for and why it failed"""
+    return {**{name: message[name] for name in DEAD_LETTER_FIELDS if name in message}, "error": error, "failed_at": time.time()}
+
+
+class MemoryEmailQueue:
+    """In process queue for tests and single worker setups, lost on restart"""
+
+    def __init__(self):
+        self._queue = None
+        self.dead_letters = []
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def enqueue(self, message: dict):
+        await self.enqueue_many([message])
+
+    async def enqueue_many(self, messages: list[dict]):
+        for message in messages:
+            self.queue.put_nowait(message)
+
+    async def dequeue_batch(self, max_messages: int, timeout: float) -> list[dict]:
+        """Wait up to timeout for the first message, then take whatever else is already queued"""
+        try:
+            batch = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(batch) < max_messages and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def ack(self, messages: list[dict]):
+        pass
+
+    async def dead_letter(self, message: dict, error: str):
+        self.dead_letters.append(dead_letter_entry(message, error))
+        del self.dead_letters[:-EMAIL_DEAD_LETTER_MAX]
+
+
+class RedisEmailQueue:
+    """Queue shared by every app worker and the delivery workers through a redis stream read by
+    one consumer group. A message stays pending under the worker that read it until the worker
+    acknowledges it, after it was sent or dead lettered, so a worker that dies mid batch loses
+    nothing: its messages are claimed by a worker once idle for claim_idle_seconds"""
+
+    def __init__(self, redis=None, consumer: str = None, claim_idle_seconds: int = 300):
+        self._redis = redis
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.claim_idle_seconds = claim_idle_seconds
+        self._group_ready = False
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            from src.db.database import create_redis_client
+            #own client without a read timeout, XREADGROUP blocks for longer than the shared clients allow
+            self._redis = create_redis_client(socket_timeout=None)
+        return self._redis
+
+    async def enqueue(self, message: dict):
+        await self.enqueue_many([message])
+
+    async def enqueue_many(self, messages: list[dict]):
+        if messages:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for message in messages:
+                    pipe.xadd(EMAIL_QUEUE_KEY, {"message": json.dumps(message)})
+                await pipe.execute()
+
+    async def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            await self.redis.xgroup_create(EMAIL_QUEUE_KEY, EMAIL_CONSUMER_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+        while True: #messages still in the old list
+            raw = await self.redis.rpop(LEGACY_QUEUE_KEY, 100)
+            if not raw:
+                break
+            await self.enqueue_many([json.loads(message) for message in raw])
+        self._group_ready = True
+
+    async def dequeue_batch(self, max_messages: int, timeout: float) -> list[dict]:
+        """Stale messages of other workers first, then new ones. Each comes with its stream id
+        under "queue_id", pass them to ack once done with them"""
+        await self._ensure_group()
+        _, entries, *_ = await self.redis.xautoclaim(EMAIL_QUEUE_KEY, EMAIL_CONSUMER_GROUP, self.consumer,
+                                                     min_idle_time=self.claim_idle_seconds * 1000, count=max_messages)
+        entries = [entry for entry in entries if entry[1]] #entries deleted while pending come back empty
+        if not entries:
+            streams = await self.redis.xreadgroup(EMAIL_CONSUMER_GROUP, self.consumer, {EMAIL_QUEUE_KEY: ">"},
+                                                  count=max_messages, block=max(1, int(timeout * 1000)))
+            entries = streams[0][1] if streams else []
+        return [{**json.loads(fields["message"]), "queue_id": entry_id} for entry_id, fields in entries]
+
+    async def ack(self, messages: list[dict]):
+        """Remove messages from dequeue_batch for good"""
+        ids = [message["queue_id"] for message in messages]
+        if ids:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xack(EMAIL_QUEUE_KEY, EMAIL_CONSUMER_GROUP, *ids)
+                pipe.xdel(EMAIL_QUEUE_KEY, *ids)
+                await pipe.execute()
+
+    async def dead_letter(self, message: dict, error: str):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(EMAIL_DEAD_LETTER_KEY, json.dumps(dead_letter_entry(message, error)))
+            pipe.ltrim(EMAIL_DEAD_LETTER_KEY, 0, EMAIL_DEAD_LETTER_MAX - 1)
+            pipe.expire(EMAIL_DEAD_LETTER_KEY, EMAIL_DEAD_LETTER_TTL_SECONDS)
+            await pipe.execute()
+
+
+def build_email_queue():
+    if EMAIL_QUEUE_BACKEND == "memory":
+        return MemoryEmailQueue()
+    return RedisEmailQueue(claim_idle_seconds=EMAIL_CLAIM_IDLE_SECONDS)
+
+
+email_queue = build_email_queue()
@@ -0,0 +1,102 @@
+import logging
+import smtplib
+import time
+from email.message import EmailMessage
+from src.metrics.prometheus import SMTP_LATENCY
+
+SMTP_TIMEOUT_SECONDS = 30
+SMTP_IDLE_CHECK_SECONDS = 60 #check an idle connection with NOOP before reusing it
+
+logger = logging.getLogger(__name__)
+
+#errors that will not go away by sending again, everything else is retried
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPNotSupportedError, ValueError)
+
+
+def is_permanent(error: Exception) -> bool:
+    if isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600:
+        return True
+    return isinstance(error, PERMANENT_ERRORS)
+
+
+class SMTPSender:
+    """Keeps one authenticated SMTP session open across messages and reconnects when the
+    server drops it. Blocking, so run it off the event loop. load_config returns an EmailConfig
+    and is called on every (re)connect so config changes are picked up"""
+
+    def __init__(self, load_config):
+        self.load_config = load_config
+        self.config = load_config()
+        self._smtp = None
+        self._last_used = 0.0
+
+    def connect(self):
+        self.close()
+        self.config = self.load_config()
+        if self.config is None:
+            raise RuntimeError("Email sender is not configured, use the /config endpoint")
+        with SMTP_LATENCY.labels("connect").time():
+            smtp = smtplib.SMTP(self.config.server, self.config.port, timeout=SMTP_TIMEOUT_SECONDS)
+            if self.config.starttls:
+                smtp.starttls() #email encryption needed to send message
+            if self.config.email_pass:
+                smtp.login(self.config.email_user, self.config.email_pass)
+        self._smtp = smtp
+        self._last_used = time.monotonic()
+
+    def _ensure_connected(self):
+        if self._smtp is None:
+            self.connect()
+        elif time.monotonic() - self._last_used > SMTP_IDLE_CHECK_SECONDS:
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self.connect()
+            except smtplib.SMTPException:
+                self.connect()
+
+    def build_message(self, message: dict) -> EmailMessage:
+        msg = EmailMessage()
+        msg['Subject'] = message["subject"]
+        msg['From'] = self.config.email_user
+        msg['To'] = message["to"]
+        msg.set_content(message["body"])
+        return msg
+
+    def send(self, message: dict):
+        """Send one message, reconnecting once if the session turned out to be dead"""
+        msg = self.build_message(message)
+        self._ensure_connected()
+        try:
+            with SMTP_LATENCY.labels("send").time():
+                self._smtp.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            logger.info("SMTP connection lost, reconnecting")
+            self.connect()
+            with SMTP_LATENCY.labels("send").time():
+                self._smtp.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def send_batch(self, messages: list[dict]) -> list:
+        """Send each message on the same session, returning None or the exception for each.
+        A temporary failure stops the batch and the rest get the same error so they are retried together"""
+        results = []
+        for index, message in enumerate(messages):
+            try:
+                self.send(message)
+                results.append(None)
+            except Exception as exc:
+                if is_permanent(exc):
+                    results.append(exc)
+                    continue
+                self.close() #start the retry on a fresh connection
+                results.extend([exc] * (len(messages) - index))
+                break
+        return results
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
@@ -0,0 +1,122 @@
+"""Background delivery of queued emails.
+
+Runs inside the app when EMAIL_WORKER_IN_PROCESS is set, or on its own with
+
+    python -m src.mail.worker
+
+To try it locally without a real mail server run `python -m aiosmtpd -n -l localhost:8025`
+and save an email config with server localhost, port 8025, starttls false and an empty email_pass.
+"""
+import asyncio
+import logging
+import os
+from src.config.load import email_config_store, load_email_config
+from src.mail.invites import save_passwords, with_password
+from src.mail.queue import email_queue
+from src.mail.smtp import SMTPSender, is_permanent
+
+EMAIL_WORKER_IN_PROCESS = os.environ.get('EMAIL_WORKER_IN_PROCESS', 'false').lower() in ('1', 'true', 'yes')
+EMAIL_BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE', 50))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+EMAIL_RETRY_BASE_SECONDS = float(os.environ.get('EMAIL_RETRY_BASE_SECONDS', 1))
+EMAIL_RETRY_MAX_SECONDS = 60
+EMAIL_POLL_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class EmailWorker:
+    """Pulls batches off the email queue and sends them over one reused SMTP session. Temporary
+    failures are retried with exponential backoff, anything that still fails after max_attempts
+    or fails permanently goes to the dead letter queue"""
+
+    def __init__(self, queue, sender_factory=None, batch_size: int = 50, max_attempts: int = 5, retry_base: float = 1):
+        self.queue = queue
+        self.sender_factory = sender_factory or (lambda: SMTPSender(load_email_config))
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.sent = 0
+        self.failed = 0
+        self._sender = None
+        self._stopping = False
+
+    @property
+    def sender(self) -> SMTPSender:
+        if self._sender is None:
+            self._sender = self.sender_factory()
+        return self._sender
+
+    async def process_batch(self, messages: list[dict]):
+        pending = messages
+        for attempt in range(self.max_attempts):
+            #invitations get their password only now, a new one on every attempt
+            outgoing = [with_password(message) for message in pending]
+            results = await asyncio.to_thread(self.sender.send_batch, [message for message, _ in outgoing])
+            retry = []
+            passwords = {}
+            for message, (_, password), error in zip(pending, outgoing, results):
+                if error is None:
+                    self.sent += 1
+                    if password is not None:
+                        passwords[message["invite"]] = password
+                elif is_permanent(error) or attempt == self.max_attempts - 1:
+                    self.failed += 1
+                    logger.warning("Giving up on email to %s: %s", message.get("to"), error)
+                    await self.queue.dead_letter(message, str(error))
+                else:
+                    retry.append(message)
+            await save_passwords(passwords)
+            if not retry:
+                return
+            pending = retry
+            await asyncio.sleep(min(self.retry_base * 2 ** attempt, EMAIL_RETRY_MAX_SECONDS))
+
+    async def run(self):
+        while not self._stopping:
+            try:
+                batch = await self.queue.dequeue_batch(self.batch_size, EMAIL_POLL_SECONDS)
+                if batch:
+                    await self.process_batch(batch)
+                    #only now, a worker stopped before this point leaves the batch to be claimed again
+                    await self.queue.ack(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Email worker iteration failed")
+                await asyncio.sleep(EMAIL_RETRY_BASE_SECONDS)
+
+    def close(self):
+        self._stopping = True
+        if self._sender is not None:
+            self._sender.close()
+            self._sender = None
+
+
+def build_email_worker() -> EmailWorker:
+    return EmailWorker(
+        email_queue,
+        batch_size=EMAIL_BATCH_SIZE,
+        max_attempts=EMAIL_MAX_ATTEMPTS,
+        retry_base=EMAIL_RETRY_BASE_SECONDS,
+    )
+
+
+async def main(worker: EmailWorker):
+    email_config_store.start_watching()
+    try:
+        await worker.run()
+    finally:
+        email_config_store.stop_watching()
+
+
+if __name__ == '__main__':
+    from src.logs.logging_config import setup_logging
+    setup_logging()
+    worker = build_email_worker()
+    try:
+        asyncio.run(main(worker))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
@@ -0,0 +1,120 @@
+import os
+import time
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+import redis
+
+#with more than one uvicorn worker set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by
+#the workers (clear it before every start). Each worker then writes its samples there and
+#/metrics adds up the files of all of them, so any worker can answer the scrape
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time until the response headers were ready, by route template",
+    ["method", "route", "status"], buckets=REQUEST_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requests currently being handled",
+    ["method"], multiprocess_mode="livesum",
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Database statement execution time, the count is the number of queries",
+    ["operation"], buckets=QUERY_BUCKETS,
+)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Database statements that raised", ["operation"])
+REDIS_COMMAND_LATENCY = Histogram(
+    "redis_command_duration_seconds", "Redis round trip time, pipelines count as one PIPELINE command",
+    ["command"], buckets=QUERY_BUCKETS,
+)
+REDIS_COMMAND_ERRORS = Counter("redis_command_errors_total", "Redis commands that failed", ["command"])
+PASSWORD_HASH_LATENCY = Histogram(
+    "password_hash_duration_seconds", "Time bcrypt spent hashing or verifying one password", buckets=HASH_BUCKETS,
+)
+PASSWORD_HASH_QUEUE_WAIT = Histogram(
+    "password_hash_queue_wait_seconds", "Time a password waited for a free hashing worker", buckets=HASH_BUCKETS,
+)
+PASSWORD_HASH_REJECTED = Counter("password_hash_rejected_total", "Hashing jobs turned away with a 503")
+RATE_LIMIT_REJECTED = Counter("rate_limit_rejected_total", "Requests refused with a 429", ["scope", "dimension"])
+SMTP_LATENCY = Histogram("smtp_duration_seconds", "SMTP connect and send time", ["operation"], buckets=HASH_BUCKETS)
+
+DB_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def route_label(request) -> str:
+    """The path template of the matched route, so /users/1 and /users/2 share a series"""
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+def _db_operation(statement: str) -> str:
+    operation = statement.lstrip()[:6].upper()
+    return operation if operation in DB_OPERATIONS else "OTHER"
+
+def instrument_engine(engine):
+    """Time every statement run on a sync Engine, for an AsyncEngine pass its sync_engine"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        DB_QUERY_LATENCY.labels(_db_operation(statement)).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+        DB_QUERY_ERRORS.labels(_db_operation(context.statement or "")).inc()
+
+    return engine
+
+async def _timed(command: str, call):
+    started = time.perf_counter()
+    try:
+        return await call
+    except redis.RedisError:
+        REDIS_COMMAND_ERRORS.labels(command).inc()
+        raise
+    finally:
+        REDIS_COMMAND_LATENCY.labels(command).observe(time.perf_counter() - started)
+
+def instrument_redis(client):
+    """Time the commands and pipelines of an async redis client, pub/sub waits are left out"""
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    async def timed_execute_command(*args, **options):
+        return await _timed(str(args[0]).upper(), execute_command(*args, **options))
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def timed_execute(*args, **kwargs):
+            return await _timed("PIPELINE", execute(*args, **kwargs))
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+    return client
+
+def render_metrics() -> bytes:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+def mark_process_dead(pid=None):
+    """Drop a worker's live gauges from the shared directory. A worker calls it when it shuts
+    down, gunicorn's master for each child that exited, so crashed workers are covered too"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid or os.getpid())
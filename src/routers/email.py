@@ -1,19 +1,18 @@
-from datetime import timedelta
-from email.message import EmailMessage
-import smtplib
+import asyncio
+import time
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from src.auth.helpers import generate_random_password, create_access_token, verify_id_token, verify_is_admin
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.auth.helpers import generate_random_password, verify_id_token, verify_is_admin
+from src.auth.hashing import hashing_service
 from src.config.load import load_email_config, save_email_config
-from src.db import crud
-from src.db.database import get_db
-from src.schemas.pydantic_schemas import EmailConfig, EmailRequest
-import os
-from dotenv import load_dotenv
+from src.db import async_crud
+from src.db.database import get_async_db
+from src.mail.invites import invitation, invitation_body
+from src.mail.queue import email_queue
+from src.mail.smtp import SMTPSender
+from src.schemas.pydantic_schemas import BatchEmailRequest, BatchEmailResult, EmailConfig, EmailRequest
 
-load_dotenv()
-
-ACTIVATION_EMAIL_EXPIRE_MINUTES = 720
+MAX_BATCH_INVITES = 1000 #recipients per call to /send-email/batch
 
 router = APIRouter()
 
@@ -23,12 +22,12 @@ async def email_config(config: EmailConfig):
     """
     Set the username and password for the email address that will send the welcome emails. Requires Bearer token auth and admin role.
     """
-    save_email_config(config.model_dump())
+    await save_email_config(config)
     return {"Email configs successfully saved"}
 
 
-@router.post("/api/v1/send-email", dependencies=[Depends(verify_is_admin)]) #, dependencies=[Depends(verify_user_logged_in)]
-async def send_email(request: EmailRequest, db: Session = Depends(get_db)):
+@router.post("/api/v1/send-email", status_code=202, dependencies=[Depends(verify_is_admin)]) #, dependencies=[Depends(verify_user_logged_in)]
+async def send_email(request: EmailRequest, db: AsyncSession = Depends(get_async_db)):
     """
     Send a welcome email to a customer. Requires Bearer token auth and admin role. Configure the
     email sender using the /config endpoint
@@ -38,63 +37,96 @@ async def send_email(request: EmailRequest, db: Session = Depends(get_db)):
         **subject**: subject line of email.
         **user_id**: id of the recipient of the email.
     Output:
-        A JSON string acknowledging the email was successfully sent.
+        A JSON string acknowledging the email was queued. It is delivered in the background
+        by the email worker, which gives the user a new temporary password and the invited
+        status once the email carrying them is sent.
     """
 
-    data = load_email_config()
-    sender_email = data.get("email_user")
-    password = data.get("email_pass")
-    port = data.get("port", 587)
-    server = data.get("server")
-
-    msg = EmailMessage()
-    msg['Subject'] = request.subject
-    msg['From'] = sender_email
-    recipient_user= crud.get_user_by_id(db, user_id=request.user_id)
+    recipient_user= await async_crud.get_user_by_id(db, user_id=request.user_id)
     if recipient_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    msg['To'] = recipient_user.email
 
-    new_password = generate_random_password()
-    crud.update_user(
-        db=db,
-        user=recipient_user,
-        update_user=
-        {
-            "password": new_password,
-            "status": "invited"
-        }
-    )
+    await email_queue.enqueue(invitation(recipient_user.email, request.subject, request.body, recipient_user.id))
+    return {"message": "Email queued for delivery"}
 
-    token = create_access_token(data={"sub": recipient_user.id}, type="email", expires_delta=timedelta(minutes=ACTIVATION_EMAIL_EXPIRE_MINUTES))
-    activation_link = f"http://{os.environ.get('EMAIL_HOSTNAME')}/activate/{token}"
-    msg.set_content(request.body
-                    + f"\nYour temporary password is {new_password}"
-                    + f"\nClick to activate account: {activation_link}")
-
-    try:
 
-        with smtplib.SMTP(server, port) as server:
+@router.post("/api/v1/send-email/batch", response_model=BatchEmailResult, dependencies=[Depends(verify_is_admin)])
+async def send_email_batch(request: BatchEmailRequest, db: AsyncSession = Depends(get_async_db)):
+    """
+    Send the welcome email to many customers at once. Requires Bearer token auth and admin role.
 
-            server.starttls() #email encryption needed to send message
-            server.login(sender_email, password)
-            server.send_message(msg)
-            return {"message": "Email sent successfully!"}
-    except Exception as e: #could add more details to error messages and catch different errors
-        raise HTTPException(status_code=500, detail=str(e))
+    Input:
+        **user_ids**: ids of the recipients, and/or
+        **status**: send to every user with this status, e.g. new.
+        **after_id**: only users with a greater id, to continue a batch that was cut off.
+        **body**: message content of email.
+        **subject**: subject line of email.
+    Output:
+        The outcome for each recipient (sent, failed or not_found) and the overall throughput.
+        A call takes at most 1000 recipients, when more users matched **next_after_id** is set
+        and the rest are invited by sending the request again with it as **after_id**.
+        Recipients are looked up in one query, their passwords are hashed in parallel and the emails
+        go out over a single SMTP connection. Only the users whose email was sent get the new password
+        and the invited status, saved in one transaction, the others can be invited again.
+    """
+    if load_email_config() is None:
+        raise HTTPException(status_code=503, detail="Email sender is not configured, use the /config endpoint")
+    started = time.perf_counter()
+    recipients = await async_crud.get_invite_recipients(db, user_ids=request.user_ids, status=request.status,
+                                                        after_id=request.after_id, limit=MAX_BATCH_INVITES + 1)
+    next_after_id = None
+    if len(recipients) > MAX_BATCH_INVITES:
+        recipients = recipients[:MAX_BATCH_INVITES]
+        next_after_id = recipients[-1].id
+    found = {recipient.id for recipient in recipients}
+    last_id = next_after_id or float("inf")
+    outcomes = [{"user_id": user_id, "status": "not_found"} for user_id in (request.user_ids or [])
+                if user_id not in found and request.after_id < user_id <= last_id]
+
+    new_passwords = [generate_random_password() for _ in recipients]
+    hashed_passwords = await hashing_service.hash_many(new_passwords)
+
+    messages = [
+        {"to": recipient.email, "subject": request.subject, "body": invitation_body(request.body, recipient.id, new_password)}
+        for recipient, new_password in zip(recipients, new_passwords)
+    ]
+    sender = SMTPSender(load_email_config)
+    try:
+        results = await asyncio.to_thread(sender.send_batch, messages)
+    finally:
+        await asyncio.to_thread(sender.close)
+    #a password is only reset once the email carrying it went out
+    await async_crud.invite_users(db, [(recipient, hashed) for recipient, hashed, error in zip(recipients, hashed_passwords, results)
+                                       if error is None])
+
+    for recipient, error in zip(recipients, results):
+        outcome = {"user_id": recipient.id, "email": recipient.email, "status": "sent" if error is None else "failed"}
+        if error is not None:
+            outcome["error"] = str(error)
+        outcomes.append(outcome)
+    seconds = time.perf_counter() - started
+    sent = sum(1 for error in results if error is None)
+    return {
+        "outcomes": outcomes,
+        "sent": sent,
+        "failed": len(results) - sent,
+        "seconds": seconds,
+        "emails_per_second": sent / seconds if seconds else 0.0,
+        "next_after_id": next_after_id,
+    }
 
 
 #this route does not use the /api/v2 prefix
 @router.get("/activate/{token}")
-async def activate_email_link(token: str, db: Session = Depends(get_db)):
+async def activate_email_link(token: str, db: AsyncSession = Depends(get_async_db)):
     """
     Reached upon user clicking the activation link sent to email.
     Verifies token in link is authentic and not expired and then changes status of user to active
     """
     id = verify_id_token(token)
     #now with the token verified find user in db and change status to active
-    user= crud.get_user_by_id(db, user_id=id)
-    crud.update_user(
+    user= await async_crud.get_user_by_id(db, user_id=id)
+    await async_crud.update_user(
         db=db,
         user=user,
         update_user=
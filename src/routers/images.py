@@ -0,0 +1,66 @@
+from fastapi import APIRouter, Header, HTTPException, Path
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from src.db.http_cache import etag_matches
+from src.images.storage import MEDIA_TYPES, get_storage, media_type
+
+IMAGE_NAME_PATTERN = r"^[0-9a-f]{64}(_w[0-9]+)?\.(jpg|png|gif|webp)$"
+#names are content hashes, so whatever is served under one never changes
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+router = APIRouter()
+
+
+def parse_range(header: str, size: int):
+    """(start, end) with end exclusive for a single "bytes=" range, None to send the whole
+    image. Several ranges in one request are answered with the whole image, which HTTP allows"""
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if not first: #the last n bytes
+            start, end = max(0, size - int(last)), size
+        else:
+            start, end = int(first), min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    if start >= size or start >= end:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+@router.get("/images/{name}")
+async def read_image(
+    name: str = Path(pattern=IMAGE_NAME_PATTERN),
+    range: str = Header(None),
+    if_range: str = Header(None),
+    if_none_match: str = Header(None),
+    ):
+    """
+    Get an uploaded image or one of its thumbnails. Supports conditional requests with
+    If-None-Match and partial ones with Range. No auth, the names are not guessable.
+    A thumbnail that is not there yet (or never will be, for images narrower than it)
+    redirects to the original.
+    """
+    storage = get_storage()
+    etag = f'"{name.split(".")[0]}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE, "Accept-Ranges": "bytes"}
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    size = await storage.size(name)
+    if size is None:
+        if "_w" in name:
+            original_hash = name.split("_w")[0]
+            for extension in MEDIA_TYPES:
+                if await storage.size(f"{original_hash}.{extension}") is not None:
+                    return RedirectResponse(f"{original_hash}.{extension}", headers={"Cache-Control": "no-cache"})
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    byte_range = parse_range(range, size) if range and (not if_range or if_range.strip() == etag) else None
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(storage.read(name), media_type=media_type(name), headers=headers)
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start)
+    headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return StreamingResponse(storage.read(name, start, end), status_code=206, media_type=media_type(name), headers=headers)
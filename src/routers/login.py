@@ -2,20 +2,25 @@ from datetime import timedelta
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from typing_extensions import Annotated
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from src.auth.helpers import authenticate_user, create_access_token, oauth2_scheme, blacklist_token, verify_user_logged_in
-from src.db.database import get_db
+from src.auth.rate_limit import rate_limit
+from src.db.database import get_async_db
 from src.schemas.pydantic_schemas import Token
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+#per IP allows for several people behind one NAT, per username stops guessing one account's password
+#from many addresses. Override with RATE_LIMIT_LOGIN_PER_IP / RATE_LIMIT_LOGIN_PER_USERNAME
+login_rate_limit = rate_limit("login", per_ip="30/minute", per_username="10/minute")
+
 router = APIRouter()
 
 
-@router.post("/login", response_model=Token)
+@router.post("/login", response_model=Token, dependencies=[Depends(login_rate_limit)])
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
     ):
     """
     Authenticates user credentials using a username and passwordinputted by user.
@@ -23,7 +28,7 @@ async def login_for_access_token(
 
     """
 
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -49,5 +54,5 @@ async def logout(token: Annotated[str, Depends(oauth2_scheme)]):
     Logs the user out from platform by blacklisting token passed.
     Requires Bearer token auth.
     """
-    blacklist_token(token)
+    await blacklist_token(token)
     return {"msg": "Successfully logged out."}
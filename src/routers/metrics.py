@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from src.metrics.prometheus import render_metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics():
+    """
+    Prometheus scrape endpoint, the numbers of every worker when PROMETHEUS_MULTIPROC_DIR is set.
+    Not authenticated, keep it off the public load balancer.
+    """
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,259 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.auth.helpers import verify_user_logged_in
+from src.db import async_crud
+from src.db.database import get_async_db
+from src.db.http_cache import HttpCache, make_etag, row_etag, versions
+from src.db.pagination import decode_cursor, split_page
+from src.images.storage import get_storage
+from src.images.uploads import IMAGE_MAX_BYTES, ImageTooLarge, store_image, thumbnail_name, thumbnail_renderer
+from src.schemas.pydantic_schemas import RecipeCreate, RecipeInfo, RecipeSearchResult, RecipeSummary, RecipeUpdate, SimilarRecipe, StepCreate, StepImage, StepsDiff
+from src.search.recipe_search import search_recipes
+from src.search.similar import similar_recipes
+from src.server.responses import dumps
+
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_RESULTS = 100
+MAX_SIMILAR_RESULTS = 50
+
+router = APIRouter()
+
+_recipes_cache = HttpCache("recipes")
+_recipe_cache = HttpCache("recipe")
+_similar_cache = HttpCache("similar", max_age=60) #changes only when a new build is published
+
+_search_results = TypeAdapter(list[RecipeSearchResult])
+
+
+def _is_duplicate(error: IntegrityError) -> bool:
+    """Whether the insert or update broke a unique constraint, recipe names are unique"""
+    message = str(error.orig).lower()
+    return "unique" in message or "duplicate" in message
+
+
+#list rows and cached recipes already have the fields of the response models, so they are written
+#straight to JSON with orjson instead of building a model per row (see benchmarks/serialization_bench.py)
+
+def _summary(row) -> dict:
+    return {"id": row.id, "name": row.name, "prep_time": row.prep_time, "user_id": row.user_id, "created_at": row.created_at}
+
+def _step(step) -> dict:
+    return {"step_number": step.step_number, "instruction": step.instruction, "image_url": step.image_url, "id": step.id}
+
+async def _get_owned_recipe(db: AsyncSession, recipe_id: int, user):
+    recipe = await async_crud.get_recipe(db, recipe_id)
+    if recipe is None:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+    if recipe.user_id != user.id:
+        raise HTTPException(status_code=403, detail="Only the owner can change a recipe")
+    return recipe
+
+
+@router.post("/recipes", status_code=201, response_model=RecipeInfo)
+async def create_recipe(recipe: RecipeCreate, db: AsyncSession = Depends(get_async_db), user = Depends(verify_user_logged_in)):
+    """
+    Create a recipe owned by the logged in user together with its steps. Requires Bearer token auth.
+    """
+    if len({step.step_number for step in recipe.steps}) != len(recipe.steps):
+        raise HTTPException(status_code=400, detail="Step numbers must be unique")
+    try:
+        return await async_crud.create_recipe(db, recipe, user_id=user.id)
+    except IntegrityError as error:
+        await db.rollback()
+        if not _is_duplicate(error):
+            raise
+        raise HTTPException(status_code=400, detail="Recipe name already exists")
+
+
+@router.get("/recipes", response_model=list[RecipeSummary], dependencies=[Depends(verify_user_logged_in)])
+async def read_recipes(
+    request: Request,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    user_id: int = None,
+    include_steps: bool = False,
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Get a page of recipes, optionally only those of one user. Requires Bearer token auth.
+
+    Only the summary columns are returned unless include_steps is set, in which case the steps of
+    the whole page are loaded with one extra query. When there are more recipes the X-Next-Cursor
+    response header holds the cursor to pass back for the next page. The ETag changes whenever a
+    recipe on the page (or one of its steps) does, send it back in If-None-Match to get an empty
+    304 while the page is unchanged.
+    """
+    after_id = decode_cursor(cursor)
+    rows = await async_crud.get_recipes_page(db, after_id=after_id, limit=limit + 1, user_id=user_id, with_description=include_steps, with_version=True)
+    rows, next_cursor = split_page(rows, limit)
+    #a recipe's version also changes with its steps, so the page alone decides whether they have to be loaded
+    etag = make_etag("recipes", after_id, limit, user_id, include_steps, [(row.id, row.version) for row in rows])
+    not_modified = _recipes_cache.not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    headers = _recipes_cache.headers(etag)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if include_steps:
+        steps = await async_crud.get_steps_for_recipes(db, [row.id for row in rows])
+        content = dumps([
+            {**_summary(row), "description": row.description, "steps": [_step(step) for step in steps[row.id]]}
+            for row in rows
+        ])
+    else:
+        content = dumps([_summary(row) for row in rows])
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+@router.get("/recipes/search", response_model=list[RecipeSearchResult], dependencies=[Depends(verify_user_logged_in)])
+async def search(
+    q: str = Query(min_length=1, max_length=200),
+    min_prep_time: int = Query(None, ge=0),
+    max_prep_time: int = Query(None, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_RESULTS),
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Search recipe names, descriptions and step instructions, best matches first. Every word
+    has to match, and words are matched as prefixes so partly typed queries work.
+    Requires Bearer token auth.
+
+    Input:
+        **q**: the words to search for.
+        **min_prep_time**, **max_prep_time**: optional prep time range.
+    """
+    rows = await search_recipes(db, q, min_prep_time=min_prep_time, max_prep_time=max_prep_time, limit=limit)
+    content = _search_results.dump_json([RecipeSearchResult(**row._mapping) for row in rows])
+    return Response(content=content, media_type="application/json")
+
+
+@router.get("/recipes/{recipe_id}", response_model=RecipeInfo, dependencies=[Depends(verify_user_logged_in)])
+async def read_recipe(recipe_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """
+    Get a recipe and its steps. Return 404 code if not found. Requires Bearer token auth.
+    Answers If-None-Match with the current ETag with an empty 304.
+    """
+    version = await versions.get("recipe", recipe_id)
+    if version is not None:
+        not_modified = _recipe_cache.not_modified(request, row_etag("recipe", recipe_id, version))
+        if not_modified is not None:
+            return not_modified
+    recipe = await async_crud.cached_get_recipe(db, recipe_id)
+    if recipe is None:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+    etag = row_etag("recipe", recipe_id, recipe["version"])
+    if version is None:
+        await versions.remember("recipe", recipe_id, recipe["version"])
+    not_modified = _recipe_cache.not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    content = dumps({key: value for key, value in recipe.items() if key != "version"})
+    return Response(content=content, media_type="application/json", headers=_recipe_cache.headers(etag))
+
+
+@router.get("/recipes/{recipe_id}/similar", response_model=list[SimilarRecipe], dependencies=[Depends(verify_user_logged_in)])
+async def read_similar_recipes(recipe_id: int, request: Request, limit: int = Query(10, ge=1, le=MAX_SIMILAR_RESULTS)):
+    """
+    Get the recipes most similar to a recipe by the words in their names, descriptions and steps,
+    most similar first. Requires Bearer token auth.
+
+    Served from a table that `python -m src.search.build_similar` computes ahead of time, so
+    recipes created or changed since it last ran are not included (404 for a recipe not in
+    it yet) and recipes deleted since may still be.
+
+    Output:
+        The ids of the similar recipes and how similar they are, from 0 to 1. At most as many
+        as the build keeps per recipe (SIMILAR_RECIPES_TOP_K, 20 by default), whatever the limit.
+    """
+    index = await similar_recipes.current()
+    if index is None:
+        raise HTTPException(status_code=503, detail="Similar recipes have not been computed yet")
+    limit = min(limit, index.k) #a build keeps k neighbours, more cannot be asked of it
+    similar = index.lookup(recipe_id, limit)
+    if similar is None:
+        raise HTTPException(status_code=404, detail="Recipe not found or not indexed yet")
+    etag = make_etag("similar", index.build, recipe_id, limit)
+    not_modified = _similar_cache.not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    content = dumps([{"id": similar_id, "score": round(score, 4)} for similar_id, score in similar])
+    return Response(content=content, media_type="application/json", headers=_similar_cache.headers(etag))
+
+
+@router.put("/recipes/{recipe_id}", response_model=RecipeInfo)
+async def update_recipe(recipe_id: int, update_recipe: RecipeUpdate, db: AsyncSession = Depends(get_async_db), user = Depends(verify_user_logged_in)):
+    """
+    Update the name, description or prep time of a recipe. Only the owner can do this.
+    Requires Bearer token auth.
+    """
+    recipe = await _get_owned_recipe(db, recipe_id, user)
+    try:
+        return await async_crud.update_recipe(db, recipe, update_recipe)
+    except IntegrityError as error:
+        await db.rollback()
+        if not _is_duplicate(error):
+            raise
+        raise HTTPException(status_code=400, detail="Recipe name already exists")
+
+
+@router.put("/recipes/{recipe_id}/steps", response_model=StepsDiff)
+async def update_recipe_steps(recipe_id: int, steps: list[StepCreate], db: AsyncSession = Depends(get_async_db), user = Depends(verify_user_logged_in)):
+    """
+    Replace the steps of a recipe. Steps are matched by step number and only the ones that
+    changed are written. Only the owner can do this. Requires Bearer token auth.
+
+    Output:
+        How many steps were inserted, updated, deleted and left unchanged.
+    """
+    if len({step.step_number for step in steps}) != len(steps):
+        raise HTTPException(status_code=400, detail="Step numbers must be unique")
+    await _get_owned_recipe(db, recipe_id, user)
+    return await async_crud.update_recipe_steps(db, recipe_id, steps)
+
+
+@router.put("/recipes/{recipe_id}/steps/{step_number}/image", response_model=StepImage)
+async def upload_step_image(recipe_id: int, step_number: int, request: Request, db: AsyncSession = Depends(get_async_db), user = Depends(verify_user_logged_in)):
+    """
+    Upload the image of a step. Send the image file itself as the request body (not a
+    multipart form), JPEG, PNG, GIF or WebP. Only the owner can do this. Requires Bearer token auth.
+
+    The body is streamed to storage as it arrives and stored under the hash of its content,
+    so uploading an image that is already stored just points the step at it.
+
+    Output:
+        The image url, the urls its thumbnails will have once rendered, the size and whether
+        the image was already stored.
+    """
+    if int(request.headers.get("content-length") or 0) > IMAGE_MAX_BYTES:
+        raise ImageTooLarge()
+    recipe = await _get_owned_recipe(db, recipe_id, user)
+    if not any(step.step_number == step_number for step in recipe.steps):
+        raise HTTPException(status_code=404, detail="Step not found")
+    await db.commit() #hand the connection back to the pool while the client is still sending
+
+    storage = get_storage()
+    image = await store_image(request.stream(), storage)
+    if image.created:
+        thumbnail_renderer.schedule(storage, image.name)
+    image_url = str(request.app.url_path_for("read_image", name=image.name))
+    if not await async_crud.set_step_image(db, recipe_id, step_number, image_url):
+        raise HTTPException(status_code=404, detail="Step not found")
+    return StepImage(
+        image_url=image_url,
+        thumbnail_urls={width: str(request.app.url_path_for("read_image", name=thumbnail_name(image.name, width)))
+                        for width in thumbnail_renderer.widths} if thumbnail_renderer.enabled else {},
+        size=image.size,
+        deduplicated=not image.created,
+    )
+
+
+@router.delete("/recipes/{recipe_id}")
+async def delete_recipe(recipe_id: int, db: AsyncSession = Depends(get_async_db), user = Depends(verify_user_logged_in)):
+    """
+    Delete a recipe and its steps. Only the owner can do this. Requires Bearer token auth.
+    """
+    await _get_owned_recipe(db, recipe_id, user)
+    return await async_crud.delete_recipe(db, recipe_id)
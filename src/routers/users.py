@@ -1,62 +1,342 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from src.auth.helpers import verify_user_logged_in
-from src.db import crud
-from src.db.database import get_db
-from src.schemas.pydantic_schemas import UpdateUser, UserCreation, UserInDB, UserInfo
+import csv
+import io
+import json
+from typing import Annotated
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.auth.helpers import CachedUser, verify_user_logged_in
+from src.db import async_crud
+from src.db.database import get_async_db, new_async_session
+from src.db.http_cache import HttpCache, if_match_version, make_etag, row_etag, versions
+from src.db.pagination import decode_cursor, split_page
+from src.schemas.pydantic_schemas import UpdateUser, UserCreation, UserInDB, UserInfo, UserPatch, UserVersion
+from src.server.idempotency import fingerprint, idempotency_keys
+from src.server.responses import dumps
+
+BULK_BATCH_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+MAX_BULK_UPDATES = 1000
 
 router = APIRouter()
 
+_users_cache = HttpCache("users")
+_user_cache = HttpCache("user")
+
+
+class _RequestStreamingResponse(StreamingResponse):
+    """StreamingResponse that leaves receive() to the request body. The stock one listens for
+    the client disconnecting while it streams, which would swallow the body still being read.
+    A disconnect shows up as ClientDisconnect from request.stream() instead"""
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+def _decode_line(line: bytes):
+    try:
+        return line.decode("utf-8", errors="strict").rstrip("\r")
+    except UnicodeDecodeError:
+        return None
+
+async def _read_lines(request: Request):
+    """Split the request body into lines as it arrives instead of reading it all first. Lines
+    that are not valid UTF-8 come out as None"""
+    pending = [] #start of the current line, from earlier chunks
+    async for chunk in request.stream():
+        #only the new chunk is scanned, a long line is not searched again for every chunk of it
+        *lines, rest = chunk.split(b"\n")
+        if lines:
+            lines[0] = b"".join([*pending, lines[0]])
+            pending = []
+            for line in lines:
+                yield _decode_line(line)
+        if rest:
+            pending.append(rest)
+    if pending:
+        yield _decode_line(b"".join(pending))
+
+async def _parse_rows(request: Request):
+    """Yield (line number, row dict or None when unparsable) from an NDJSON or CSV body.
+    CSV needs a header line and one record per line"""
+    is_csv = "csv" in request.headers.get("content-type", "")
+    header = None
+    line_number = 0
+    async for line in _read_lines(request):
+        line_number += 1
+        if line is None:
+            yield line_number, None
+            continue
+        if not line.strip():
+            continue
+        if not is_csv:
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                yield line_number, None
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        yield line_number, dict(zip(header, values))
+
+async def _import_users(request: Request):
+    """Create users in batches and stream back one NDJSON result per input row"""
+    counts = {"created": 0, "duplicate": 0, "invalid": 0, "error": 0}
+    seen_names, seen_emails = set(), set()
+    batch = []
+
+    def result(line_number, status, email=None):
+        counts[status] += 1
+        return json.dumps({"line": line_number, "status": status, "email": email}) + "\n"
+
+    async def flush(db):
+        try:
+            statuses = await async_crud.create_users_bulk(db, [user for _, user in batch])
+        except IntegrityError:
+            #another writer took one of the names or emails between the check and the insert
+            await db.rollback()
+            statuses = ["error"] * len(batch)
+        lines = [result(line_number, status, user.email) for (line_number, user), status in zip(batch, statuses)]
+        batch.clear()
+        return lines
+
+    async with new_async_session() as db:
+        async for line_number, row in _parse_rows(request):
+            try:
+                user = UserCreation.model_validate(row)
+            except ValidationError:
+                yield result(line_number, "invalid")
+                continue
+            if user.name in seen_names or user.email in seen_emails:
+                yield result(line_number, "duplicate", user.email)
+                continue
+            seen_names.add(user.name)
+            seen_emails.add(user.email)
+            batch.append((line_number, user))
+            if len(batch) >= BULK_BATCH_SIZE:
+                for line in await flush(db):
+                    yield line
+        for line in await flush(db):
+            yield line
+    yield json.dumps({"summary": counts}) + "\n"
+
+async def _export_users(format: str):
+    """Walk the users table in id order one batch at a time"""
+    if format == "csv":
+        yield "id,name,email\n"
+    after_id = 0
+    async with new_async_session() as db:
+        while True:
+            rows = await async_crud.get_users_page(db, after_id=after_id, limit=EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            if format == "csv":
+                out = io.StringIO()
+                csv.writer(out, lineterminator="\n").writerows(rows)
+                yield out.getvalue()
+            else:
+                yield b"".join(dumps({"id": row.id, "name": row.name, "email": row.email}) + b"\n" for row in rows)
+            after_id = rows[-1].id
+
 
 @router.post("/users", status_code=201, response_model=UserCreation, dependencies=[Depends(verify_user_logged_in)]) #, dependencies=[Depends(verify_user_logged_in)] is for non admin users
-def create_user(user: UserCreation, db: Session = Depends(get_db)):
+async def create_user(user: UserCreation, db: AsyncSession = Depends(get_async_db)):
     """
     Create a new user account. Requires Bearer token auth and admin role.
     """
-    db_user = crud.get_user_by_email(db, email=user.email)
+    db_user = await async_crud.cached_get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    return await async_crud.create_user(db=db, user=user)
+
+
+@router.post("/users/bulk", dependencies=[Depends(verify_user_logged_in)])
+async def bulk_create_users(request: Request):
+    """
+    Create many user accounts from an NDJSON body (one {"name", "email"} object per line) or a CSV
+    body with a name,email header when the content type is text/csv. The body is read as it streams
+    in and users are inserted in batches. Requires Bearer token auth and admin role.
+
+    Output:
+        One NDJSON line per input line with a status of created, duplicate, invalid or error,
+        followed by a summary line with the totals.
+    """
+    return _RequestStreamingResponse(_import_users(request), media_type="application/x-ndjson")
+
+
+@router.get("/users/export", dependencies=[Depends(verify_user_logged_in)])
+async def export_users(format: str = "ndjson"):
+    """
+    Stream every user account as NDJSON, or as CSV with format=csv, without loading the whole table.
+    Requires Bearer token auth and admin role.
+    """
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(_export_users(format), media_type=media_type)
 
 
 @router.get("/users", response_model=list[UserInfo], dependencies=[Depends(verify_user_logged_in)]) #, dependencies=[Depends(verify_user_logged_in)] is for non admin users
-def read_users(limit: int = 100, db: Session = Depends(get_db)):
+async def read_users(
+    request: Request,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    name: str = None,
+    email: str = None,
+    db: AsyncSession = Depends(get_async_db)
+    ):
     """
-    Get a list of all user accounts including admins. Requires Bearer token auth and admin role.
+    Get a page of user accounts including admins, optionally filtered by exact name or email.
+    Requires Bearer token auth and admin role.
+
+    When there are more users the X-Next-Cursor response header holds the cursor to pass
+    back for the next page. The ETag changes whenever a user on the page does, send it back
+    in If-None-Match to get an empty 304 while the page is unchanged.
     """
-    users = crud.get_users(db, limit=limit)
-    return users
+    after_id = decode_cursor(cursor)
+    rows = await async_crud.get_users_page(db, after_id=after_id, limit=limit + 1, name=name, email=email, with_version=True)
+    rows, next_cursor = split_page(rows, limit)
+    etag = make_etag("users", after_id, limit, name, email, [(row.id, row.version) for row in rows])
+    not_modified = _users_cache.not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    #rows already have exactly the UserInfo fields so they are encoded directly instead of
+    #being validated and re-serialized through the response model
+    content = dumps([{"name": row.name, "email": row.email, "id": row.id} for row in rows])
+    headers = _users_cache.headers(etag)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 @router.get("/users/{user_id}", response_model=UserInfo, dependencies=[Depends(verify_user_logged_in)]) #, dependencies=[Depends(verify_user_logged_in)] is for non admin users
-def read_user(user_id: int, db: Session = Depends(get_db)):
+async def read_user(user_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
     """
     Get user account corresponding to the id. Return 404 code if not found. Requires Bearer token auth and admin role.
+    Answers If-None-Match with the current ETag with an empty 304.
     """
-    db_user = crud.get_user_by_id(db, user_id=user_id)
+    version = await versions.get("user", user_id)
+    if version is not None:
+        not_modified = _user_cache.not_modified(request, row_etag("user", user_id, version))
+        if not_modified is not None:
+            return not_modified
+    db_user = await async_crud.cached_get_user_by_id(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user
+    etag = row_etag("user", user_id, db_user["version"])
+    if version is None:
+        await versions.remember("user", user_id, db_user["version"])
+    not_modified = _user_cache.not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    #the cached dict already has the UserInfo fields, encoded as is like the list above
+    content = dumps({"name": db_user["name"], "email": db_user["email"], "id": db_user["id"]})
+    return Response(content=content, media_type="application/json", headers=_user_cache.headers(etag))
 
 
-@router.put("/users/{user_id}", dependencies=[Depends(verify_user_logged_in)]) #, dependencies=[Depends(verify_user_logged_in)] is for non admin users
-def update_user(user_id: int, update_user: UpdateUser, db: Session = Depends(get_db)):
+def _fingerprint(*parts, password: str = None):
+    """Idempotency fingerprint of a write, passwords only count as given or not, redis never
+    gets anything they could be guessed from"""
+    return fingerprint(*parts, password is not None)
+
+
+@router.put("/users/{user_id}")
+async def update_user(
+    user_id: int,
+    update_user: UpdateUser,
+    request: Request,
+    current_user: CachedUser = Depends(verify_user_logged_in), #verify_user_logged_in is for non admin users
+    db: AsyncSession = Depends(get_async_db)
+    ):
     """
     Update user account information corresponding to the id. Return 404 code if not found. Requires Bearer token auth and admin role.
+
+    With the user's ETag in If-Match the update only applies if nobody changed the user since,
+    otherwise it answers 412 with the current ETag. A retry with the Idempotency-Key of a request
+    that succeeded gets that response back without updating again.
     """
-    db_user = crud.get_user_by_id(db, user_id=user_id)
-    if db_user is None:
-        raise HTTPException(status_code=404, detail="User not found")
-    return crud.update_user(db=db, user=db_user, update_user=update_user)
+    expected_version = if_match_version(request, "user", user_id)
+
+    async def write():
+        try:
+            row = await async_crud.write_user(db, user_id, update_user.model_dump(exclude_unset=True), expected_version)
+        except IntegrityError:
+            await db.rollback()
+            raise HTTPException(status_code=409, detail="Name or email already registered")
+        if row is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return Response(content=dumps({"name": row.name, "email": row.email}), media_type="application/json",
+                        headers={"ETag": row_etag("user", row.id, row.version)})
+
+    request_fingerprint = _fingerprint(user_id, update_user.model_dump(exclude={"password"}), expected_version,
+                                       password=update_user.password)
+    return await idempotency_keys.run(request, current_user.id, request_fingerprint, write)
+
+
+@router.patch("/users", response_model=list[UserVersion])
+async def update_users(
+    request: Request,
+    updates: Annotated[list[UserPatch], Body(min_length=1, max_length=MAX_BULK_UPDATES)],
+    current_user: CachedUser = Depends(verify_user_logged_in), #verify_user_logged_in is for non admin users
+    db: AsyncSession = Depends(get_async_db)
+    ):
+    """
+    Update many user accounts in one transaction, either all of them or none. Each entry has the
+    id and the fields to change, and optionally the version of the user it applies to (the number
+    in the user's ETag). Requires Bearer token auth and admin role.
+
+    Output:
+        The updated users with their new versions, in the order given. 404 listing the ids that
+        do not exist, or 409 listing the users now at another version, changes nothing.
+        Takes an Idempotency-Key like PUT /users/{id}.
+    """
+    user_ids = [update.id for update in updates]
+    if len(set(user_ids)) != len(user_ids):
+        raise HTTPException(status_code=422, detail="Each user can only be updated once per request")
+    changes = [update.model_dump(exclude_unset=True, exclude={"id", "version"}) for update in updates]
+    empty = [update.id for update, change in zip(updates, changes) if not change]
+    if empty:
+        raise HTTPException(status_code=422, detail={"message": "Nothing to change", "ids": empty})
+
+    async def write():
+        try:
+            rows = await async_crud.update_users_bulk(db, [
+                (update.id, change, update.version) for update, change in zip(updates, changes)
+            ])
+        except IntegrityError:
+            await db.rollback()
+            raise HTTPException(status_code=409, detail="Name or email already registered")
+        if rows is None:
+            current = await async_crud.get_user_versions(db, user_ids)
+            missing = [user_id for user_id in user_ids if user_id not in current]
+            if missing:
+                raise HTTPException(status_code=404, detail={"message": "Users not found", "ids": missing})
+            conflicts = [{"id": update.id, "version": current[update.id]} for update in updates
+                         if update.version is not None and current[update.id] != update.version]
+            raise HTTPException(status_code=409, detail={"message": "Users were changed since they were read", "users": conflicts})
+        return Response(content=dumps([{"name": row.name, "email": row.email, "id": row.id, "version": row.version} for row in rows]),
+                        media_type="application/json")
+
+    request_fingerprint = fingerprint([
+        _fingerprint(update.model_dump(exclude={"password"}), password=update.password) for update in updates
+    ])
+    return await idempotency_keys.run(request, current_user.id, request_fingerprint, write)
 
 
 @router.delete("/users/{user_id}", dependencies=[Depends(verify_user_logged_in)]) #, dependencies=[Depends(verify_user_logged_in)] is for non admin users
-def delete_user(user_id: int, db: Session = Depends(get_db)):
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     Sets user account status to 'deleted' corresponding to the id. Return 404 code if not found. Requires Bearer token auth and admin role.
     """
-    db_user = crud.get_user_by_id(db, user_id=user_id)
+    db_user = await async_crud.get_user_by_id(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return crud.delete_user(db=db, user=db_user)
+    return await async_crud.delete_user(db=db, user=db_user)
 
@@ -1,5 +1,6 @@
-from typing import Union, Optional
-from pydantic import BaseModel, EmailStr
+from datetime import datetime
+from typing import Literal, Union, Optional
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator, model_validator
 
 
 class UserCreation(BaseModel):
@@ -27,13 +28,115 @@ class UserInfo(BaseModel):
     email: Union[str, None] = None
     id: int
 
+class UserPatch(BaseModel):
+    """One user of a bulk update, only the fields given are changed"""
+    id: int
+    name: str = None
+    email: str = None
+    password: str = None
+    version: Union[int, None] = None #apply only to this version of the user, like If-Match
+
+class UserVersion(UserInfo):
+    version: int
+
 class EmailConfig(BaseModel):
+    model_config = ConfigDict(frozen=True) #shared snapshot, see src/config/load.py
+
     email_user: EmailStr
     email_pass: str
     port: int
     server: str #how to verify they are inputting a valid server for config?
+    starttls: bool = True #turn off only for a local test server such as aiosmtpd
 
 class EmailRequest(BaseModel):
     user_id: int
     subject: str
-    body: str
\ No newline at end of file
+    body: str
+
+class BatchEmailRequest(BaseModel):
+    user_ids: Optional[list[int]] = Field(default=None, max_length=1000)
+    status: Optional[Literal["new", "invited", "active", "deleted"]] = None #invite every user with this status
+    after_id: int = Field(default=0, ge=0) #only users with a greater id, next_after_id of a truncated batch
+    subject: str
+    body: str
+
+    @model_validator(mode="after")
+    def check_recipients(self):
+        if not self.user_ids and self.status is None:
+            raise ValueError("user_ids or status is required")
+        return self
+
+class InviteOutcome(BaseModel):
+    user_id: int
+    email: Union[str, None] = None
+    status: str #sent, failed or not_found
+    error: Union[str, None] = None
+
+class BatchEmailResult(BaseModel):
+    outcomes: list[InviteOutcome]
+    sent: int
+    failed: int
+    seconds: float
+    emails_per_second: float
+    next_after_id: Union[int, None] = None #set when more users matched than one batch takes, send again with it as after_id
+
+class StepCreate(BaseModel):
+    step_number: int = Field(ge=1)
+    instruction: str
+    image_url: Union[str, None] = None
+
+class StepInfo(StepCreate):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+
+class RecipeCreate(BaseModel):
+    name: str = Field(max_length=254)
+    description: Union[str, None] = None
+    prep_time: int = Field(ge=0)
+    steps: list[StepCreate] = []
+
+class RecipeUpdate(BaseModel):
+    name: Union[str, None] = Field(default=None, max_length=254)
+    description: Union[str, None] = None
+    prep_time: Union[int, None] = Field(default=None, ge=0)
+
+    @field_validator("name", "prep_time")
+    @classmethod
+    def check_not_null(cls, value):
+        #only runs for values that were sent, leaving a field out keeps its current value
+        if value is None:
+            raise ValueError("cannot be null")
+        return value
+
+class RecipeSummary(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: str
+    prep_time: int
+    user_id: int
+    created_at: Union[datetime, None] = None
+
+class RecipeSearchResult(RecipeSummary):
+    score: float
+
+class RecipeInfo(RecipeSummary):
+    description: Union[str, None] = None
+    steps: list[StepInfo] = []
+
+class SimilarRecipe(BaseModel):
+    id: int
+    score: float #cosine similarity of the two recipes' words, 0 to 1
+
+class StepImage(BaseModel):
+    image_url: str
+    thumbnail_urls: dict[int, str] #by width, rendered in the background after the upload
+    size: int
+    deduplicated: bool
+
+class StepsDiff(BaseModel):
+    inserted: int
+    updated: int
+    deleted: int
+    unchanged: int
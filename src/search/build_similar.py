@@ -0,0 +1,308 @@
+"""Build the similar recipes table that GET /recipes/{id}/similar serves.
+
+    python -m src.search.build_similar                  # re-read only recipes added or changed since the last build
+    python -m src.search.build_similar --full           # re-read every recipe
+    python -m src.search.build_similar --approximate    # compare candidate pairs only, for large catalogues
+
+Every recipe becomes a hashed bag of words over its name, description and step instructions
+(the hashing trick, so there is no vocabulary to keep in step), weighted by TF-IDF and scaled to
+unit length in a scipy sparse matrix. The term counts are kept memory-mapped next to the table,
+so the next run only reads and tokenizes recipes whose version changed. The k most similar
+recipes of each one come from blocked sparse matrix products, or with --approximate from
+comparing each recipe only with the ones that land next to it under random hyperplane hashes.
+
+The result goes to a new build directory under SIMILAR_RECIPES_PATH and is published by
+replacing its CURRENT file. API workers switch to it within SIMILAR_RECIPES_RELOAD_SECONDS.
+Run it from cron as often as suggestions should follow edits; recipes deleted since the last
+build keep showing up until the next one.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timezone
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+from src.db import database, models
+from src.search.similar import CURRENT_FILE, META_FILE, SIMILAR_RECIPES_PATH, published_build
+
+#size of the hashed feature space, changing it makes the next run a full one
+SIMILAR_RECIPES_FEATURES = int(os.environ.get('SIMILAR_RECIPES_FEATURES', 2 ** 18))
+SIMILAR_RECIPES_TOP_K = int(os.environ.get('SIMILAR_RECIPES_TOP_K', 20))
+#memory for one block of similarities in the exact search, bigger blocks are fewer matrix products
+SIMILAR_RECIPES_BLOCK_BYTES = int(os.environ.get('SIMILAR_RECIPES_BLOCK_BYTES', 256 * 1024 * 1024))
+
+FIELD_WEIGHTS = (3.0, 2.0, 1.0) #name, description, steps
+STOP_WORDS = frozenset("a an and are as at be by for from in into is it of on or the then to until with".split())
+BATCH_SIZE = 500 #recipes read per query, keeps the IN lists under sqlite's variable limit
+KEEP_BUILDS = 2 #the new build and the one workers may still have mapped
+
+#approximate search: HASH_TABLES signatures of HASH_BITS random hyperplanes each. In every table
+#the recipes are sorted by signature and each is compared with the WINDOW recipes after it. On
+#topical text these find about 80% of the exact top 10 at a cost linear in the recipes, exact
+#search is quadratic and slower from a few tens of thousands of recipes on
+HASH_TABLES = 64
+HASH_BITS = 16
+WINDOW = 8
+PAIRS_PER_CHUNK = 500000
+
+logger = logging.getLogger(__name__)
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in re.findall(r"\w+", text.lower()) if len(token) > 1 and token not in STOP_WORDS]
+
+def term_counts(documents, features: int):
+    """CSR matrix with a row of field weighted hashed term counts per (name, description, steps)"""
+    columns = {} #token -> feature, crc32 because hash() differs between processes
+    indptr, indices, data = [0], [], []
+    for fields in documents:
+        counts = defaultdict(float)
+        for text, weight in zip(fields, FIELD_WEIGHTS):
+            for token in tokenize(text or ""):
+                column = columns.get(token)
+                if column is None:
+                    column = columns[token] = zlib.crc32(token.encode()) % features
+                counts[column] += weight
+        indices.extend(counts)
+        data.extend(counts.values())
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, features),
+    )
+
+def tfidf(counts):
+    """Sublinear term frequency times smoothed inverse document frequency, each row scaled to
+    unit length so that dot products are cosine similarities"""
+    rows = counts.shape[0]
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = (np.log((1 + rows) / (1 + document_frequency)) + 1).astype(np.float32)
+    vectors = sparse.csr_matrix((
+        ((1 + np.log(counts.data)) * idf[counts.indices]).astype(np.float32),
+        np.asarray(counts.indices), np.asarray(counts.indptr),
+    ), shape=counts.shape)
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    norms[norms == 0] = 1 #recipes without a single word stay all zeros
+    vectors.data /= np.repeat(norms, np.diff(vectors.indptr)).astype(np.float32)
+    return vectors
+
+def top_k(similarities, k: int):
+    """Columns and values of the k largest values of each row, largest first"""
+    columns = np.argpartition(similarities, -k, axis=1)[:, -k:]
+    values = np.take_along_axis(similarities, columns, axis=1)
+    order = np.argsort(-values, axis=1, kind="stable")
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+def exact_neighbours(vectors, k: int, block_bytes: int):
+    """Row numbers (-1 for none) and similarities of the k most similar rows of every row,
+    comparing all pairs a block of rows at a time"""
+    rows = vectors.shape[0]
+    neighbours = np.full((rows, k), -1, dtype=np.int64)
+    scores = np.zeros((rows, k), dtype=np.float32)
+    k = min(k, rows - 1)
+    if k <= 0:
+        return neighbours, scores
+    transposed = vectors.T.tocsr()
+    block_rows = max(1, min(rows, block_bytes // (4 * rows)))
+    for start in range(0, rows, block_rows):
+        block = (vectors[start:start + block_rows] @ transposed).toarray()
+        own = np.arange(block.shape[0])
+        block[own, own + start] = 0 #a recipe is not its own neighbour
+        columns, values = top_k(block, k)
+        neighbours[start:start + len(own), :k] = np.where(values > 0, columns, -1)
+        scores[start:start + len(own), :k] = np.maximum(values, 0)
+    return neighbours, scores
+
+def approximate_neighbours(vectors, k: int, seed: int = 0):
+    """Like exact_neighbours, but each row is only compared with the rows next to it when all
+    rows are sorted by random hyperplane signatures, which similar rows tend to share. The
+    candidate pairs are scored exactly, so what is missed is neighbours, never accuracy"""
+    rows = vectors.shape[0]
+    neighbours = np.full((rows, k), -1, dtype=np.int64)
+    scores = np.zeros((rows, k), dtype=np.float32)
+    if rows < 2:
+        return neighbours, scores
+
+    #project onto the features actually used, the hyperplanes then fit in memory
+    used = np.unique(vectors.indices)
+    remap = np.zeros(vectors.shape[1], dtype=np.int32)
+    remap[used] = np.arange(len(used), dtype=np.int32)
+    compact = sparse.csr_matrix((vectors.data, remap[vectors.indices], vectors.indptr), shape=(rows, len(used)))
+    rng = np.random.default_rng(seed)
+    planes = rng.standard_normal((len(used), HASH_TABLES * HASH_BITS), dtype=np.float32)
+    above = (compact @ planes) > 0
+    bit_values = 1 << np.arange(HASH_BITS, dtype=np.int64)
+
+    pairs = []
+    for table in range(HASH_TABLES):
+        signatures = above[:, table * HASH_BITS:(table + 1) * HASH_BITS] @ bit_values
+        order = np.lexsort((rng.random(rows), signatures)) #random order within a signature
+        for offset in range(1, min(WINDOW, rows - 1) + 1):
+            first, second = order[:-offset], order[offset:]
+            pairs.append(np.minimum(first, second) * rows + np.maximum(first, second))
+    pairs = np.unique(np.concatenate(pairs))
+    first, second = np.divmod(pairs, rows)
+
+    similarity = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), PAIRS_PER_CHUNK):
+        end = start + PAIRS_PER_CHUNK
+        similarity[start:end] = np.asarray(vectors[first[start:end]].multiply(vectors[second[start:end]]).sum(axis=1)).ravel()
+
+    #both directions of every pair, then the k best per row
+    sources = np.concatenate([first, second])
+    targets = np.concatenate([second, first])
+    similarity = np.concatenate([similarity, similarity])
+    keep = similarity > 0
+    sources, targets, similarity = sources[keep], targets[keep], similarity[keep]
+    #one int64 key sorts much faster than lexsort: the source, then the similarity descending,
+    #whose float32 bits order like the values since they are all positive
+    order = np.argsort((sources << 32) | (0xFFFFFFFF - similarity.view(np.uint32)).astype(np.int64))
+    sources, targets, similarity = sources[order], targets[order], similarity[order]
+    group_starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]])
+    rank = np.arange(len(sources)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(sources)]))
+    keep = rank < k
+    neighbours[sources[keep], rank[keep]] = targets[keep]
+    scores[sources[keep], rank[keep]] = similarity[keep]
+    return neighbours, scores
+
+
+def load_previous(path: str, features: int):
+    """(ids, versions, term counts) of the published build, memory-mapped, or None when there
+    is nothing that can be reused"""
+    build = published_build(path)
+    if build is None:
+        return None
+    directory = os.path.join(path, build)
+    try:
+        with open(os.path.join(directory, META_FILE)) as fp:
+            meta = json.load(fp)
+        if meta["features"] != features:
+            return None
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                  for name in ("ids", "versions", "counts_data", "counts_indices", "counts_indptr")}
+    except (OSError, ValueError, KeyError):
+        logger.warning("Could not reuse similar recipes build %s, reading every recipe", build, exc_info=True)
+        return None
+    counts = sparse.csr_matrix((arrays["counts_data"], arrays["counts_indices"], arrays["counts_indptr"]),
+                               shape=(len(arrays["ids"]), features))
+    return arrays["ids"], arrays["versions"], counts
+
+def read_versions(connection):
+    """Ids in ascending order and versions of every recipe. Read before the recipes themselves,
+    so a recipe edited while the job runs is stored with its old version and read again next time"""
+    rows = connection.execute(select(models.Recipe.id, models.Recipe.version).order_by(models.Recipe.id)).all()
+    return np.array([row.id for row in rows], dtype=np.int64), np.array([row.version for row in rows], dtype=np.int64)
+
+def read_documents(connection, recipe_ids: list[int]):
+    """Ids and (name, description, steps) of the recipes that still exist, a batch at a time"""
+    ids, documents = [], []
+    for start in range(0, len(recipe_ids), BATCH_SIZE):
+        batch = recipe_ids[start:start + BATCH_SIZE]
+        steps = defaultdict(list)
+        stmt = (select(models.Recipe_Steps.recipe_id, models.Recipe_Steps.instruction)
+                .where(models.Recipe_Steps.recipe_id.in_(batch))
+                .order_by(models.Recipe_Steps.recipe_id, models.Recipe_Steps.step_number))
+        for row in connection.execute(stmt):
+            steps[row.recipe_id].append(row.instruction)
+        stmt = (select(models.Recipe.id, models.Recipe.name, models.Recipe.description)
+                .where(models.Recipe.id.in_(batch))
+                .order_by(models.Recipe.id))
+        for row in connection.execute(stmt):
+            ids.append(row.id)
+            documents.append((row.name, row.description, " ".join(steps[row.id])))
+    return np.array(ids, dtype=np.int64), documents
+
+def publish(path: str, meta: dict, arrays: dict) -> str:
+    """Write a new build directory, point CURRENT at it and drop builds older than KEEP_BUILDS"""
+    build = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}-{os.getpid()}" #sorts oldest first
+    directory = os.path.join(path, build)
+    os.makedirs(directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), array)
+    with open(os.path.join(directory, META_FILE), "w") as fp:
+        json.dump({**meta, "build": build}, fp)
+    current = os.path.join(path, CURRENT_FILE)
+    with open(f"{current}.tmp", "w") as fp:
+        fp.write(build)
+    os.replace(f"{current}.tmp", current)
+
+    builds = sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+    for old in builds[:-KEEP_BUILDS]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    return build
+
+def build(path: str = SIMILAR_RECIPES_PATH, full: bool = False, approximate: bool = False,
+          k: int = SIMILAR_RECIPES_TOP_K, features: int = SIMILAR_RECIPES_FEATURES) -> dict:
+    """Build and publish the similar recipes table, returns the new build's meta"""
+    started = time.perf_counter()
+    os.makedirs(path, exist_ok=True)
+    previous = None if full else load_previous(path, features)
+    with database.get_engine().connect() as connection:
+        ids, versions = read_versions(connection)
+        if previous is not None and len(previous[0]):
+            previous_ids, previous_versions, previous_counts = previous
+            previous_rows = np.minimum(np.searchsorted(previous_ids, ids), len(previous_ids) - 1)
+            unchanged = (previous_ids[previous_rows] == ids) & (previous_versions[previous_rows] == versions)
+        else:
+            previous_rows, previous_counts = None, None
+            unchanged = np.zeros(len(ids), dtype=bool)
+        read_ids, documents = read_documents(connection, ids[~unchanged].tolist())
+
+    counts = term_counts(documents, features)
+    if unchanged.any():
+        counts = sparse.vstack([previous_counts[previous_rows[unchanged]], counts], format="csr")
+    built_ids = np.concatenate([ids[unchanged], read_ids])
+    order = np.argsort(built_ids, kind="stable")
+    built_ids, counts = built_ids[order], counts[order]
+    built_versions = versions[np.searchsorted(ids, built_ids)]
+    counts.sort_indices()
+
+    vectors = tfidf(counts)
+    if approximate:
+        rows, scores = approximate_neighbours(vectors, k)
+    else:
+        rows, scores = exact_neighbours(vectors, k, SIMILAR_RECIPES_BLOCK_BYTES)
+    neighbours = np.where(rows >= 0, built_ids[np.maximum(rows, 0)], -1)
+
+    meta = {
+        "recipes": len(built_ids),
+        "read": len(read_ids),
+        "reused": int(unchanged.sum()),
+        "k": k,
+        "features": features,
+        "approximate": approximate,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    meta["build"] = publish(path, meta, {
+        "ids": built_ids,
+        "versions": built_versions,
+        "counts_data": counts.data,
+        "counts_indices": counts.indices,
+        "counts_indptr": counts.indptr.astype(np.int64),
+        "neighbours": neighbours,
+        "scores": scores,
+    })
+    return meta
+
+
+if __name__ == '__main__':
+    from src.logs.logging_config import setup_logging, stop_logging
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--full", action="store_true", help="read every recipe instead of only the changed ones")
+    parser.add_argument("--approximate", action="store_true", help="compare candidate pairs instead of every pair")
+    parser.add_argument("--k", type=int, default=SIMILAR_RECIPES_TOP_K, help="neighbours kept per recipe")
+    parser.add_argument("--path", default=SIMILAR_RECIPES_PATH)
+    args = parser.parse_args()
+    setup_logging()
+    try:
+        meta = build(args.path, full=args.full, approximate=args.approximate, k=args.k)
+        logger.info("Published similar recipes build %s", meta["build"], extra=meta)
+    finally:
+        stop_logging()
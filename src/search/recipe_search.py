@@ -0,0 +1,115 @@
+import re
+from fastapi import HTTPException
+from sqlalchemy import text
+
+#ranked recipe search over name, description and step instructions. On MySQL this uses the
+#FULLTEXT indexes declared in models.py, which MySQL keeps current by itself. On sqlite it uses
+#the recipe_search FTS5 table, kept current by the reindex/remove calls in the recipe crud functions
+
+MAX_TERMS = 10
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 4.0
+STEPS_WEIGHT = 1.0
+
+SQLITE_SEARCH = """
+SELECT r.id, r.name, r.prep_time, r.user_id, r.created_at,
+       -bm25(recipe_search, :name_weight, :description_weight, :steps_weight) AS score
+FROM recipe_search JOIN recipes r ON r.id = recipe_search.rowid
+WHERE recipe_search MATCH :query {filters}
+ORDER BY score DESC
+LIMIT :limit
+"""
+
+#on MySQL every term has to match the name or description or one of the steps, like a term
+#matching any column of the recipe's FTS5 row. Name and description share one FULLTEXT index, so
+#they are ranked together with NAME_WEIGHT and DESCRIPTION_WEIGHT does not apply there
+MYSQL_SEARCH = """
+SELECT r.id, r.name, r.prep_time, r.user_id, r.created_at,
+       MATCH(r.name, r.description) AGAINST (:query IN BOOLEAN MODE) * :name_weight
+       + COALESCE(s.score, 0) * :steps_weight AS score
+FROM recipes r
+LEFT JOIN (
+    SELECT recipe_id, MAX(MATCH(instruction) AGAINST (:query IN BOOLEAN MODE)) AS score
+    FROM recipe_steps
+    WHERE MATCH(instruction) AGAINST (:query IN BOOLEAN MODE)
+    GROUP BY recipe_id
+) s ON s.recipe_id = r.id
+WHERE {terms} {filters}
+ORDER BY score DESC
+LIMIT :limit
+"""
+
+MYSQL_TERM = """(MATCH(r.name, r.description) AGAINST (:term_{index} IN BOOLEAN MODE)
+       OR EXISTS (SELECT 1 FROM recipe_steps ts
+                  WHERE ts.recipe_id = r.id AND MATCH(ts.instruction) AGAINST (:term_{index} IN BOOLEAN MODE)))"""
+
+
+def _dialect(db) -> str:
+    return db.get_bind().dialect.name
+
+def parse_terms(query: str) -> list[str]:
+    terms = re.findall(r"\w+", query.lower())[:MAX_TERMS]
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query has no words in it")
+    return terms
+
+async def search_recipes(db, query: str, min_prep_time: int = None, max_prep_time: int = None, limit: int = 20):
+    """Rows of the recipe summary columns plus a relevance score, best first. Every word has to
+    match and the last letters of a word may be missing, so "tom sou" finds "tomato soup" """
+    terms = parse_terms(query)
+    dialect = _dialect(db)
+    params = {"limit": limit, "name_weight": NAME_WEIGHT, "steps_weight": STEPS_WEIGHT}
+    if dialect == "sqlite":
+        sql, term_matches = SQLITE_SEARCH, ""
+        params["query"] = " ".join(f'"{term}"*' for term in terms)
+        params["description_weight"] = DESCRIPTION_WEIGHT
+    elif dialect == "mysql":
+        #each term is required on its own, the whole query only ranks
+        sql = MYSQL_SEARCH
+        term_matches = " AND ".join(MYSQL_TERM.format(index=index) for index in range(len(terms)))
+        params["query"] = " ".join(f"{term}*" for term in terms)
+        params.update({f"term_{index}": f"{term}*" for index, term in enumerate(terms)})
+    else:
+        raise HTTPException(status_code=501, detail=f"Recipe search is not available on {dialect}")
+
+    filters = ""
+    if min_prep_time is not None:
+        filters += " AND r.prep_time >= :min_prep_time"
+        params["min_prep_time"] = min_prep_time
+    if max_prep_time is not None:
+        filters += " AND r.prep_time <= :max_prep_time"
+        params["max_prep_time"] = max_prep_time
+    return (await db.execute(text(sql.format(terms=term_matches, filters=filters)), params)).all()
+
+async def reindex_recipes(db, recipe_ids: list[int]):
+    """Rebuild the search rows of these recipes from the recipe and step tables. Runs in the
+    caller's transaction so the index changes commit together with the recipe"""
+    if not recipe_ids or _dialect(db) != "sqlite":
+        return
+    await remove_recipes(db, recipe_ids)
+    await db.execute(text("""
+        INSERT INTO recipe_search (rowid, name, description, steps)
+        SELECT r.id, r.name, COALESCE(r.description, ''),
+               COALESCE((SELECT group_concat(s.instruction, ' ') FROM recipe_steps s WHERE s.recipe_id = r.id), '')
+        FROM recipes r WHERE r.id IN ({ids})
+    """.format(ids=", ".join(str(int(recipe_id)) for recipe_id in recipe_ids))))
+
+async def remove_recipes(db, recipe_ids: list[int]):
+    if not recipe_ids or _dialect(db) != "sqlite":
+        return
+    await db.execute(text("DELETE FROM recipe_search WHERE rowid IN ({ids})".format(
+        ids=", ".join(str(int(recipe_id)) for recipe_id in recipe_ids))))
+
+def rebuild_search_index(connection):
+    """Fill the sqlite search table from scratch, for existing data or after a bulk load.
+    Takes a sync connection, e.g. engine.begin()"""
+    if connection.dialect.name != "sqlite":
+        return
+    connection.execute(text("DELETE FROM recipe_search"))
+    connection.execute(text("""
+        INSERT INTO recipe_search (rowid, name, description, steps)
+        SELECT r.id, r.name, COALESCE(r.description, ''), COALESCE(s.steps, '')
+        FROM recipes r
+        LEFT JOIN (SELECT recipe_id, group_concat(instruction, ' ') AS steps FROM recipe_steps GROUP BY recipe_id) s
+            ON s.recipe_id = r.id
+    """))
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+#"similar recipes" served from a table of each recipe's nearest neighbours, precomputed by
+#`python -m src.search.build_similar`. A request is a binary search over the recipe ids and a
+#slice of the table, with no database involved. The arrays are memory-mapped, so every worker
+#shares the same pages and loading a new build costs nothing until rows are read
+
+SIMILAR_RECIPES_PATH = os.environ.get('SIMILAR_RECIPES_PATH', 'data/similar-recipes')
+#how often a worker looks for a build newer than the one it serves
+SIMILAR_RECIPES_RELOAD_SECONDS = float(os.environ.get('SIMILAR_RECIPES_RELOAD_SECONDS', 10))
+
+CURRENT_FILE = "CURRENT" #holds the name of the build directory to serve, replaced atomically
+META_FILE = "meta.json"
+
+logger = logging.getLogger(__name__)
+
+
+def published_build(path: str):
+    """Name of the build directory the job last published in path, None before the first"""
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as fp:
+            return fp.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class SimilarIndex:
+    """One build: the recipe ids in ascending order, and for each of them the ids (-1 when there
+    are fewer) and cosine similarities of its k nearest recipes, best first"""
+
+    def __init__(self, directory: str):
+        import numpy as np #only once the endpoint is used, it takes a while to import
+
+        with open(os.path.join(directory, META_FILE)) as fp:
+            self.meta = json.load(fp)
+        self.build = self.meta["build"]
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        self.neighbours = np.load(os.path.join(directory, "neighbours.npy"), mmap_mode="r")
+        self.scores = np.load(os.path.join(directory, "scores.npy"), mmap_mode="r")
+        self.k = self.neighbours.shape[1]
+        self._searchsorted = np.searchsorted
+
+    def lookup(self, recipe_id: int, limit: int):
+        """[(id, score)] of the recipes most like recipe_id, None when it was not in the build"""
+        row = int(self._searchsorted(self.ids, recipe_id))
+        if row == len(self.ids) or self.ids[row] != recipe_id:
+            return None
+        neighbours = self.neighbours[row, :limit].tolist()
+        scores = self.scores[row, :limit].tolist()
+        return [(neighbour, score) for neighbour, score in zip(neighbours, scores) if neighbour >= 0]
+
+
+class SimilarRecipes:
+    """The build the job last published in path, switched to a newer one within reload_seconds
+    of it being published. Builds still being served are never modified, the job writes each
+    one to a new directory. Looking for and loading builds (reading CURRENT, importing numpy,
+    np.load) happens in a thread, requests only read the index that was swapped in"""
+
+    def __init__(self, path: str, reload_seconds: float = 10):
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self._index = None
+        self._checked_at = None
+        self._refresh_task = None
+        self._lock = threading.Lock()
+
+    async def current(self):
+        """The SimilarIndex to serve, or None before the first build. Only the first call waits
+        for a build to load, later ones keep serving the loaded one while a newer one loads"""
+        if self._checked_at is None:
+            await asyncio.to_thread(self.refresh)
+        elif time.monotonic() - self._checked_at >= self.reload_seconds and (
+                self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.create_task(asyncio.to_thread(self.refresh))
+        return self._index
+
+    def refresh(self):
+        """Load the published build if it is not the one served, blocking"""
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < self.reload_seconds:
+                return
+            build = published_build(self.path)
+            if build is not None and (self._index is None or self._index.build != build):
+                try:
+                    self._index = SimilarIndex(os.path.join(self.path, build))
+                    logger.info("Serving similar recipes build %s", build)
+                except (OSError, ValueError, KeyError):
+                    logger.warning("Could not load similar recipes build %s", build, exc_info=True)
+            self._checked_at = now
+
+
+similar_recipes = SimilarRecipes(SIMILAR_RECIPES_PATH, SIMILAR_RECIPES_RELOAD_SECONDS)
@@ -0,0 +1,15 @@
+from uvicorn_worker import UvicornWorker
+from src.server import settings
+
+
+class Worker(UvicornWorker):
+    """UvicornWorker on uvloop and httptools when installed. It stops taking new work on SIGTERM
+    and gives in-flight requests drain_seconds, leaving the rest of gunicorn's graceful_timeout
+    for the lifespan shutdown to close the pools before gunicorn kills the process"""
+
+    CONFIG_KWARGS = {
+        "loop": settings.event_loop(),
+        "http": settings.http_protocol(),
+        "timeout_graceful_shutdown": settings.drain_seconds(),
+        "access_log": False, #the middleware in main.py writes the access log
+    }
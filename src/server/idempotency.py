@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import os
+import orjson
+import redis
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+from src.db.database import get_redis_client
+
+#writes that take an Idempotency-Key header run once per key: a retry of a request that already
+#succeeded gets the stored response back instead of applying the changes again. Keys belong to
+#the user sending them and the method and path they were sent to
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400)) #how long a response can be replayed
+#how long a key stays claimed by a request that has not finished, in case its worker died
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 60))
+
+IDEMPOTENCY_KEY_PREFIX = "idempotency:"
+MAX_KEY_LENGTH = 255
+REPLAYED_HEADERS = ("etag",) #response headers stored along with the body
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*parts) -> str:
+    """Digest of what makes two requests the same one, the parsed body and the headers that change
+    what it does. A key sent again with another fingerprint is a client bug, not a retry"""
+    return hashlib.blake2b(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+
+class IdempotencyKeys:
+    """Claims a key in redis before the write runs and stores the response after it succeeded.
+    Failed requests release the key so they can be retried. Without redis the write runs
+    unprotected rather than not at all"""
+
+    def __init__(self, redis=None, ttl: int = 86400, lock_seconds: int = 60):
+        self._redis = redis
+        self.ttl = ttl
+        self.lock_seconds = lock_seconds
+
+    @property
+    def redis(self):
+        """The client given to the constructor, or the app's shared one"""
+        return self._redis or get_redis_client()
+
+    async def run(self, request: Request, owner, request_fingerprint: str, handler) -> Response:
+        """The response of handler(), an async callable returning a Response, run at most once
+        per Idempotency-Key of owner. Runs it every time when the request has no key"""
+        key = request.headers.get("idempotency-key")
+        if key is None:
+            return await handler()
+        if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} printable characters")
+        redis_key = f"{IDEMPOTENCY_KEY_PREFIX}{owner}:{request.method}:{request.url.path}:{key}"
+        try:
+            claimed = await self.redis.set(redis_key, orjson.dumps({"fingerprint": request_fingerprint}),
+                                           nx=True, ex=self.lock_seconds)
+            stored = None if claimed else await self.redis.get(redis_key)
+        except redis.RedisError:
+            logger.warning("Idempotency key lookup failed, running the request anyway", exc_info=True)
+            return await handler()
+        if not claimed:
+            if stored is None: #released or expired in between
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key was just retried, try again",
+                                    headers={"Retry-After": "1"})
+            return self._replay(orjson.loads(stored), request_fingerprint)
+
+        try:
+            response = await handler()
+        except BaseException:
+            await self._release(redis_key)
+            raise
+        if response.status_code < 300:
+            entry = {
+                "fingerprint": request_fingerprint,
+                "status": response.status_code,
+                "media_type": response.media_type,
+                "body": response.body.decode(),
+                "headers": {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers},
+            }
+            try:
+                await self.redis.set(redis_key, orjson.dumps(entry), ex=self.ttl)
+            except redis.RedisError:
+                logger.warning("Could not store the response for an Idempotency-Key", exc_info=True)
+        else:
+            await self._release(redis_key)
+        return response
+
+    def _replay(self, entry: dict, request_fingerprint: str) -> Response:
+        if entry["fingerprint"] != request_fingerprint:
+            raise HTTPException(status_code=422, detail="This Idempotency-Key was already used for a different request")
+        if "status" not in entry:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still being processed",
+                                headers={"Retry-After": "1"})
+        return Response(content=entry["body"], status_code=entry["status"], media_type=entry["media_type"],
+                        headers={**entry["headers"], "Idempotent-Replayed": "true"})
+
+    async def _release(self, redis_key: str):
+        try:
+            await self.redis.delete(redis_key)
+        except redis.RedisError:
+            logger.warning("Could not release an Idempotency-Key, it expires in %ss", self.lock_seconds, exc_info=True)
+
+
+idempotency_keys = IdempotencyKeys(None, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_LOCK_SECONDS)
@@ -0,0 +1,23 @@
+import orjson
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+#dicts keyed by numbers (thumbnail widths) are allowed, UTC datetimes end in Z the way pydantic writes them
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+
+def dumps(content) -> bytes:
+    """JSON bytes for plain data (dicts, lists, strings, numbers, datetimes) through orjson"""
+    return orjson.dumps(content, option=JSON_OPTIONS)
+
+
+class JSONResponse(ORJSONResponse):
+    """The app's default response class. Pydantic models are written by pydantic's own serializer
+    and everything else by orjson, the stdlib json module is never involved. Returning one
+    directly from an endpoint also skips FastAPI validating and encoding the return value
+    against the response model, for data that already has its shape"""
+
+    def render(self, content) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.model_dump_json().encode()
+        return dumps(content)
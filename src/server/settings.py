@@ -0,0 +1,59 @@
+import glob
+import importlib.util
+import os
+import sys
+import tempfile
+
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8080))
+#the variable uvicorn and gunicorn both read, unset means one worker per CPU this process may run on.
+#Every worker has its own database and redis pools, so the database sees up to
+#workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 0))
+#keep above the idle timeout of the load balancer in front, or it may reuse a connection the worker just closed
+KEEPALIVE_SECONDS = int(os.environ.get('KEEPALIVE_SECONDS', 5))
+BACKLOG = int(os.environ.get('BACKLOG', 2048))
+#a stopping worker gets this long to finish in-flight requests and close its pools before it is killed
+GRACEFUL_TIMEOUT = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+#part of GRACEFUL_TIMEOUT kept back from draining requests for the lifespan shutdown
+SHUTDOWN_RESERVE_SECONDS = 5
+#gunicorn only: a worker silent for this long is restarted, and workers are recycled after
+#MAX_REQUESTS (0 is never) plus up to MAX_REQUESTS_JITTER so they do not all restart at once
+WORKER_TIMEOUT = int(os.environ.get('WORKER_TIMEOUT', 60))
+MAX_REQUESTS = int(os.environ.get('MAX_REQUESTS', 0))
+MAX_REQUESTS_JITTER = int(os.environ.get('MAX_REQUESTS_JITTER', 0))
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0)) #respects cpusets and taskset, cpu_count does not
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def worker_count() -> int:
+    return WEB_CONCURRENCY or available_cpus()
+
+def drain_seconds() -> int:
+    return max(GRACEFUL_TIMEOUT - SHUTDOWN_RESERVE_SECONDS, 1)
+
+def event_loop() -> str:
+    return "uvloop" if sys.platform != "win32" and importlib.util.find_spec("uvloop") else "asyncio"
+
+def http_protocol() -> str:
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+def prepare_environment(workers: int):
+    """Defaults for settings the workers read when they import the app, call before they start.
+    The bcrypt pool is split between the workers instead of each one starting a thread per CPU,
+    and with several workers the metrics go to a shared directory so /metrics covers all of them"""
+    os.environ.setdefault('HASH_POOL_WORKERS', str(max(1, available_cpus() // workers)))
+    if workers > 1:
+        os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f"recipe-organizer-metrics-{PORT}"))
+
+def clear_metrics_dir():
+    """Remove the samples of a previous run, the directory has to start empty"""
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)